@@ -4,9 +4,9 @@ import numpy as np
 class Param:
     # === can't change now ===
     N_STAGE = 5
-    BATCH_RPN = 1
     BATCH_RoI = 4
     # === could change now ===
+    BATCH_RPN = 4  # images per RPN header train step, 4 to 16 keep the cpu kernels busy
 
     # --- Anchor generator ---
     BASE_SIZE = 12
@@ -17,6 +17,20 @@ class Param:
     # --- NN train data generator ---
     THRESHOLD_IOU_RPN = 0.7
     THRESHOLD_IOU_RoI = 0.55
+    # random augmentation of the train samples in memory, before the target assignment
+    AUGMENT_FLIP_HORIZONTAL = 0.5  # probability
+    AUGMENT_FLIP_VERTICAL = 0.0  # probability
+    # (min, max) zoom, e.g. (0.8, 1.2). None for no scale jitter, which keeps the RPN target cache useful
+    AUGMENT_SCALE_RANGE = None
+    # RPN targets of the samples which are not augmented read from an on disk cache. A scale jittered sample is
+    # never read from it, so it is only on without scale jitter (flips only: hit rate (1 - p_h) * (1 - p_v))
+    RPN_TARGET_CACHE = AUGMENT_SCALE_RANGE is None
+    # RPN header samples made by worker processes with shared memory ring buffers, 0 for the tf.data pipeline
+    N_SAMPLE_WORKERS = 0
+    SAMPLE_QUEUE_DEPTH = 4  # ring buffer slots of each worker, one BATCH_RPN batch per slot
+    # RPN header samples resized to the shape of their aspect ratio bucket instead of IMG_RESIZED_SHAPE, e.g.
+    # AspectBuckets.SHAPES. The models are then built with a dynamic input shape. None for the fixed shape
+    ASPECT_BUCKETS = None
 
     # --- RPN ---
     PATH_MODEL = 'SavedModels'
@@ -39,3 +53,4 @@ class Param:
     # --- File and Directory ---
     DATA_JSON_FILE = ''
     PATH_IMAGES = ''
+    PATH_IMAGE_SHARDS = ''  # folder of the packed ImageShards, '' means decoding the images of PATH_IMAGES
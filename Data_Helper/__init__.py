@@ -1 +1,8 @@
+from Data_Helper.cocojsonstream import CocoJsonStream
+from Data_Helper.cocosharder import CocoSharder
+from Data_Helper.annotationcache import AnnotationCache
+from Data_Helper.bytelrucache import ByteLruCache
+from Data_Helper.imageshards import ImageShards
+from Data_Helper.maskstore import MaskStore
+from Data_Helper.visualrenderer import VisualRenderer
 from Data_Helper.cocotools import CocoTools
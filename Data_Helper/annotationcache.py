@@ -0,0 +1,445 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from Data_Helper.cocojsonstream import CocoJsonStream
+
+
+class AnnotationCache:
+    # Columnar cache of a coco json file, one folder of .npy arrays next to the json, loaded with mmap,
+    # so a process start only reads the small meta.json instead of parsing the whole annotation file.
+    # The annotations are grouped by image in the order of image_ids, the annotations of image k are the rows
+    # anno_offsets[k]:anno_offsets[k + 1] of boxes, category_ids and categories_sparse.
+    # Polygons are packed: the points of polygon p are polygon_points[polygon_offsets[p]:polygon_offsets[p + 1]]
+    # and the polygons of annotation a are anno_polygon_offsets[a]:anno_polygon_offsets[a + 1].
+    # RLE segmentations (crowd) are stored uncompressed: rle_counts[anno_rle_offsets[a]:anno_rle_offsets[a + 1]],
+    # with the size of the original image.
+    VERSION = 2
+    ARRAYS = ('image_shapes', 'anno_offsets', 'boxes', 'category_ids', 'categories_sparse',
+              'segm_is_polygon', 'anno_polygon_offsets', 'polygon_offsets', 'polygon_points',
+              'anno_rle_offsets', 'rle_counts')
+
+    def __init__(self, cache_dir: str, mmap_mode: str = 'r'):
+        self.cache_dir = cache_dir
+        with open(f"{cache_dir}/meta.json", 'r') as f:
+            self.meta = json.load(f)
+        self.image_ids = self.meta['image_ids']
+        self.file_names = self.meta['file_names']
+        self.categories = self.meta['categories']
+        self.image_id2row = {image_id: row for row, image_id in enumerate(self.image_ids)}
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(f"{cache_dir}/{name}.npy", mmap_mode=mmap_mode))
+
+    @classmethod
+    def cache_dir_for(cls, json_file: str, resized_shape):
+        # boxes are stored resized, so every resized shape has its own cache
+        suffix = f"{resized_shape[0]}x{resized_shape[1]}" if resized_shape is not None else 'original'
+        return f"{json_file}.cache_{suffix}"
+
+    @classmethod
+    def is_fresh(cls, cache_dir: str, json_file: str, resized_shape):
+        # staleness is checked with the size and mtime of the json, hashing the whole file costs seconds
+        try:
+            with open(f"{cache_dir}/meta.json", 'r') as f:
+                meta = json.load(f)
+            stat = os.stat(json_file)
+        except (OSError, ValueError):
+            return False
+        return (meta.get('version') == cls.VERSION
+                and meta.get('json_size') == stat.st_size
+                and meta.get('json_mtime_ns') == stat.st_mtime_ns
+                and meta.get('resized_shape') == cls._resized_hw(resized_shape))
+
+    @classmethod
+    def load(cls, json_file: str, resized_shape):
+        '''
+        :return: AnnotationCache, None if there is no cache of the json file or the cache is stale
+        '''
+        cache_dir = cls.cache_dir_for(json_file, resized_shape)
+        if not cls.is_fresh(cache_dir, json_file, resized_shape):
+            return None
+        return cls(cache_dir)
+
+    @classmethod
+    def compile(cls, dataset: dict, json_file: str, resized_shape):
+        '''
+        write the cache of a parsed coco json file, the resize of the boxes is applied once here, vectorized.
+        :param dataset: the parsed json file, same with json.load
+        :param resized_shape: (height, width, ...) or None for no resize
+        :return: AnnotationCache of the written cache
+        '''
+        stat = os.stat(json_file)
+        writer = _CacheWriter(cls.cache_dir_for(json_file, resized_shape))
+        for image in dataset['images']:
+            writer.add_image(image)
+        for category in dataset['categories']:
+            writer.add_category(category)
+        for anno in dataset['annotations']:
+            writer.add_annotation(anno)
+        return cls(writer.finalize(stat, cls._resized_hw(resized_shape)))
+
+    @classmethod
+    def compile_streaming(cls, json_file: str, resized_shape, chunk_size: int = 1 << 22):
+        '''
+        same cache with compile, but the json file is never parsed as a whole: the images, annotations and
+        categories are streamed by CocoJsonStream and each annotation is written to the cache folder as a compact
+        record, in blocks. The peak memory is the compact index arrays (tens of bytes per annotation)
+        instead of the python dicts of the whole document.
+        '''
+        stat = os.stat(json_file)
+        writer = _CacheWriter(cls.cache_dir_for(json_file, resized_shape))
+        add = {'images': writer.add_image, 'categories': writer.add_category, 'annotations': writer.add_annotation}
+        for key, value in CocoJsonStream(json_file, stream_keys=tuple(add), chunk_size=chunk_size):
+            if key in add:
+                add[key](value)
+        return cls(writer.finalize(stat, cls._resized_hw(resized_shape)))
+
+    @classmethod
+    def _resized_hw(cls, resized_shape):
+        return None if resized_shape is None else [int(resized_shape[0]), int(resized_shape[1])]
+
+    def anno_slice(self, image_id):
+        # rows of the annotations of image_id, an empty slice for an unknown image
+        row = self.image_id2row.get(image_id)
+        if row is None:
+            return slice(0, 0)
+        return slice(int(self.anno_offsets[row]), int(self.anno_offsets[row + 1]))
+
+    def get_image_shape(self, image_id):
+        row = self.image_id2row.get(image_id)
+        if row is not None:
+            return tuple(int(v) for v in self.image_shapes[row])
+
+    def get_image_name(self, image_id):
+        row = self.image_id2row.get(image_id)
+        if row is not None:
+            return self.file_names[row]
+
+    def get_polygons(self, anno_index: int):
+        # list of (n, 2) float64 polygons of one annotation, point format (y, x) same with the json
+        first, last = self.anno_polygon_offsets[anno_index], self.anno_polygon_offsets[anno_index + 1]
+        return [self.polygon_points[self.polygon_offsets[p]:self.polygon_offsets[p + 1]] for p in range(first, last)]
+
+    def get_points(self, anno_index: int):
+        # all the points of all the polygons of one annotation, same with reshaping the segmentation list to (-1, 2)
+        first, last = self.anno_polygon_offsets[anno_index], self.anno_polygon_offsets[anno_index + 1]
+        return self.polygon_points[self.polygon_offsets[first]:self.polygon_offsets[last]]
+
+    def get_rle_counts(self, anno_index: int):
+        # uncompressed rle counts of one annotation, column major, empty for a polygon annotation
+        return self.rle_counts[self.anno_rle_offsets[anno_index]:self.anno_rle_offsets[anno_index + 1]]
+
+
+class _CacheWriter:
+    # Writes the compact annotation records to raw column files in blocks, then groups them by image into
+    # the arrays of AnnotationCache. The dicts of the json are never kept, only the images and categories.
+    # columns: name -> (dtype, shape of one value)
+    COLUMNS = {'bbox': (np.float64, (4,)), 'category_id': (np.int64, ()), 'image_key': (np.int64, ()),
+               'segm_is_polygon': (bool, ()), 'n_polygons': (np.int64, ()), 'polygon_len': (np.int64, ()),
+               'points': (np.float64, (2,)), 'rle_len': (np.int64, ()), 'rle_counts': (np.int64, ())}
+
+    def __init__(self, cache_dir: str, block_size: int = 1 << 16):
+        '''
+        :param block_size: annotations buffered before a write, annotations and polygons grouped per block in finalize
+        '''
+        self.cache_dir = cache_dir
+        self.tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+        self.block_size = block_size
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self.files = {name: open(self._column_path(name), 'wb') for name in self.COLUMNS}
+        self.buffers = {name: [] for name in self.COLUMNS}
+        # image id -> key, in order of first appearance in images or annotations, the annotations may come first
+        self.image_keys = {}
+        # image id -> (height, width, file_name), first occurrence of each id, same with CocoTools
+        self.images = {}
+        self.categories = []
+        self.n_annotations = 0
+
+    def _column_path(self, name):
+        return f"{self.tmp_dir}/column_{name}.bin"
+
+    def add_image(self, image):
+        self.image_keys.setdefault(image['id'], len(self.image_keys))
+        if image['id'] not in self.images:
+            self.images[image['id']] = (image['height'], image['width'], image['file_name'])
+
+    def add_category(self, category):
+        self.categories.append(category)
+
+    def add_annotation(self, anno):
+        buffers = self.buffers
+        buffers['bbox'].extend(anno['bbox'])
+        buffers['category_id'].append(anno['category_id'])
+        buffers['image_key'].append(self.image_keys.setdefault(anno['image_id'], len(self.image_keys)))
+        segm = anno['segmentation']
+        # rle segmentations (crowd) have no polygon
+        is_polygon = isinstance(segm, list)
+        buffers['segm_is_polygon'].append(is_polygon)
+        buffers['n_polygons'].append(len(segm) if is_polygon else 0)
+        if is_polygon:
+            for polygon in segm:
+                buffers['polygon_len'].append(len(polygon) // 2)
+                buffers['points'].extend(polygon[:len(polygon) // 2 * 2])
+            buffers['rle_len'].append(0)
+        else:
+            counts = segm['counts']
+            if isinstance(counts, (str, bytes)):
+                counts = _rle_string_to_counts(counts)
+            buffers['rle_len'].append(len(counts))
+            buffers['rle_counts'].extend(counts)
+        self.n_annotations += 1
+        if (len(buffers['category_id']) >= self.block_size or len(buffers['points']) >= self.block_size * 16
+                or len(buffers['rle_counts']) >= self.block_size * 16):
+            self._flush()
+
+    def _flush(self):
+        for name, (dtype, _) in self.COLUMNS.items():
+            np.asarray(self.buffers[name], dtype=dtype).tofile(self.files[name])
+            self.buffers[name].clear()
+
+    def _read_column(self, name):
+        dtype, shape = self.COLUMNS[name]
+        return np.fromfile(self._column_path(name), dtype=dtype).reshape((-1,) + shape)
+
+    def _gather(self, fd, name, starts, lengths):
+        # rows of a column (start, length in rows) read with one pread per run of ranges which are
+        # consecutive in the file. mmap is not used here: the kernel maps the pages around each random access,
+        # and the resident memory of the gather would grow to the whole column
+        dtype, shape = self.COLUMNS[name]
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        if starts.size == 0:
+            return np.zeros(shape=(0,) + shape, dtype=dtype)
+        ends = starts + lengths
+        breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+        run_starts = starts[np.concatenate([[0], breaks])].tolist()
+        run_ends = ends[np.concatenate([breaks - 1, [starts.size - 1]])].tolist()
+        data = b''.join(os.pread(fd, (end - start) * row_bytes, start * row_bytes)
+                        for start, end in zip(run_starts, run_ends))
+        return np.frombuffer(data, dtype=dtype).reshape((-1,) + shape)
+
+    def _open_array(self, name, dtype, shape):
+        # output .npy written sequentially block by block with tofile, the header is written first
+        f = open(f"{self.tmp_dir}/{name}.npy", 'wb')
+        np.lib.format.write_array_header_2_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                 'fortran_order': False, 'shape': shape})
+        return f
+
+    def finalize(self, json_stat, resized_hw):
+        '''
+        :return: the cache folder
+        '''
+        self._flush()
+        for f in self.files.values():
+            f.close()
+        # the compact per annotation columns are read into memory, the points only block by block
+        columns = {name: self._read_column(name) for name in self.COLUMNS if name not in ('points', 'rle_counts')}
+
+        # --- images ---
+        image_ids = list(self.images)
+        image_shapes = np.array([image[:2] for image in self.images.values()], dtype=np.int32).reshape((-1, 2))
+        key2row = np.full(shape=len(self.image_keys), fill_value=-1, dtype=np.int64)
+        for row, image_id in enumerate(image_ids):
+            key2row[self.image_keys[image_id]] = row
+
+        # --- category mapping, same with CocoTools ---
+        category2sparse = {}
+        for category in self.categories:
+            category2sparse.setdefault(category['id'], len(category2sparse))
+        known_categories = np.array(sorted(category2sparse), dtype=np.int64)
+        known_sparse = np.array([category2sparse[c] for c in known_categories.tolist()], dtype=np.int32)
+
+        # --- annotations grouped by image, the json order is kept inside each image ---
+        anno_rows = key2row[columns['image_key']]
+        order = np.flatnonzero(anno_rows >= 0)
+        order = order[np.argsort(anno_rows[order], kind='stable')]
+        anno_offsets = np.zeros(shape=len(image_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(anno_rows[order], minlength=len(image_ids)), out=anno_offsets[1:])
+
+        # --- polygons of annotation a are the ranges of its polygons in file order, concatenated in image order ---
+        n_polygons = columns['n_polygons']
+        polygon_len = columns['polygon_len']
+        file_anno_polygon_starts = np.concatenate([[0], np.cumsum(n_polygons)]).astype(np.int64)
+        file_polygon_point_starts = np.concatenate([[0], np.cumsum(polygon_len)]).astype(np.int64)
+        polygon_order = _concat_ranges(file_anno_polygon_starts[order], n_polygons[order])
+        anno_polygon_offsets = np.concatenate([[0], np.cumsum(n_polygons[order])]).astype(np.int64)
+        polygon_offsets = np.concatenate([[0], np.cumsum(polygon_len[polygon_order])]).astype(np.int64)
+        rle_len = columns['rle_len']
+        file_rle_starts = np.concatenate([[0], np.cumsum(rle_len)]).astype(np.int64)
+        anno_rle_offsets = np.concatenate([[0], np.cumsum(rle_len[order])]).astype(np.int64)
+
+        n = order.size
+        outputs = {'boxes': self._open_array('boxes', np.int32, (n, 4)),
+                   'category_ids': self._open_array('category_ids', np.int64, (n,)),
+                   'categories_sparse': self._open_array('categories_sparse', np.int32, (n,)),
+                   'segm_is_polygon': self._open_array('segm_is_polygon', bool, (n,)),
+                   'polygon_points': self._open_array('polygon_points', np.float64, (int(polygon_offsets[-1]), 2)),
+                   'rle_counts': self._open_array('rle_counts', np.int64, (int(anno_rle_offsets[-1]),))}
+        for start in range(0, n, self.block_size):
+            block = order[start:start + self.block_size]
+            # boxes: opencv (y, x, dy, dx) to numpy (x1, y1, x2, y2), same int truncation with CocoTools
+            raw = columns['bbox'][block].astype(np.int64)
+            boxes = np.stack([raw[:, 1], raw[:, 0], raw[:, 1] + raw[:, 3], raw[:, 0] + raw[:, 2]], axis=1)
+            if resized_hw is not None:
+                original_hw = image_shapes[anno_rows[block]][:, [0, 1, 0, 1]]
+                boxes = boxes / original_hw * np.array(resized_hw)[[0, 1, 0, 1]]
+            boxes.astype(np.int32).tofile(outputs['boxes'])
+            category_ids = columns['category_id'][block]
+            category_ids.tofile(outputs['category_ids'])
+            sparse_index = np.searchsorted(known_categories, category_ids)
+            known = sparse_index < known_categories.size
+            known[known] = known_categories[sparse_index[known]] == category_ids[known]
+            if not np.all(known):
+                raise KeyError(int(category_ids[np.argmin(known)]))
+            known_sparse[sparse_index].tofile(outputs['categories_sparse'])
+            columns['segm_is_polygon'][block].tofile(outputs['segm_is_polygon'])
+        with open(self._column_path('points'), 'rb') as points_file:
+            for start in range(0, polygon_order.size, self.block_size):
+                block = polygon_order[start:start + self.block_size]
+                self._gather(points_file.fileno(), 'points', file_polygon_point_starts[block],
+                             polygon_len[block]).tofile(outputs['polygon_points'])
+        with open(self._column_path('rle_counts'), 'rb') as rle_file:
+            for start in range(0, n, self.block_size):
+                block = order[start:start + self.block_size]
+                self._gather(rle_file.fileno(), 'rle_counts', file_rle_starts[block],
+                             rle_len[block]).tofile(outputs['rle_counts'])
+        for f in outputs.values():
+            f.close()
+        del columns
+        for name in self.COLUMNS:
+            os.remove(self._column_path(name))
+
+        np.save(f"{self.tmp_dir}/image_shapes.npy", image_shapes)
+        np.save(f"{self.tmp_dir}/anno_offsets.npy", anno_offsets)
+        np.save(f"{self.tmp_dir}/anno_polygon_offsets.npy", anno_polygon_offsets)
+        np.save(f"{self.tmp_dir}/polygon_offsets.npy", polygon_offsets)
+        np.save(f"{self.tmp_dir}/anno_rle_offsets.npy", anno_rle_offsets)
+        meta = {'version': AnnotationCache.VERSION, 'json_size': json_stat.st_size,
+                'json_mtime_ns': json_stat.st_mtime_ns, 'resized_shape': resized_hw, 'image_ids': image_ids,
+                'file_names': [image[2] for image in self.images.values()], 'categories': self.categories}
+        with open(f"{self.tmp_dir}/meta.json", 'w') as f:
+            json.dump(meta, f)
+        # --- rename the finished folder, a crashed compile never leaves a half written cache ---
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.replace(self.tmp_dir, self.cache_dir)
+        return self.cache_dir
+
+
+def _rle_string_to_counts(string):
+    # compressed coco rle string to uncompressed counts, same with rleFrString of the coco mask api:
+    # each count is a signed variable length number of 5 bit groups, stored as chars from 48,
+    # counts after the second are stored as the difference to the count two before
+    if isinstance(string, bytes):
+        string = string.decode('ascii')
+    counts = []
+    p = 0
+    while p < len(string):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(string[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+def _concat_ranges(starts, lengths):
+    # concatenation of arange(start, start + length) for each pair, vectorized
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(shape=(0,), dtype=np.int64)
+    ends = np.cumsum(lengths)
+    shifts = np.repeat(np.asarray(starts, dtype=np.int64) - (ends - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + shifts
+
+
+def benchmark_cache(json_file: str, resized_shape=(800, 1333, 3)):
+    import time
+
+    t = time.time()
+    with open(json_file, 'r') as f:
+        dataset = json.load(f)
+    time_json = time.time() - t
+    t = time.time()
+    AnnotationCache.compile(dataset, json_file, resized_shape)
+    time_compile = time.time() - t
+    t = time.time()
+    cache = AnnotationCache.load(json_file, resized_shape)
+    time_load = time.time() - t
+    print(f"images: {len(cache.image_ids)}, annotations: {cache.boxes.shape[0]}, json.load: {time_json:.2f} s, "
+          f"compile: {time_compile:.2f} s, mmap load: {time_load * 1000:.1f} ms")
+
+
+def write_synthetic_coco(json_file: str, n_annotations: int = 1000000, n_images: int = 100000, n_points: int = 16):
+    # coco style json with random boxes and one polygon per annotation, written in blocks
+    rng = np.random.default_rng(0)
+    with open(json_file, 'w') as f:
+        f.write('{"info": {}, "licenses": [], "categories": ')
+        f.write(json.dumps([{'id': i + 1, 'name': f'c{i + 1}'} for i in range(80)]))
+        f.write(', "images": ')
+        f.write(json.dumps([{'id': i, 'height': 480, 'width': 640, 'file_name': f'{i:012d}.jpg'}
+                            for i in range(n_images)]))
+        f.write(', "annotations": [')
+        block_size = 10000
+        for start in range(0, n_annotations, block_size):
+            n = min(block_size, n_annotations - start)
+            boxes = np.round(rng.uniform(0, 300, size=(n, 4)), 2).tolist()
+            polygons = np.round(rng.uniform(0, 480, size=(n, n_points * 2)), 2).tolist()
+            image_ids = rng.integers(0, n_images, size=n).tolist()
+            categories = rng.integers(1, 81, size=n).tolist()
+            annotations = [{'id': start + k, 'image_id': image_ids[k], 'category_id': categories[k], 'iscrowd': 0,
+                            'bbox': boxes[k], 'area': boxes[k][2] * boxes[k][3], 'segmentation': [polygons[k]]}
+                           for k in range(n)]
+            if start > 0:
+                f.write(', ')
+            f.write(json.dumps(annotations)[1:-1])
+        f.write(']}')
+
+
+def _measure_compile(json_file: str, resized_shape, streaming: bool):
+    # run in a fresh process, so ru_maxrss is the peak of this compile only
+    import resource
+    import time
+
+    t = time.time()
+    if streaming:
+        cache = AnnotationCache.compile_streaming(json_file, resized_shape)
+    else:
+        with open(json_file, 'r') as f:
+            dataset = json.load(f)
+        cache = AnnotationCache.compile(dataset, json_file, resized_shape)
+    seconds = time.time() - t
+    # ru_maxrss is in KB on linux
+    return seconds, cache.boxes.shape[0], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_streaming(json_file: str = '/tmp/coco_synthetic_1m.json', n_annotations: int = 1000000,
+                        resized_shape=(800, 1333, 3)):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not os.path.exists(json_file):
+        write_synthetic_coco(json_file, n_annotations)
+    size_mb = os.path.getsize(json_file) / 2 ** 20
+    for streaming in (False, True):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            seconds, n, peak_mb = pool.submit(_measure_compile, json_file, resized_shape, streaming).result()
+        print(f"{'streaming' if streaming else 'json.load'}: {n} annotations, {size_mb:.0f} MB json, "
+              f"{seconds:.1f} s ({n / seconds / 1000:.0f}k annotations/s, {size_mb / seconds:.1f} MB/s), "
+              f"peak rss: {peak_mb:.0f} MB")
+
+
+if __name__ == '__main__':
+    benchmark_cache('/media/liushuzhi/HDD500/Dataset/COCO2017/annotations/instances_val2017.json')
+    benchmark_streaming()
@@ -0,0 +1,61 @@
+import collections
+import threading
+
+
+class ByteLruCache:
+    # Thread safe LRU cache with a byte budget instead of an entry count,
+    # the least recently used entries are evicted until the cached values fit in max_bytes.
+    # Values are stored as they are, callers store read only arrays so a cached value is never changed.
+    def __init__(self, max_bytes: int):
+        '''
+        :param max_bytes: byte budget, a value larger than the budget is returned but never cached
+        '''
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        :return: the cached value, None on a miss
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, n_bytes: int):
+        '''
+        :return: value, so a loader can end with return cache.put(key, value, value.nbytes)
+        '''
+        if n_bytes > self.max_bytes:
+            return value
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.n_bytes -= old[1]
+            self._entries[key] = (value, n_bytes)
+            self.n_bytes += n_bytes
+            while self.n_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.n_bytes -= evicted_bytes
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'bytes': self.n_bytes, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / n_lookups if n_lookups else 0.0, 'evictions': self.evictions}
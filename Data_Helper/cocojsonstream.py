@@ -0,0 +1,97 @@
+import json
+
+
+class CocoJsonStream:
+    # Incremental reader of a coco json file, only uses the stdlib json decoder.
+    # The file is read in chunks and the elements of the arrays in stream_keys (images, annotations, ...)
+    # are decoded and yielded one by one, so only one element and one chunk are held in memory at a time.
+    # The other top level values (info, licenses, ...) are yielded whole.
+    def __init__(self, file: str, stream_keys=('images', 'annotations', 'categories'), chunk_size: int = 1 << 22):
+        '''
+        :param stream_keys: top level keys whose arrays are yielded element by element
+        :param chunk_size: number of characters read from the file at a time
+        '''
+        self.file = file
+        self.stream_keys = set(stream_keys)
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+
+    def __iter__(self):
+        '''
+        :return: iterator of (key, value), one per element for the keys in stream_keys, one per key for the others
+        '''
+        with open(self.file, 'r', encoding='utf-8') as f:
+            self._f = f
+            self._buf = ''
+            self._pos = 0
+            self._eof = False
+            self._expect('{')
+            if self._peek() == '}':
+                return
+            while True:
+                key = self._decode()
+                self._expect(':')
+                if key in self.stream_keys and self._peek() == '[':
+                    self._pos += 1
+                    if self._peek() == ']':
+                        self._pos += 1
+                    else:
+                        while True:
+                            yield key, self._decode()
+                            if self._next_separator(']'):
+                                break
+                else:
+                    yield key, self._decode()
+                if self._next_separator('}'):
+                    return
+
+    def _read_more(self, n_chars: int):
+        # drop the consumed part of the buffer before appending, the buffer stays about one chunk long
+        if self._eof:
+            return False
+        chunk = self._f.read(n_chars)
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        self._eof = len(chunk) < n_chars
+        return len(chunk) > 0
+
+    def _peek(self):
+        # skip whitespace and return the next character without consuming it
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\n\r':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read_more(self.chunk_size):
+                raise ValueError(f"unexpected end of json file {self.file}")
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"expected '{char}' at char {self._pos} of the buffer in {self.file}")
+        self._pos += 1
+
+    def _next_separator(self, closing: str):
+        # consume ',' or the closing bracket, return True for the closing bracket
+        char = self._peek()
+        self._pos += 1
+        if char == closing:
+            return True
+        if char != ',':
+            raise ValueError(f"expected ',' or '{closing}' in {self.file}, got '{char}'")
+        return False
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # the value continues in the next chunk, read at least as much as is buffered so a large value
+            # is decoded in a logarithmic number of retries
+            self._read_more(max(self.chunk_size, len(self._buf) - self._pos))
@@ -0,0 +1,152 @@
+import json
+import os
+
+import numpy as np
+
+from Data_Helper.cocojsonstream import CocoJsonStream
+
+
+class CocoSharder:
+    # Splits a coco json file into disjoint image shards or subsets, the annotations follow their image.
+    # Two sequential passes of CocoJsonStream, each linear in images + annotations: the first one reads the image
+    # ids (and the categories of their annotations to stratify), the second one writes every image and annotation
+    # straight to the file of its shard. Only the ids are held in memory, never the whole json.
+    #
+    # The images are put in one order, then dealt: image i of the order goes to shard i % n_shards, so the shards
+    # differ by at most one image. A stratified subset takes the images where floor((i + 1) * fraction) steps.
+    # order 'balanced': file order, 'random': shuffled with seed.
+    # stratify: the order is grouped by the rarest category of each image, so every shard or subset gets its share
+    # of every category (images without annotations are one more group).
+    @classmethod
+    def split(cls, json_file: str, n_shards: int, out_pattern: str = None, order: str = 'random',
+              stratify: bool = False, seed: int = 0):
+        '''
+        :param out_pattern: file name with a {} for the shard index, default {json_file stem}.shard{}of{n}.json
+        :return: list of the n_shards written files
+        '''
+        if out_pattern is None:
+            out_pattern = f"{os.path.splitext(json_file)[0]}.shard{{}}of{n_shards}.json"
+        image_ids = cls._dealing_order(json_file, order, stratify, seed)
+        image_id2file = {image_id: i % n_shards for i, image_id in enumerate(image_ids)}
+        out_files = [out_pattern.format(i) for i in range(n_shards)]
+        cls._write(json_file, image_id2file, out_files)
+        return out_files
+
+    @classmethod
+    def subset(cls, json_file: str, out_file: str, fraction: float = None, n_images: int = None,
+               order: str = 'random', stratify: bool = False, seed: int = 0):
+        '''
+        write one subset of the images, of fraction of the images or of n_images images.
+        Without stratify the subset is the first images of the order, the first ones of the file for 'balanced'
+        :return: out_file
+        '''
+        image_ids = cls._dealing_order(json_file, order, stratify, seed)
+        if n_images is None:
+            n_images = int(round(fraction * len(image_ids)))
+        n_images = min(n_images, len(image_ids))
+        if stratify:
+            # error diffusion, the n_images images are spread evenly over the groups of the order
+            fraction = n_images / max(len(image_ids), 1)
+            positions = np.arange(len(image_ids))
+            selected = np.floor((positions + 1) * fraction + 1e-9) > np.floor(positions * fraction + 1e-9)
+            image_ids = [image_ids[i] for i in np.flatnonzero(selected).tolist()]
+        image_id2file = {image_id: 0 for image_id in image_ids[:n_images]}
+        cls._write(json_file, image_id2file, [out_file])
+        return out_file
+
+    # --- pass 1 ---
+    @classmethod
+    def _dealing_order(cls, json_file: str, order: str, stratify: bool, seed: int):
+        if order not in ('balanced', 'random'):
+            raise ValueError(f"unknown order {order}, use 'balanced' or 'random'")
+        image_ids = []
+        image_id2categories = {}
+        for key, value in CocoJsonStream(json_file, stream_keys=('images', 'annotations')):
+            if key == 'images':
+                image_ids.append(value['id'])
+            elif key == 'annotations' and stratify:
+                image_id2categories.setdefault(value['image_id'], set()).add(value['category_id'])
+        # unique ids in file order, same with CocoTools.image_ids
+        image_ids = list(dict.fromkeys(image_ids))
+        rng = np.random.default_rng(seed)
+        if order == 'random':
+            image_ids = [image_ids[i] for i in rng.permutation(len(image_ids)).tolist()]
+        if not stratify:
+            return image_ids
+        category_counts = {}
+        for categories in image_id2categories.values():
+            for category in categories:
+                category_counts[category] = category_counts.get(category, 0) + 1
+        # groups ordered by category frequency, the rarest ones first, the images without annotations last
+        groups = {}
+        for image_id in image_ids:
+            categories = image_id2categories.get(image_id)
+            group = min(categories, key=lambda c: (category_counts[c], str(c))) if categories else None
+            groups.setdefault(group, []).append(image_id)
+        sorted_groups = sorted(groups, key=lambda g: (g is None, category_counts.get(g, 0), str(g)))
+        return [image_id for group in sorted_groups for image_id in groups[group]]
+
+    # --- pass 2 ---
+    @classmethod
+    def _write(cls, json_file: str, image_id2file: dict, out_files: list):
+        # each output file is a json object written key by key, in the key order of the input file.
+        # Written to temporary files and renamed at the end, so an interrupted split leaves no partial shard
+        tmp_files = [f"{out_file}.tmp" for out_file in out_files]
+        outs = [open(tmp_file, 'w') for tmp_file in tmp_files]
+        try:
+            current_key = None
+            n_written = [0] * len(outs)
+            written_keys = set()
+            for key, value in CocoJsonStream(json_file, stream_keys=('images', 'annotations')):
+                if key in ('images', 'annotations'):
+                    if key != current_key:
+                        cls._close_array(outs, current_key)
+                        for out in outs:
+                            out.write(f'{", " if written_keys else "{"}{json.dumps(key)}: [')
+                        written_keys.add(key)
+                        current_key = key
+                        n_written = [0] * len(outs)
+                    image_id = value['id'] if key == 'images' else value['image_id']
+                    i = image_id2file.get(image_id)
+                    if i is None:
+                        continue
+                    outs[i].write(f'{", " if n_written[i] else ""}{json.dumps(value)}')
+                    n_written[i] += 1
+                else:
+                    cls._close_array(outs, current_key)
+                    current_key = None
+                    for out in outs:
+                        out.write(f'{", " if written_keys else "{"}{json.dumps(key)}: {json.dumps(value)}')
+                    written_keys.add(key)
+            cls._close_array(outs, current_key)
+            # empty arrays are not yielded by the stream
+            for key in ('images', 'annotations'):
+                if key not in written_keys:
+                    for out in outs:
+                        out.write(f'{", " if written_keys else "{"}{json.dumps(key)}: []')
+                    written_keys.add(key)
+            for out in outs:
+                out.write('}')
+        finally:
+            for out in outs:
+                out.close()
+        for tmp_file, out_file in zip(tmp_files, out_files):
+            os.replace(tmp_file, out_file)
+
+    @classmethod
+    def _close_array(cls, outs, current_key):
+        if current_key is not None:
+            for out in outs:
+                out.write(']')
+
+
+if __name__ == '__main__':
+    import time
+
+    file = '/media/liushuzhi/HDD500/Dataset/COCO2017/annotations/instances_train2017.json'
+    t = time.time()
+    shard_files = CocoSharder.split(file, n_shards=4, order='random', stratify=True)
+    print(f"4 stratified shards in {time.time() - t:.1f} s: {shard_files}")
+    t = time.time()
+    CocoSharder.subset(file, file.replace('.json', '_10percent.json'), fraction=0.1, stratify=True)
+    print(f"10% subset in {time.time() - t:.1f} s")
@@ -1,49 +1,145 @@
 import json
 import os
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
-from pycococreatortools import pycococreatortools
+
+from Data_Helper.annotationcache import AnnotationCache
+from Data_Helper.bytelrucache import ByteLruCache
+from Data_Helper.cocosharder import CocoSharder
+from Data_Helper.flipaugmentation import FLIPS, augment_one_image
+from Data_Helper.imageshards import ImageShards
+from Data_Helper.maskstore import MaskStore
+from Data_Helper.visualrenderer import VisualRenderer
 
 
 class CocoTools:
-    def __init__(self, json_file: str, image_folder_path: str, resized_shape: tuple):
+    def __init__(self, json_file: str, image_folder_path: str, resized_shape: tuple, use_cache: bool = True,
+                 streaming: bool = False, image_cache_bytes: int = 512 * 2 ** 20, image_shard_dir: str = None):
+        '''
+        :param resized_shape: (height, width, channels) the images and annotations are resized to, None for no resize
+        :param use_cache: read the annotations from the columnar AnnotationCache next to the json file,
+                          the cache is built on the first run and rebuilt when the json file changes.
+                          The json file is then only parsed when the full dicts are used (augmentation, sampling)
+        :param streaming: build the cache with the incremental parser, the json file is never held in memory as a
+                          whole, for annotation files larger than the memory. Needs use_cache
+        :param image_cache_bytes: byte budget of the decoded image LRU of get_original_image, 0 disables it
+        :param image_shard_dir: folder of ImageShards packed with the same resized_shape, the images are then
+                                read as zero copy slices of the shards instead of being decoded
+        '''
         self.segment_info = None
-        self.load_anno_coco(json_file, image_folder_path)
-        self.RESIZE_FLAG = False
+        self.imagefolder_path = image_folder_path
+        self.file = json_file
+        self._dataset = None
+        # set before loading, the cache stores the resized boxes
         self.resized_shape = resized_shape
-        if not all(resized_shape):
-            self.RESIZE_FLAG = True
+        self.RESIZE_FLAG = resized_shape is not None and all(resized_shape)
+        cache_shape = resized_shape if self.RESIZE_FLAG else None
+        self.cache = AnnotationCache.load(json_file, cache_shape) if use_cache else None
+        if self.cache is None and use_cache and streaming:
+            self.cache = AnnotationCache.compile_streaming(json_file, cache_shape)
+        if self.cache is not None:
+            self.image_ids = list(self.cache.image_ids)
+            self._build_category_mapping(self.cache.categories)
+        else:
+            self.load_anno_coco(json_file, image_folder_path)
+            if use_cache:
+                try:
+                    self.cache = AnnotationCache.compile(self._dataset, json_file, cache_shape)
+                except OSError as e:
+                    print(f"annotation cache not written: {e}")
+        # instance masks as rle, decoded masks cached in an LRU
+        self.mask_store = MaskStore(self)
+        # decoded, resized rgb images, keyed by (image_id, target shape)
+        self.image_cache = ByteLruCache(image_cache_bytes)
+        self.image_shards = ImageShards(image_shard_dir) if image_shard_dir else None
+        # headless drawing, the debug jpegs are written by a background thread pool
+        self.renderer = VisualRenderer()
+        if self.image_shards is not None and (
+                not self.RESIZE_FLAG or self.image_shards.image_shape[:2] != tuple(resized_shape[:2])):
+            raise ValueError(f"image shards of shape {self.image_shards.image_shape} don't match {resized_shape}")
 
     def load_anno_coco(self, file: str, image_folder_path: str):
         self.imagefolder_path = image_folder_path
         self.file = file
         with open(file, 'r') as f:
-            dict1 = json.load(f)
-        self.info = dict1["info"]
-        self.licenses = dict1["licenses"]
-        self.images = dict1["images"]
-        self.annotations = dict1["annotations"]
-        self.categories = dict1["categories"]
+            self._dataset = json.load(f)
         # self.segment_info = dict1["segment_info"]
-        self.image_ids = []
-        for image in self.images:
-            if image['id'] not in self.image_ids:
-                self.image_ids.append(image['id'])
+        # unique image ids in file order
+        self.image_ids = list(dict.fromkeys(image['id'] for image in self.images))
+        self._build_index()
+        self._build_category_mapping(self.categories)
+
+    # --- the json dicts, parsed on first use when the annotations are read from the cache ---
+    def _require_json(self):
+        if self._dataset is None:
+            self.load_anno_coco(self.file, self.imagefolder_path)
+        return self._dataset
+
+    @property
+    def info(self):
+        return self._require_json()["info"]
+
+    @property
+    def licenses(self):
+        return self._require_json()["licenses"]
+
+    @property
+    def images(self):
+        return self._require_json()["images"]
+
+    @property
+    def annotations(self):
+        return self._require_json()["annotations"]
+
+    @property
+    def categories(self):
+        return self._require_json()["categories"]
+
+    def _build_category_mapping(self, categories):
         count = 0
         self.category2sparse_onehot = {}
         self.sparse_onehot2category = []
-        for category in self.categories:
+        for category in categories:
             if category['id'] not in self.category2sparse_onehot:
                 self.category2sparse_onehot[category['id']] = count
                 self.sparse_onehot2category.append(category['id'])
                 count += 1
 
-    def _resize_anno(self):
-        for image_id in self.image_ids:
-            original_shape = self.get_image_shape(image_id)
+    def _build_index(self):
+        # image id -> image dict and image id -> annotations of the image, built once,
+        # so the per image accessors only touch the objects of one image instead of scanning the whole json
+        self.image_id2image = {}
+        for image in self.images:
+            self.image_id2image.setdefault(image['id'], image)
+        self.image_id2annotations = {image_id: [] for image_id in self.image_ids}
+        self.max_annotation_id = 0
+        for anno in self.annotations:
+            self._index_annotation(anno)
+
+    def _index_image(self, image):
+        self.images.append(image)
+        if image['id'] not in self.image_id2image:
+            self.image_id2image[image['id']] = image
+            self.image_id2annotations.setdefault(image['id'], [])
+
+    def _index_annotation(self, anno):
+        self.image_id2annotations.setdefault(anno['image_id'], []).append(anno)
+        self.max_annotation_id = max(self.max_annotation_id, int(anno['id']))
+
+    def get_annotations(self, image_id):
+        self._require_json()
+        return self.image_id2annotations.get(image_id, [])
+
+    def _resize_points(self, points, image_id):
+        # points: (n, 2) opencv format (y, x), scaled from the original image shape to resized_shape
+        if not self.RESIZE_FLAG:
+            return points
+        original_shape = self.get_image_shape(image_id)
+        # Note that opencv format is (y, x) here, different from numpy (x, y)
+        return points / np.asarray([original_shape[1], original_shape[0]]) * np.asarray(
+            [self.resized_shape[1], self.resized_shape[0]])
 
     def draw_segm_from_anno_coco(self,
                                  image_id,
@@ -51,34 +147,15 @@ class CocoTools:
                                  annos: list,
                                  show: bool = False,
                                  save_file: bool = False):
-        height, width = self.get_image_shape(image_id)
-        if self.RESIZE_FLAG:
-            height, width, _ = self.resized_shape
-        bboxes_int = self.get_original_bboxes_list(image_id)  # format (x1,y1,x2,y2)
-        tempimg = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+        # the jpeg is rendered and written in the background, self.renderer.wait() blocks until it is written
+        bboxes = self.get_original_bboxes_list(image_id)  # format (x1,y1,x2,y2)
         masks_pred, class_ids = self.get_segm_mask_from_anno_coco(annos, image_id)
-        _, _, n_masks = masks_pred.shape
-        for i in range(n_masks):
-            color_random = np.random.randint(0, 256, (1, 3), dtype=np.uint8)
-            color_random2 = color_random.tolist()
-            # opencv need format (y1, x1, y2, x2)
-            cv2.rectangle(tempimg,
-                          (bboxes_int[i][1], bboxes_int[i][0]),
-                          (bboxes_int[i][3], bboxes_int[i][2]),
-                          color_random2[0],
-                          2)
-            cv2.putText(tempimg, f'{i + 1}th Object_{class_ids[i]}',
-                        (bboxes_int[i][3] + 10, bboxes_int[i][2]),
-                        0, 0.3, color_random2[0])
-            tempimg[:, :, 0][masks_pred[:, :, i]] = color_random[0, 0]
-            tempimg[:, :, 1][masks_pred[:, :, i]] = color_random[0, 1]
-            tempimg[:, :, 2][masks_pred[:, :, i]] = color_random[0, 2]
-        original_image = (original_image * 0.5 + tempimg * 0.5).astype(np.uint8)
-        plt.imshow(original_image)
-        if show:
-            plt.show()
+        labels = [f'{i + 1}th Object_{class_id}' for i, class_id in enumerate(class_ids)]
         if save_file:
-            plt.savefig(f'{os.getcwd()}/Images_Drawn/{image_id}.jpg', dpi=300)
+            self.renderer.submit(f'{os.getcwd()}/Images_Drawn/{image_id}.jpg', original_image, bboxes, masks_pred,
+                                 labels)
+        if show:
+            VisualRenderer.show(self.renderer.render(original_image, bboxes, masks_pred, labels), f'{image_id}')
 
     def draw_bboxes(self,
                     original_image,
@@ -87,26 +164,18 @@ class CocoTools:
                     save_file: bool = False,
                     path: str = "",
                     save_name: str = ""):
-        # bbox is numpy format (x1, y1, x2, y2)
-        height, width = original_image.shape[0], original_image.shape[1]
-        tempimg = np.zeros(shape=(height, width, 3), dtype=np.uint8)
-        for bbox in bboxes:
-            color_random = np.random.randint(0, 256, (1, 3), dtype=np.uint8)
-            color_random2 = color_random.tolist()
-            cv2.rectangle(tempimg,
-                          (bbox[1], bbox[0]),
-                          (bbox[3], bbox[2]),
-                          color_random2[0],
-                          2)
-        original_image = (original_image * 0.5 + tempimg * 0.5).astype(np.uint8)
-        plt.imshow(original_image)
-        if show:
-            plt.show()
+        # bbox is numpy format (x1, y1, x2, y2), may be float.
+        # the jpeg is rendered and written in the background, self.renderer.wait() blocks until it is written
         if save_file:
-            img_opencv = cv2.cvtColor(original_image, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(filename=f"{path}/{save_name}.jpg", img=img_opencv)
+            self.renderer.submit(f"{path}/{save_name}.jpg", original_image, bboxes)
+        if show:
+            VisualRenderer.show(self.renderer.render(original_image, bboxes), save_name)
 
     def get_segm_mask_from_anno_coco(self, annos, image_id):
+        # annos None or all the annotations: the masks of all the annotations of image_id (polygon and rle),
+        # from the MaskStore, read only and in the order of get_original_bboxes_list
+        if annos is None or (self._dataset is not None and annos is self._dataset["annotations"]):
+            return self.mask_store.get_masks(image_id), self.get_original_category_list(image_id)
         segms = []
         height, width = self.get_image_shape(image_id)
         if self.RESIZE_FLAG:
@@ -115,12 +184,7 @@ class CocoTools:
         for anno in annos:
             if anno['image_id'] == image_id and isinstance(anno['segmentation'], list):
                 segm_temp = np.reshape(anno['segmentation'][0], newshape=(-1, 2))
-                if self.RESIZE_FLAG:
-                    original_shape = self.get_image_shape(image_id)
-                    # Note that opencv format is (y, x) here, different from numpy (x, y)
-                    segm_temp = segm_temp / np.asarray([original_shape[1], original_shape[0]]) * np.asarray(
-                        [self.resized_shape[1], self.resized_shape[0]])
-                segms.append(segm_temp.astype(int))
+                segms.append(self._resize_points(segm_temp, image_id).astype(int))
                 class_ids.append(anno['category_id'])
         n_segms = len(segms)
         mask_temp = np.zeros(shape=(height, width, n_segms), dtype=np.uint8)
@@ -129,15 +193,25 @@ class CocoTools:
             contour = segms[i]
             cv2.fillPoly(img=temp_one_mask, pts=[contour], color=1)
             mask_temp[:, :, i] = temp_one_mask
-        return mask_temp.astype(np.bool), class_ids
+        return mask_temp.astype(bool), class_ids
 
     def get_original_image(self, image_id):
+        # read only, a slice of the image shards or cached. Copy it before drawing on it
+        if self.image_shards is not None:
+            img_rgb = self.image_shards.get_image(image_id)
+            if img_rgb is not None:
+                return img_rgb
+        key = (image_id, tuple(self.resized_shape[:2]) if self.RESIZE_FLAG else None)
+        img_rgb = self.image_cache.get(key)
+        if img_rgb is not None:
+            return img_rgb
         image_name = self.get_image_name(image_id)
         img = cv2.imread(f"{self.imagefolder_path}/{image_name}")
         if self.RESIZE_FLAG:
             img = cv2.resize(img, (self.resized_shape[1], self.resized_shape[0]), interpolation=cv2.INTER_AREA)
         img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        return np.array(img_rgb)
+        img_rgb.flags.writeable = False
+        return self.image_cache.put(key, img_rgb, img_rgb.nbytes)
 
     def get_original_bboxes_list(self, image_id):
         # read original opencv bbox and convert to numpy format bbox
@@ -146,183 +220,169 @@ class CocoTools:
         opencv box format: (y, x, dy, dx)
         output box format: (x1, y1, x2, y2)
         '''
+        if self.cache is not None:
+            # int32 rows of the mmap cache, already resized
+            return list(np.asarray(self.cache.boxes[self.cache.anno_slice(image_id)]))
         bboxes = []
-        for anno in self.annotations:
-            if anno['image_id'] == image_id:
-                bbox = np.array(anno['bbox'], dtype=np.int)
-                bbox[0], bbox[1], bbox[2], bbox[3] = bbox[1], bbox[0], bbox[1] + bbox[3], bbox[0] + bbox[2]
-                if self.RESIZE_FLAG:
-                    original_shape = self.get_image_shape(image_id)
-                    bbox[0] = bbox[0] / original_shape[0] * self.resized_shape[0]
-                    bbox[1] = bbox[1] / original_shape[1] * self.resized_shape[1]
-                    bbox[2] = bbox[2] / original_shape[0] * self.resized_shape[0]
-                    bbox[3] = bbox[3] / original_shape[1] * self.resized_shape[1]
-                bboxes.append(bbox)
+        for anno in self.get_annotations(image_id):
+            bbox = np.array(anno['bbox'], dtype=np.int32)
+            bbox[0], bbox[1], bbox[2], bbox[3] = bbox[1], bbox[0], bbox[1] + bbox[3], bbox[0] + bbox[2]
+            if self.RESIZE_FLAG:
+                original_shape = self.get_image_shape(image_id)
+                bbox[0] = bbox[0] / original_shape[0] * self.resized_shape[0]
+                bbox[1] = bbox[1] / original_shape[1] * self.resized_shape[1]
+                bbox[2] = bbox[2] / original_shape[0] * self.resized_shape[0]
+                bbox[3] = bbox[3] / original_shape[1] * self.resized_shape[1]
+            bboxes.append(bbox)
         return bboxes
 
+    def get_original_category_list(self, image_id):
+        if self.cache is not None:
+            return self.cache.category_ids[self.cache.anno_slice(image_id)].tolist()
+        return [anno['category_id'] for anno in self.get_annotations(image_id)]
+
     def get_original_category_sparse_list(self, image_id):
-        categories_sparse = []
-        for anno in self.annotations:
-            if anno['image_id'] == image_id:
-                sparse = self.category2sparse_onehot[anno['category_id']]
-                categories_sparse.append(sparse)
-        return categories_sparse
+        if self.cache is not None:
+            return self.cache.categories_sparse[self.cache.anno_slice(image_id)].tolist()
+        return [self.category2sparse_onehot[anno['category_id']] for anno in self.get_annotations(image_id)]
 
     def get_category_from_sparse(self, num: int):
         return self.sparse_onehot2category[num]
 
     def get_original_segms_mask_list(self, image_id):
         # TODO: put mask list to dictionary of labels
-        height, width = self.get_image_shape(image_id)
-        masks = []
-        for anno in self.annotations:
-            if anno['image_id'] == image_id:
-                img_temp = np.zeros(shape=(height, width), dtype=np.uint8)
-                contour = np.reshape(anno['segmentation'], newshape=(-1, 2)).astype(int)
-                img_temp = cv2.fillPoly(img_temp, [contour], 1)
-                masks.append(img_temp)
-        return masks
+        masks = self.mask_store.get_masks(image_id)
+        return [masks[:, :, i].astype(np.uint8) for i in range(masks.shape[2])]
+
+    def get_mask_crops(self, image_id, boxes=None, anno_indices=None, crop_shape=(28, 28)):
+        # masks cropped to boxes and resized to crop_shape, see MaskStore.get_mask_crops
+        return self.mask_store.get_mask_crops(image_id, boxes, anno_indices, crop_shape)
 
     def get_image_name(self, image_id):
-        for image in self.images:
-            if image['id'] == image_id:
-                return image['file_name']
+        if self.cache is not None and image_id in self.cache.image_id2row:
+            return self.cache.get_image_name(image_id)
+        self._require_json()
+        image = self.image_id2image.get(image_id)
+        if image is not None:
+            return image['file_name']
 
     def get_image_shape(self, image_id):
-        for image in self.images:
-            if image['id'] == image_id:
-                return (image['height'], image['width'])
+        if self.cache is not None and image_id in self.cache.image_id2row:
+            return self.cache.get_image_shape(image_id)
+        self._require_json()
+        image = self.image_id2image.get(image_id)
+        if image is not None:
+            return (image['height'], image['width'])
 
     def draw_with_image_id(self, image_id):
         original_image = self.get_original_image(image_id)
-        self.draw_segm_from_anno_coco(image_id, original_image, self.annotations, True)
+        self.draw_segm_from_anno_coco(image_id, original_image, None, True)
 
     def agumentation_one_image(self, image_id):
-        annotation_ids = []
-        for anno in self.annotations:
-            annotation_ids.append(int(anno['id']))
-
-        max_annotation_id = max(annotation_ids)
-        counter = 1
-        masks, class_ids = self.get_segm_mask_from_anno_coco(self.annotations, image_id)
-        masks = masks.astype(np.uint8)
-        img = self.get_original_image(image_id)
-        _, _, n_masks = masks.shape
-        image_dict = {}
-        for img_dic in self.images:
-            if img_dic['id'] == image_id:
-                image_dict = deepcopy(img_dic)
-                break
-        # === flip vertically ===
-        img_flipped_vertical = np.flip(img, axis=0)
-        open_cv_image = cv2.cvtColor(img_flipped_vertical, cv2.COLOR_RGB2BGR)
-        image_id_new = f"{image_id}Vertical"
-        cv2.imwrite(filename=f"{self.imagefolder_path}/{image_id_new}.png", img=open_cv_image)
-        image_dict['id'] = f"{image_id_new}"
-        image_dict['file_name'] = f"{image_id_new}.png"
-        print(f"image_dic: {image_dict}")
-        self.images.append(deepcopy(image_dict))
-        for index in range(n_masks):
-            mask = masks[:, :, index]
-            mask = np.flip(mask, axis=0)
-            category_info = {"id": class_ids[index], "is_crowd": False}
-            anno = pycococreatortools.create_annotation_info(annotation_id=max_annotation_id + counter,
-                                                             image_id=f"{image_id_new}",
-                                                             category_info=category_info,
-                                                             binary_mask=mask.astype(np.uint8),
-                                                             image_size=None,
-                                                             tolerance=2,
-                                                             bounding_box=None)
-            counter += 1
-            print(anno)
-            self.annotations.append(anno)
-        # === flip horizontally ===
-        image_id_new = f"{image_id}Horizontal"
-        image_dict['id'] = f"{image_id_new}"
-        image_dict['file_name'] = f"{image_id_new}.png"
-        print(f"image_dic: {image_dict}")
-        self.images.append(deepcopy(image_dict))
-        img_flipped_horizontal = np.flip(img, axis=1)
-        open_cv_image = cv2.cvtColor(img_flipped_horizontal, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(filename=f"{self.imagefolder_path}/{image_id_new}.png", img=open_cv_image)
-        for index in range(n_masks):
-            mask = masks[:, :, index]
-            mask = np.flip(mask, axis=1)
-            category_info = {"id": class_ids[index], "is_crowd": False}
-            anno = pycococreatortools.create_annotation_info(annotation_id=max_annotation_id + counter,
-                                                             image_id=f"{image_id_new}",
-                                                             category_info=category_info,
-                                                             binary_mask=mask.astype(np.uint8),
-                                                             image_size=None,
-                                                             tolerance=2,
-                                                             bounding_box=None)
-            counter += 1
-            print(anno)
-            self.annotations.append(anno)
-        # === flip both directions ===
-        image_id_new = f"{image_id}Both"
-        image_dict['id'] = f"{image_id_new}"
-        image_dict['file_name'] = f"{image_id_new}.png"
-        print(f"image_dic: {image_dict}")
-        self.images.append(deepcopy(image_dict))
-        img_flipped_both = np.flip(img, axis=(0, 1))
-        open_cv_image = cv2.cvtColor(img_flipped_both, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(filename=f"{self.imagefolder_path}/{image_id_new}.png", img=open_cv_image)
-        for index in range(n_masks):
-            mask = masks[:, :, index]
-            mask = np.flip(mask, axis=(0, 1))
-            category_info = {"id": class_ids[index], "is_crowd": False}
-            anno = pycococreatortools.create_annotation_info(annotation_id=max_annotation_id + counter,
-                                                             image_id=f"{image_id_new}",
-                                                             category_info=category_info,
-                                                             binary_mask=mask.astype(np.uint8),
-                                                             image_size=None,
-                                                             tolerance=2,
-                                                             bounding_box=None)
-            counter += 1
-            print(anno)
+        # flipped copies of one image, written next to it and added to the annotations in memory
+        self._require_json()
+        images, annotations = augment_one_image(self.image_id2image[image_id], self.get_annotations(image_id),
+                                                self.imagefolder_path, self.max_annotation_id + 1)
+        for image in images:
+            self._index_image(image)
+        for anno in annotations:
             self.annotations.append(anno)
+            self._index_annotation(anno)
 
-    def augmentation(self):
+    def augmentation(self, n_processes: int = None):
+        '''
+        add the flipped copies (Vertical, Horizontal, Both) of all the images to the json file.
+        The images are flipped and written by a process pool, the result of each image is appended to a journal
+        next to the json file, so an interrupted augmentation resumes with the images which are not done yet.
+        The json file is written at the end as a stream, the journal is read back without loading it whole.
+        :param n_processes: None means os.cpu_count()
+        '''
         if 'augmented' in self.info:
             print('already augmented')
-            pass
-        else:
-            print('start augmenting')
-            for image_id in self.image_ids:
-                self.agumentation_one_image(image_id)
-            self.info['augmented'] = 'yes'
-            with open(self.file, 'w') as f:
-                json.dump({
-                    "info": self.info,
-                    "licenses": self.licenses,
-                    "images": self.images,
-                    "annotations": self.annotations,
-                    "categories": self.categories,
-                    "segment_info": self.segment_info
-                },
-                    f,
-                    indent=4)
+            return
+        print('start augmenting')
+        journal_path = f"{self.file}.augment.jsonl"
+        done = self._read_augment_journal(journal_path)
+        # the annotation ids of each image follow the image order, the same on every resumed run
+        first_annotation_ids = {}
+        next_annotation_id = self.max_annotation_id + 1
+        for image_id in self.image_ids:
+            first_annotation_ids[image_id] = next_annotation_id
+            next_annotation_id += len(FLIPS) * len(self.get_annotations(image_id))
+        todo = [image_id for image_id in self.image_ids if image_id not in done]
+        print(f"{len(done)} images already augmented, {len(todo)} to do")
+        if todo:
+            with open(journal_path, 'a') as journal, ProcessPoolExecutor(max_workers=n_processes) as pool:
+                results = pool.map(augment_one_image,
+                                   [self.image_id2image[image_id] for image_id in todo],
+                                   [self.get_annotations(image_id) for image_id in todo],
+                                   [self.imagefolder_path] * len(todo),
+                                   [first_annotation_ids[image_id] for image_id in todo],
+                                   chunksize=8)
+                for image_id, (images, annotations) in zip(todo, results):
+                    journal.write(json.dumps({'image_id': image_id, 'images': images, 'annotations': annotations}))
+                    journal.write('\n')
+                    journal.flush()
+        self.info['augmented'] = 'yes'
+        self._write_augmented_json(journal_path)
+        os.remove(journal_path)
 
-    def make_train_sample(self, n, file):
-        images = []
-        annotations = []
-        images += self.images[:n]
-        for image in images:
-            image_id = image['id']
+    @classmethod
+    def _iter_augment_journal(cls, journal_path):
+        with open(journal_path, 'r') as f:
+            for line in f:
+                yield json.loads(line)
+
+    @classmethod
+    def _read_augment_journal(cls, journal_path):
+        # image ids in the journal, a last line cut by an interruption is removed
+        done = set()
+        if not os.path.exists(journal_path):
+            return done
+        valid_bytes = 0
+        with open(journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['image_id'])
+                except ValueError:
+                    break
+                valid_bytes += len(line)
+        with open(journal_path, 'r+b') as f:
+            f.truncate(valid_bytes)
+        return done
+
+    def _write_augmented_json(self, journal_path):
+        # the original json, with the images and annotations of the journal appended, added to the indexes too
+        tmp_file = f"{self.file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(f'{{"info": {json.dumps(self.info)}, "licenses": {json.dumps(self.licenses)}, "images": [')
+            separator = ''
+            for image in self.images:
+                f.write(separator + json.dumps(image))
+                separator = ', '
+            for entry in self._iter_augment_journal(journal_path):
+                for image in entry['images']:
+                    f.write(separator + json.dumps(image))
+                    separator = ', '
+                    self._index_image(image)
+            f.write('], "annotations": [')
+            separator = ''
             for anno in self.annotations:
-                if anno['image_id'] == image_id:
-                    annotations.append(anno)
-        anno_json = {
-            "info": self.info,
-            "licenses": self.licenses,
-            "images": images,
-            "annotations": annotations,
-            "categories": self.categories,
-            # "segment_info": self.segment_info
-        }
-        with open(file, 'w') as f:
-            json.dump(anno_json, f)
+                f.write(separator + json.dumps(anno))
+                separator = ', '
+            for entry in self._iter_augment_journal(journal_path):
+                for anno in entry['annotations']:
+                    f.write(separator + json.dumps(anno))
+                    separator = ', '
+                    self.annotations.append(anno)
+                    self._index_annotation(anno)
+            f.write(f'], "categories": {json.dumps(self.categories)}, '
+                    f'"segment_info": {json.dumps(self.segment_info)}}}')
+        os.replace(tmp_file, self.file)
+
+    def make_train_sample(self, n, file):
+        # the first n images of the json file with their annotations, streamed by CocoSharder
+        CocoSharder.subset(self.file, file, n_images=n, order='balanced')
 
 
 if __name__ == '__main__':
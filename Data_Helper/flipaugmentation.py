@@ -0,0 +1,87 @@
+import os
+from copy import deepcopy
+
+import cv2
+import numpy as np
+from pycocotools import mask as mask_utils
+
+# suffix of the augmented image id -> flipped numpy axes of the image, 0: rows (upside down), 1: columns (mirror)
+FLIPS = (('Vertical', (0,)), ('Horizontal', (1,)), ('Both', (0, 1)))
+
+
+# The flips are geometric: coco coordinates are continuous, pixel column c covers [c, c + 1),
+# so flipping the columns maps x to width - x, same for the rows with y and height.
+# Only rle segmentations are decoded, flipped and encoded again, polygons and boxes are never rasterized.
+def flip_polygon(polygon, height, width, axes):
+    # polygon: coco [x0, y0, x1, y1, ...], x: column, y: row
+    points = np.array(polygon, dtype=np.float64).reshape((-1, 2))
+    if 1 in axes:
+        points[:, 0] = width - points[:, 0]
+    if 0 in axes:
+        points[:, 1] = height - points[:, 1]
+    return points.ravel().tolist()
+
+
+def flip_bbox(bbox, height, width, axes):
+    # bbox: coco [x, y, w, h]
+    x, y, w, h = bbox
+    if 1 in axes:
+        x = width - x - w
+    if 0 in axes:
+        y = height - y - h
+    return [x, y, w, h]
+
+
+def flip_rle(segm, height, width, axes):
+    # segm: coco rle, compressed or uncompressed. Output compressed, counts as str so it can be dumped to json
+    if isinstance(segm['counts'], list):
+        rle = mask_utils.frPyObjects(segm, *segm['size'])
+    else:
+        counts = segm['counts'].encode('ascii') if isinstance(segm['counts'], str) else segm['counts']
+        rle = {'size': segm['size'], 'counts': counts}
+    flipped = mask_utils.encode(np.asfortranarray(np.flip(mask_utils.decode(rle), axis=axes)))
+    return {'size': [height, width], 'counts': flipped['counts'].decode('ascii')}
+
+
+def flip_annotation(anno, height, width, axes, annotation_id, image_id):
+    anno_flipped = deepcopy(anno)
+    anno_flipped['id'] = annotation_id
+    anno_flipped['image_id'] = image_id
+    anno_flipped['bbox'] = flip_bbox(anno['bbox'], height, width, axes)
+    if isinstance(anno['segmentation'], list):
+        anno_flipped['segmentation'] = [flip_polygon(polygon, height, width, axes) for polygon in anno['segmentation']]
+    else:
+        anno_flipped['segmentation'] = flip_rle(anno['segmentation'], height, width, axes)
+    return anno_flipped
+
+
+def augment_one_image(image: dict, annotations: list, image_folder_path: str, first_annotation_id: int):
+    '''
+    write the flipped copies of one image next to it as png and flip its annotations, run in a worker process.
+    The images are written to a temporary file and renamed, so an interrupted run never leaves a broken image.
+    :param image: coco image dict
+    :param annotations: coco annotation dicts of the image
+    :param first_annotation_id: the new annotations get the ids first_annotation_id, first_annotation_id + 1, ...
+    :return: list of the new image dicts, list of the new annotation dicts
+    '''
+    img = cv2.imread(f"{image_folder_path}/{image['file_name']}")
+    if img is None:
+        raise FileNotFoundError(f"{image_folder_path}/{image['file_name']}")
+    height, width = image['height'], image['width']
+    new_images = []
+    new_annotations = []
+    annotation_id = first_annotation_id
+    for suffix, axes in FLIPS:
+        image_id_new = f"{image['id']}{suffix}"
+        image_dict = deepcopy(image)
+        image_dict['id'] = image_id_new
+        image_dict['file_name'] = f"{image_id_new}.png"
+        path = f"{image_folder_path}/{image_dict['file_name']}"
+        tmp_path = f"{path}.tmp{os.getpid()}.png"
+        cv2.imwrite(filename=tmp_path, img=np.flip(img, axis=axes))
+        os.replace(tmp_path, path)
+        new_images.append(image_dict)
+        for anno in annotations:
+            new_annotations.append(flip_annotation(anno, height, width, axes, annotation_id, image_id_new))
+            annotation_id += 1
+    return new_images, new_annotations
@@ -0,0 +1,112 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+
+class ImageShards:
+    # Images of a dataset, already resized and converted to rgb uint8, packed into fixed stride shard files.
+    # shard_{k:05d}.npy holds the images images_per_shard * k ... as one (n, H, W, 3) array, the index.json holds
+    # the image ids in packing order. The shards are loaded with mmap, so an image is a zero copy, read only slice.
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        with open(f"{shard_dir}/index.json", 'r') as f:
+            index = json.load(f)
+        self.image_shape = tuple(index['image_shape'])
+        self.images_per_shard = index['images_per_shard']
+        self.image_ids = index['image_ids']
+        self.image_id2index = {image_id: i for i, image_id in enumerate(self.image_ids)}
+        self._shards = {}
+
+    def _shard(self, shard_index: int):
+        shard = self._shards.get(shard_index)
+        if shard is None:
+            shard = np.load(self.shard_path(self.shard_dir, shard_index), mmap_mode='r')
+            self._shards[shard_index] = shard
+        return shard
+
+    def get_image(self, image_id):
+        '''
+        :return: read only (H, W, 3) uint8 rgb view into the shard, None if the image is not packed
+        '''
+        index = self.image_id2index.get(image_id)
+        if index is None:
+            return None
+        return self._shard(index // self.images_per_shard)[index % self.images_per_shard]
+
+    @classmethod
+    def shard_path(cls, shard_dir: str, shard_index: int):
+        return f"{shard_dir}/shard_{shard_index:05d}.npy"
+
+    @classmethod
+    def pack(cls, coco_tools, shard_dir: str, images_per_shard: int = 256, n_processes: int = None):
+        '''
+        decode, resize and pack all the images of coco_tools, one shard per task of a process pool.
+        Shards which are already complete are skipped, so an interrupted packing resumes.
+        :param coco_tools: CocoTools with a resized_shape, the images are resized like get_original_image
+        :param n_processes: None means os.cpu_count()
+        :return: ImageShards of the packed shards
+        '''
+        if not coco_tools.RESIZE_FLAG:
+            raise ValueError("image shards need a fixed resized_shape")
+        image_shape = tuple(coco_tools.resized_shape[:2]) + (3,)
+        image_ids = list(coco_tools.image_ids)
+        index = {'image_shape': list(image_shape), 'images_per_shard': images_per_shard, 'image_ids': image_ids}
+        os.makedirs(shard_dir, exist_ok=True)
+        # the shards of an earlier packing are only reused for the same images in the same order
+        plan_path = f"{shard_dir}/pack_plan.json"
+        if os.path.exists(plan_path):
+            with open(plan_path, 'r') as f:
+                if json.load(f) != index:
+                    for name in os.listdir(shard_dir):
+                        if name.startswith('shard_') or name == 'index.json':
+                            os.remove(f"{shard_dir}/{name}")
+        with open(plan_path, 'w') as f:
+            json.dump(index, f)
+        tasks = []
+        for shard_index, start in enumerate(range(0, len(image_ids), images_per_shard)):
+            file_paths = [f"{coco_tools.imagefolder_path}/{coco_tools.get_image_name(image_id)}"
+                          for image_id in image_ids[start:start + images_per_shard]]
+            tasks.append((file_paths, image_shape, cls.shard_path(shard_dir, shard_index)))
+        with ProcessPoolExecutor(max_workers=n_processes) as pool:
+            futures = [pool.submit(_pack_shard, *task) for task in tasks]
+            for future in futures:
+                print(f"packed {future.result()}")
+        # the index is written last, a shard folder without index is not complete
+        with open(f"{shard_dir}/index.json", 'w') as f:
+            json.dump(index, f)
+        return cls(shard_dir)
+
+
+def _pack_shard(file_paths, image_shape, path):
+    # one shard, run in a worker process. Written to a temporary file and renamed when complete
+    shape = (len(file_paths),) + tuple(image_shape)
+    if os.path.exists(path):
+        try:
+            if np.load(path, mmap_mode='r').shape == shape:
+                return path
+        except ValueError:
+            pass
+    tmp_path = f"{path}.tmp{os.getpid()}.npy"
+    shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+    for i, file_path in enumerate(file_paths):
+        img = cv2.imread(file_path)
+        if img is None:
+            raise FileNotFoundError(file_path)
+        # same with CocoTools.get_original_image
+        img = cv2.resize(img, (image_shape[1], image_shape[0]), interpolation=cv2.INTER_AREA)
+        shard[i] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    shard.flush()
+    del shard
+    os.replace(tmp_path, path)
+    return path
+
+
+if __name__ == '__main__':
+    from Configs.FasterRCNN_config import Param
+    from Data_Helper import CocoTools
+
+    t1 = CocoTools(Param.DATA_JSON_FILE, Param.PATH_IMAGES, resized_shape=Param.IMG_RESIZED_SHAPE)
+    ImageShards.pack(t1, Param.PATH_IMAGE_SHARDS)
@@ -0,0 +1,157 @@
+import cv2
+import numpy as np
+from pycocotools import mask as mask_utils
+
+from Data_Helper.bytelrucache import ByteLruCache
+
+
+class MaskStore:
+    # Instance masks of the images of a CocoTools, kept as coco rle at the image shape of CocoTools
+    # (resized_shape if resizing), one rle per annotation in the order of get_original_bboxes_list.
+    # Polygon and rle (crowd) segmentations are both supported.
+    # rle lists and decoded (H, W, n) masks are cached in one LRU with a byte budget, decoded masks are read only.
+    def __init__(self, coco_tools, max_bytes: int = 256 * 2 ** 20):
+        '''
+        :param coco_tools: CocoTools, the source of the segmentations, from its AnnotationCache if any
+        :param max_bytes: byte budget of the LRU, the least recently used entries are evicted above it
+        '''
+        self.coco_tools = coco_tools
+        self.lru = ByteLruCache(max_bytes)
+
+    # --- segmentations ---
+    def _segmentations(self, image_id):
+        # list of ('polygon', [(n, 2) float polygons, opencv (y, x), original coordinates])
+        # or ('rle', compressed rle at the original image shape), one per annotation
+        coco_tools = self.coco_tools
+        height, width = coco_tools.get_image_shape(image_id)
+        segmentations = []
+        if coco_tools.cache is not None:
+            cache = coco_tools.cache
+            anno_slice = cache.anno_slice(image_id)
+            for index in range(anno_slice.start, anno_slice.stop):
+                if cache.segm_is_polygon[index]:
+                    segmentations.append(('polygon', cache.get_polygons(index)))
+                else:
+                    counts = cache.get_rle_counts(index).tolist()
+                    segmentations.append(('rle', mask_utils.frPyObjects({'counts': counts, 'size': [height, width]},
+                                                                        height, width)))
+            return segmentations
+        for anno in coco_tools.get_annotations(image_id):
+            segm = anno['segmentation']
+            if isinstance(segm, list):
+                segmentations.append(('polygon', [np.reshape(polygon[:len(polygon) // 2 * 2], (-1, 2))
+                                                  for polygon in segm]))
+            elif isinstance(segm['counts'], list):
+                segmentations.append(('rle', mask_utils.frPyObjects(segm, *segm['size'])))
+            else:
+                counts = segm['counts'].encode('ascii') if isinstance(segm['counts'], str) else segm['counts']
+                segmentations.append(('rle', {'size': segm['size'], 'counts': counts}))
+        return segmentations
+
+    def _image_shape(self, image_id):
+        if self.coco_tools.RESIZE_FLAG:
+            return tuple(self.coco_tools.resized_shape[:2])
+        return self.coco_tools.get_image_shape(image_id)
+
+    def is_crowd(self, image_id):
+        '''
+        :return: bool (n,), True for the annotations with an rle segmentation
+        '''
+        return np.array([kind == 'rle' for kind, _ in self._segmentations(image_id)], dtype=bool)
+
+    def get_rles(self, image_id):
+        '''
+        :return: list of compressed coco rle, one per annotation, at the image shape of CocoTools
+        '''
+        key = ('rle', image_id)
+        rles = self.lru.get(key)
+        if rles is not None:
+            return rles
+        height, width = self._image_shape(image_id)
+        rles = []
+        for kind, segm in self._segmentations(image_id):
+            if kind == 'polygon':
+                polygons = [self.coco_tools._resize_points(polygon, image_id).ravel().tolist()
+                            for polygon in segm if len(polygon) >= 3]
+                if polygons:
+                    rles.append(mask_utils.merge(mask_utils.frPyObjects(polygons, height, width)))
+                else:
+                    rles.append(mask_utils.encode(np.zeros(shape=(height, width), dtype=np.uint8, order='F')))
+            elif tuple(segm['size']) != (height, width):
+                mask = cv2.resize(mask_utils.decode(segm), (width, height), interpolation=cv2.INTER_NEAREST)
+                rles.append(mask_utils.encode(np.asfortranarray(mask)))
+            else:
+                rles.append(segm)
+        return self.lru.put(key, rles, sum(len(rle['counts']) for rle in rles))
+
+    def get_masks(self, image_id):
+        '''
+        :return: read only bool (H, W, n) masks of all the annotations of image_id
+        '''
+        key = ('mask', image_id)
+        masks = self.lru.get(key)
+        if masks is not None:
+            return masks
+        rles = self.get_rles(image_id)
+        if rles:
+            masks = mask_utils.decode(rles).astype(bool)
+        else:
+            height, width = self._image_shape(image_id)
+            masks = np.zeros(shape=(height, width, 0), dtype=bool)
+        masks.flags.writeable = False
+        return self.lru.put(key, masks, masks.nbytes)
+
+    def get_mask_crops(self, image_id, boxes=None, anno_indices=None, crop_shape=(28, 28)):
+        '''
+        masks cropped to boxes and resized to crop_shape, the target format of a mask head.
+        Polygons are rasterized directly in the crop, so the cost scales with crop_shape, not the image.
+        :param boxes: (k, 4) boxes (x1, y1, x2, y2) at the image shape of CocoTools, default the gt boxes
+        :param anno_indices: (k,) index of the annotation of each box, default 0..k-1
+        :return: bool (k, crop_h, crop_w)
+        '''
+        if boxes is None:
+            boxes = self.coco_tools.get_original_bboxes_list(image_id)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+        anno_indices = np.arange(boxes.shape[0]) if anno_indices is None else np.asarray(anno_indices)
+        crop_h, crop_w = crop_shape
+        crops = np.zeros(shape=(boxes.shape[0], crop_h, crop_w), dtype=np.uint8)
+        segmentations = self._segmentations(image_id)
+        for k, ((x1, y1, x2, y2), anno_index) in enumerate(zip(boxes.tolist(), anno_indices.tolist())):
+            kind, segm = segmentations[anno_index]
+            if kind == 'polygon':
+                # crop frame: (point - box origin) * crop size / box size, fixed point with 4 fraction bits
+                scale = np.array([crop_w / max(y2 - y1, 1), crop_h / max(x2 - x1, 1)])
+                for polygon in segm:
+                    if len(polygon) < 3:
+                        continue
+                    points = (self.coco_tools._resize_points(polygon, image_id) - [y1, x1]) * scale
+                    cv2.fillPoly(crops[k], [np.round(points * 16).astype(np.int32)], 1, cv2.LINE_8, shift=4)
+            else:
+                mask = self.get_masks(image_id)[:, :, anno_index]
+                r1, c1 = max(int(np.floor(x1)), 0), max(int(np.floor(y1)), 0)
+                r2, c2 = min(int(np.ceil(x2)), mask.shape[0]), min(int(np.ceil(y2)), mask.shape[1])
+                if r2 > r1 and c2 > c1:
+                    crops[k] = cv2.resize(mask[r1:r2, c1:c2].astype(np.uint8), (crop_w, crop_h),
+                                          interpolation=cv2.INTER_NEAREST)
+        return crops.astype(bool)
+
+    def stats(self):
+        return self.lru.stats()
+
+
+if __name__ == '__main__':
+    import time
+
+    from Data_Helper import CocoTools
+
+    file = '/media/liushuzhi/HDD500/Dataset/COCO2017/annotations/instances_val2017.json'
+    image_path = '/media/liushuzhi/HDD500/Dataset/COCO2017/val2017'
+    t1 = CocoTools(file, image_path, resized_shape=(800, 1333, 3))
+    t = time.time()
+    for test_image_id in t1.image_ids[:200]:
+        t1.mask_store.get_mask_crops(test_image_id)
+    print(f"mask crops of 200 images: {time.time() - t:.2f} s")
+    t = time.time()
+    for test_image_id in t1.image_ids[:200]:
+        t1.mask_store.get_masks(test_image_id)
+    print(f"full masks of 200 images: {time.time() - t:.2f} s, {t1.mask_store.stats()}")
@@ -0,0 +1,113 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+class VisualRenderer:
+    # Headless rendering of boxes, masks and labels on rgb uint8 images with opencv only, matplotlib is never
+    # imported unless show is called. The boxes of one color are drawn by one cv2.polylines call and all the masks
+    # by one color lookup, so the cost hardly grows with the number of boxes.
+    # submit renders and writes a jpeg in a background thread pool, opencv releases the GIL while drawing and
+    # encoding, so debug images don't block the training loop.
+    def __init__(self, n_threads: int = 4, n_colors: int = 32, seed: int = 0):
+        '''
+        :param n_threads: threads of the background pool of submit
+        :param n_colors: size of the random palette, box i gets the color i % n_colors
+        '''
+        self.n_threads = n_threads
+        self.palette = np.random.default_rng(seed).integers(64, 256, size=(n_colors, 3), dtype=np.uint8)
+        self._pool = None
+        self._futures = []
+
+    def render(self, image, bboxes=None, masks=None, labels=None, thickness: int = 2, alpha: float = 0.5):
+        '''
+        :param image: (H, W, 3) rgb uint8, not changed
+        :param bboxes: (n, 4) boxes (x1, y1, x2, y2), x: row, y: column
+        :param masks: (H, W, m) bool masks, mask i has the color of box i
+        :param labels: n strings written next to the boxes
+        :return: (H, W, 3) rgb uint8 image with the boxes and masks blended with alpha
+        '''
+        overlay = np.array(image, dtype=np.uint8)
+        if masks is not None and masks.shape[2] > 0:
+            masks = np.asarray(masks, dtype=bool)
+            covered = masks.any(axis=2)
+            # the last mask is on top, like drawing them one by one
+            top = masks.shape[2] - 1 - np.argmax(masks[:, :, ::-1], axis=2)
+            colors = self.palette[top[covered] % len(self.palette)]
+            overlay[covered] = (overlay[covered] * (1 - alpha) + colors * alpha).astype(np.uint8)
+        if bboxes is not None:
+            bboxes = np.asarray(bboxes, dtype=np.float64).reshape((-1, 4)).astype(np.int32)
+            # corners in opencv (column, row) order, shape (n, 4, 2)
+            corners = bboxes[:, [[1, 0], [3, 0], [3, 2], [1, 2]]]
+            color_indices = np.arange(bboxes.shape[0]) % len(self.palette)
+            for color_index in np.unique(color_indices).tolist():
+                cv2.polylines(overlay, list(corners[color_indices == color_index]), True,
+                              self.palette[color_index].tolist(), thickness)
+            if labels is not None:
+                for i, (bbox, label) in enumerate(zip(bboxes.tolist(), labels)):
+                    cv2.putText(overlay, str(label), (bbox[3] + 10, bbox[2]), cv2.FONT_HERSHEY_SIMPLEX, 0.3,
+                                self.palette[i % len(self.palette)].tolist())
+        return overlay
+
+    @classmethod
+    def write_jpeg(cls, file: str, image, quality: int = 90):
+        # image: rgb uint8
+        folder = os.path.dirname(file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        cv2.imwrite(file, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return file
+
+    def _render_and_write(self, file, image, bboxes, masks, labels):
+        return self.write_jpeg(file, self.render(image, bboxes, masks, labels))
+
+    def submit(self, file: str, image, bboxes=None, masks=None, labels=None):
+        '''
+        render and write a jpeg in the background pool, arguments the same with render
+        :return: Future of the written file name
+        '''
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        future = self._pool.submit(self._render_and_write, file, self._snapshot(image), self._snapshot(bboxes),
+                                   self._snapshot(masks), labels)
+        # finished jobs are dropped, the failed ones are kept so wait raises their error
+        self._futures = [f for f in self._futures if not f.done() or f.exception() is not None] + [future]
+        return future
+
+    @classmethod
+    def _snapshot(cls, array):
+        # a writable array may be changed by the caller before the job runs, read only ones are shared
+        if array is None or (isinstance(array, np.ndarray) and not array.flags.writeable):
+            return array
+        return np.array(array)
+
+    def wait(self):
+        # block until all the submitted images are written, raise the first error of a job
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    @classmethod
+    def show(cls, image, title: str = ''):
+        # interactive window, the only place matplotlib is imported
+        import matplotlib.pyplot as plt
+        plt.imshow(image)
+        plt.title(title)
+        plt.show()
+
+
+if __name__ == '__main__':
+    import time
+
+    renderer = VisualRenderer()
+    test_image = np.zeros(shape=(800, 1333, 3), dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    top_left = rng.uniform(0, 700, size=(2000, 2))
+    test_boxes = np.concatenate([top_left, top_left + rng.uniform(10, 100, size=(2000, 2))], axis=1)
+    t = time.time()
+    for k in range(20):
+        renderer.submit(f"/tmp/render_test/{k}.jpg", test_image, test_boxes)
+    renderer.wait()
+    print(f"20 images of 2000 boxes: {time.time() - t:.2f} s")
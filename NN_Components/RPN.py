@@ -2,7 +2,7 @@ import numpy as np
 import tensorflow as tf
 
 from NN_Components import Backbone
-from NN_Helper import BboxTools
+from NN_Helper import BboxToolsTf
 
 
 class RPN:
@@ -32,8 +32,7 @@ class RPN:
                                             kernel_initializer='he_normal')(self.ac1)
         self.bh2 = tf.keras.layers.BatchNormalization()(self.conv2)
         self.ac2 = tf.keras.layers.Activation(activation=tf.keras.activations.relu)(self.bh2)
-        self.reshape2 = tf.keras.layers.Reshape(
-            target_shape=(back_outshape[0], back_outshape[1], int(18 / 2), 2))(self.ac2)
+        self.reshape2 = self._reshape_anchors(self.ac2, back_outshape, int(18 / 2), 2)
         self.RPN_Anchor_Pred = tf.nn.softmax(logits=self.reshape2, axis=-1, name='RPN_Anchor_Pred')
         # [1,0] is background, [0,1] is foreground. second channel is true.
 
@@ -42,9 +41,8 @@ class RPN:
                                             kernel_initializer='he_normal')(self.ac1)
         self.bh3 = tf.keras.layers.BatchNormalization()(self.conv3)
         self.ac3 = tf.keras.layers.Activation(activation=tf.keras.activations.linear)(self.bh3)
-        self.RPN_BBOX_Regression_Pred = tf.keras.layers.Reshape(
-            target_shape=(back_outshape[0], back_outshape[1], int(36 / 4), 4), name='RPN_BBOX_Regression_Pred')(
-            self.ac3)
+        self.RPN_BBOX_Regression_Pred = self._reshape_anchors(self.ac3, back_outshape, int(36 / 4), 4,
+                                                              name='RPN_BBOX_Regression_Pred')
 
         self.RPN_header_model = tf.keras.Model(inputs=[self.input_RPN],
                                                outputs=[self.RPN_Anchor_Pred, self.RPN_BBOX_Regression_Pred],
@@ -55,16 +53,32 @@ class RPN:
                                                       outputs=[rpn_anchor_pred, rpn_bbox_regression_pred],
                                                       name='RPN_BACKBONE_MODEL')
 
-        self.shape_Anchor_Target = self.RPN_header_model.get_layer(
-            name='tf_op_layer_RPN_Anchor_Pred').output.shape[1:-1]
-        self.shape_BBOX_Regression = self.RPN_header_model.get_layer(
-            name='RPN_BBOX_Regression_Pred').output.shape[1:]
-        self.N_total_anchors = self.shape_Anchor_Target[0] * self.shape_Anchor_Target[1] * self.shape_Anchor_Target[2]
+        # h and w are None with a dynamic input shape (aspect ratio buckets), the losses then count the anchors of
+        # each batch at run time
+        self.shape_Anchor_Target = (back_outshape[0], back_outshape[1], int(18 / 2))
+        self.shape_BBOX_Regression = (back_outshape[0], back_outshape[1], int(36 / 4), 4)
+        self.N_total_anchors = None if None in self.shape_Anchor_Target[:2] else \
+            self.shape_Anchor_Target[0] * self.shape_Anchor_Target[1] * self.shape_Anchor_Target[2]
 
         # --- for low level training ---
         self.optimizer_with_backbone = tf.keras.optimizers.Adam(self.lr)
         self.optimizer_header = tf.keras.optimizers.Adam(self.lr)
 
+    @classmethod
+    def _reshape_anchors(cls, tensor, back_outshape, n_anchors: int, depth: int, name: str = None):
+        # (batch, h, w, n_anchors * depth) -> (batch, h, w, n_anchors, depth)
+        if None not in tuple(back_outshape[:2]):
+            return tf.keras.layers.Reshape(target_shape=(back_outshape[0], back_outshape[1], n_anchors, depth),
+                                           name=name)(tensor)
+        # the feature map size is only known at run time
+        return tf.reshape(tensor, tf.concat([tf.shape(tensor)[:3], [n_anchors, depth]], axis=0), name=name)
+
+    def _n_anchors_per_image(self, anchor_pred):
+        if self.N_total_anchors is not None:
+            return self.N_total_anchors
+        shape = tf.shape(anchor_pred)
+        return shape[1] * shape[2] * shape[3]
+
     def process_image(self, img):
         rpn_anchor_pred, rpn_bbox_regression_pred = self.RPN_with_backbone_model.predict(img)
         return rpn_anchor_pred, rpn_bbox_regression_pred
@@ -100,51 +114,62 @@ class RPN:
         tf.keras.utils.plot_model(model=self.RPN_train_model, to_file='RPN_train_model.png', show_shapes=True)
 
     def _rpn_loss(self, anchor_target, bbox_reg_target, anchor_pred, bbox_reg_pred):
-        # shape of input anchor_target: (batch_size=1, h, w, n_anchors)
-        # currently only support batch size = 1
-        bbox_inside_weight = tf.zeros(
-            shape=(self.BATCH, self.shape_Anchor_Target[0], self.shape_Anchor_Target[1], self.shape_Anchor_Target[2]),
-            dtype=tf.float32)
-
+        # dense targets, shape of input anchor_target: (batch_size, h, w, n_anchors), any batch size
+        n_anchors = self._n_anchors_per_image(anchor_pred)
+        anchor_target = tf.reshape(anchor_target, (-1, n_anchors))
         # --- anchor_target: 1:foreground, 0.5:ignore, 0:background ---
-        indices_foreground = tf.where(tf.equal(anchor_target, 1))
-        indices_background = tf.where(tf.equal(anchor_target, 0))
-        # DebugPrint('indices_foreground', indices_foreground)
-        # DebugPrint('indices_background', indices_background)
-        n_foreground = tf.gather_nd(tf.shape(indices_foreground), [[0]])
-        # DebugPrint('n_foreground', n_foreground)
-
-        # --- update value of bbox_inside_weight corresponding to foreground to 1 ---
-        bbox_inside_weight = tf.tensor_scatter_nd_update(tensor=bbox_inside_weight, indices=indices_foreground,
-                                                         updates=tf.ones(shape=n_foreground))
-
-        # --- balance the foreground and background training sample ---
+        foreground = tf.equal(anchor_target, 1)
+        n_foreground = tf.reduce_sum(tf.cast(foreground, tf.float32), axis=1, keepdims=True)
+
+        # --- balance the foreground and background training sample of each image ---
+        # each background is selected with probability (n_foreground + 128) / N_total_anchors of its image
         n_background_selected = 128
-        selected_ratio = (n_foreground + n_background_selected) / self.N_total_anchors
-        remain_ratio = (self.N_total_anchors - n_foreground - n_background_selected) / self.N_total_anchors
-        concat = tf.concat([remain_ratio, selected_ratio], axis=0)
-        concat = tf.reshape(concat, (1, 2))
-        temp_random_choice = tf.random.categorical(tf.math.log(concat), self.N_total_anchors)
-        temp_random_choice = tf.reshape(temp_random_choice, (
-            self.BATCH, self.shape_Anchor_Target[0], self.shape_Anchor_Target[1], self.shape_Anchor_Target[2]))
-        temp_random_choice = tf.gather_nd(params=temp_random_choice, indices=indices_background)
-        temp_random_choice = tf.dtypes.cast(temp_random_choice, tf.float32)
-        # --- update value of bbox_inside_weight corresponding to random selected background to 1 ---
-        bbox_inside_weight = tf.tensor_scatter_nd_update(tensor=bbox_inside_weight, indices=indices_background,
-                                                         updates=temp_random_choice)
-
-        indices_train = tf.where(tf.equal(bbox_inside_weight, 1))
-
-        # print(anchor_target)
-        # print(anchor_pred)
+        selected_ratio = (n_foreground + n_background_selected) / tf.cast(n_anchors, tf.float32)
+        background = tf.logical_and(tf.equal(anchor_target, 0),
+                                    tf.less(tf.random.uniform(shape=tf.shape(anchor_target)), selected_ratio))
+
+        # indices into the batch flattened (batch * n_anchors)
+        indices_foreground = tf.where(tf.reshape(foreground, (-1,)))[:, 0]
+        indices_background = tf.where(tf.reshape(background, (-1,)))[:, 0]
+        bbox_reg_target = tf.gather(tf.reshape(bbox_reg_target, (-1, 4)), indices_foreground)
+        return self._rpn_loss_flat(indices_foreground, bbox_reg_target, indices_background,
+                                   tf.reshape(anchor_pred, (-1, 2)), tf.reshape(bbox_reg_pred, (-1, 4)))
+
+    def _rpn_loss_sparse(self, foreground_indices, foreground_reg_targets, background_indices, anchor_pred,
+                         bbox_reg_pred):
+        '''
+        loss of the sparse targets of NnDataGenerator.gen_sparse_target_for_rpn, the backgrounds are already sampled
+        :param foreground_indices: int32 (batch, p), anchor index in its image (C order of h, w, n_anchors),
+                                   -1 pads the images with less than p foregrounds
+        :param foreground_reg_targets: float32 (batch, p, 4)
+        :param background_indices: int32 (batch, q), padded with -1 too
+        :param anchor_pred: (batch, h, w, n_anchors, 2)
+        :param bbox_reg_pred: (batch, h, w, n_anchors, 4)
+        '''
+        foreground_valid = tf.greater_equal(foreground_indices, 0)
+        foreground_reg_targets = tf.boolean_mask(foreground_reg_targets, foreground_valid)
+        n_anchors = self._n_anchors_per_image(anchor_pred)
+        return self._rpn_loss_flat(self._batch_flat_indices(foreground_indices, foreground_valid, n_anchors),
+                                   foreground_reg_targets,
+                                   self._batch_flat_indices(background_indices,
+                                                            tf.greater_equal(background_indices, 0), n_anchors),
+                                   tf.reshape(anchor_pred, (-1, 2)), tf.reshape(bbox_reg_pred, (-1, 4)))
+
+    def _batch_flat_indices(self, indices, valid, n_anchors):
+        # (batch, k) indices in each image -> the valid ones as indices into the predictions flattened over the batch
+        offsets = tf.range(tf.shape(indices)[0], dtype=tf.int64)[:, tf.newaxis] * tf.cast(n_anchors, tf.int64)
+        return tf.boolean_mask(tf.cast(indices, tf.int64) + offsets, valid)
+
+    def _rpn_loss_flat(self, indices_foreground, bbox_reg_target, indices_background, anchor_pred, bbox_reg_pred):
+        # anchor_pred (n, 2) and bbox_reg_pred (n, 4) flattened, the indices point into them
         # train anchor for foreground and background
-        anchor_target = tf.cast(anchor_target, tf.int32)
+        indices_train = tf.concat([indices_foreground, indices_background], axis=0)
+        anchor_target = tf.concat([tf.ones_like(indices_foreground, dtype=tf.int32),
+                                   tf.zeros_like(indices_background, dtype=tf.int32)], axis=0)
         anchor_target = tf.one_hot(indices=anchor_target, depth=2, axis=-1)
-        anchor_target = tf.gather_nd(params=anchor_target, indices=indices_train)
-        anchor_pred = tf.gather_nd(params=anchor_pred, indices=indices_train)
+        anchor_pred = tf.gather(anchor_pred, indices_train)
         # --- train bbox reg only for foreground ---
-        bbox_reg_target = tf.gather_nd(params=bbox_reg_target, indices=indices_foreground)
-        bbox_reg_pred = tf.gather_nd(params=bbox_reg_pred, indices=indices_foreground)
+        bbox_reg_pred = tf.gather(bbox_reg_pred, indices_foreground)
 
         anchor_loss = tf.losses.categorical_crossentropy(y_true=anchor_target, y_pred=anchor_pred)
         anchor_loss = tf.math.reduce_mean(anchor_loss)
@@ -160,64 +185,63 @@ class RPN:
                         rpn_anchor_pred,
                         rpn_bbox_regression_pred,
                         anchor_candidates,
-                        h: int,
-                        w: int,
-                        n_anchors: int,
                         n_proposal: int,
                         anchor_threshold: float):
+        '''
+        the n_proposal best scored anchors of each image with foreground score > anchor_threshold, decoded with
+        their predicted regression
+        :param rpn_anchor_pred: (batch, h, w, n_anchors, 2), rpn_bbox_regression_pred: (batch, h, w, n_anchors, 4)
+        :param anchor_candidates: (h, w, n_anchors, 4) anchors of the image shape of the batch
+        :return: boxes float32 (k, 4) of all the images in score order per image, box_indices int32 (k,) image of
+                 each box, the inputs of the RoI models
+        '''
         # === Selection part ===
-        # top_values, top_indices = tf.math.top_k()
-        rpn_anchor_pred = tf.slice(rpn_anchor_pred, [0, 0, 0, 0, 1], [1,
-                                                                      h,
-                                                                      w,
-                                                                      n_anchors,
-                                                                      1])  # second channel is foreground
-        # squeeze the pred of anchor and bbox_reg
-        rpn_anchor_pred = tf.squeeze(rpn_anchor_pred)
-        rpn_bbox_regression_pred = tf.squeeze(rpn_bbox_regression_pred)
-        shape1 = tf.shape(rpn_anchor_pred)
-        # flatten the pred of anchor to get top N values and indices
-        rpn_anchor_pred = tf.reshape(rpn_anchor_pred, (-1,))
-        n_anchor_proposal = n_proposal
+        n_images = tf.shape(rpn_anchor_pred)[0]
+        # second channel is foreground, flatten each image to get its top N values and indices
+        rpn_anchor_pred = tf.reshape(rpn_anchor_pred[..., 1], (n_images, -1))
+        rpn_bbox_regression_pred = tf.reshape(rpn_bbox_regression_pred, (n_images, -1, 4))
+        n_anchor_proposal = min(n_proposal, rpn_anchor_pred.shape[1] or n_proposal)
         top_values, top_indices = tf.math.top_k(rpn_anchor_pred,
                                                 n_anchor_proposal)  # top_k has sort function. it's important here
-        top_indices = tf.gather_nd(top_indices, tf.where(tf.greater(top_values, anchor_threshold)))
-        top_values = tf.gather_nd(top_values, tf.where(tf.greater(top_values, anchor_threshold)))
-
-        top_indices = tf.reshape(top_indices, (-1, 1))
-        update_value = tf.math.add(top_values, 1)
-        rpn_anchor_pred = tf.tensor_scatter_nd_update(rpn_anchor_pred, top_indices, update_value)
-        rpn_anchor_pred = tf.reshape(rpn_anchor_pred, shape1)
-
-        # --- find the base boxes ---
-        anchor_pred_top_indices = tf.where(tf.greater(rpn_anchor_pred, 1))
-        base_boxes = tf.gather_nd(anchor_candidates, anchor_pred_top_indices)
-
-        # --- find the bbox_regs ---
-        # flatten the bbox_reg by last dim to use top_indices to get final_box_reg
-        rpn_bbox_regression_pred_shape = tf.shape(rpn_bbox_regression_pred)
-        rpn_bbox_regression_pred = tf.reshape(rpn_bbox_regression_pred, (-1, rpn_bbox_regression_pred_shape[-1]))
-        final_box_reg = tf.gather_nd(rpn_bbox_regression_pred, top_indices)
-
-        # Convert to numpy to plot
-        final_box = BboxTools.bbox_reg2truebox(base_boxes=base_boxes, regs=final_box_reg)
-        return np.array(final_box).astype(np.float)
-        # return final_box
-
-    @tf.function
-    def train_step_with_backbone(self, image, anchor_target, box_reg_target):
+        selected = tf.greater(top_values, anchor_threshold)
+        top_indices = tf.boolean_mask(top_indices, selected)
+
+        # --- find the base boxes and the bbox_regs, in the same (score) order ---
+        base_boxes = tf.gather(tf.cast(tf.reshape(anchor_candidates, (-1, 4)), tf.float32), top_indices)
+        box_indices = tf.cast(tf.where(selected)[:, 0], tf.int32)
+        final_box_reg = tf.gather_nd(rpn_bbox_regression_pred, tf.stack([box_indices, top_indices], axis=1))
+
+        # decode in graph, only convert the final boxes to numpy
+        final_box = BboxToolsTf.bbox_reg2truebox(base_boxes=base_boxes, regs=final_box_reg)
+        return np.asarray(final_box, dtype=np.float32), box_indices.numpy()
+
+    # the sparse targets have a different length for each image, one trace for all of them
+    _train_step_signature = [tf.TensorSpec(shape=(None, None, None, 3), dtype=tf.float32),
+                             tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+                             tf.TensorSpec(shape=(None, None, 4), dtype=tf.float32),
+                             tf.TensorSpec(shape=(None, None), dtype=tf.int32)]
+
+    @tf.function(input_signature=_train_step_signature)
+    def train_step_with_backbone(self, image, foreground_indices, foreground_reg_targets, background_indices):
         with tf.GradientTape() as backbone_tape:
             anchor_pred, box_reg_pred = self.RPN_with_backbone_model(image)
-            total_loss = self._rpn_loss(anchor_target, box_reg_target, anchor_pred, box_reg_pred)
+            total_loss = self._rpn_loss_sparse(foreground_indices, foreground_reg_targets, background_indices,
+                                               anchor_pred, box_reg_pred)
         gradients_backbone = backbone_tape.gradient(total_loss, self.RPN_with_backbone_model.trainable_variables)
         self.optimizer_with_backbone.apply_gradients(
             zip(gradients_backbone, self.RPN_with_backbone_model.trainable_variables))
 
-    @tf.function
-    def train_step_header(self, image, anchor_target, box_reg_target):
+    # the header is trained on the batches of tf_dataset_rpn and SampleWorkerPool, uint8 images cast in the graph
+    _train_step_header_signature = [tf.TensorSpec(shape=(None, None, None, 3), dtype=tf.uint8)] + \
+        _train_step_signature[1:]
+
+    @tf.function(input_signature=_train_step_header_signature)
+    def train_step_header(self, image, foreground_indices, foreground_reg_targets, background_indices):
+        image = tf.cast(image, tf.float32)
         with tf.GradientTape() as header_tape:
             anchor_pred, box_reg_pred = self.RPN_with_backbone_model(image)
-            total_loss = self._rpn_loss(anchor_target, box_reg_target, anchor_pred, box_reg_pred)
+            total_loss = self._rpn_loss_sparse(foreground_indices, foreground_reg_targets, background_indices,
+                                               anchor_pred, box_reg_pred)
         gradients_header = header_tape.gradient(total_loss, self.RPN_header_model.trainable_variables)
         self.optimizer_header.apply_gradients(zip(gradients_header, self.RPN_header_model.trainable_variables))
 
@@ -1,3 +1,6 @@
+import time
+
+import numpy as np
 import tensorflow as tf
 
 from NN_Components import Backbone
@@ -10,32 +13,32 @@ class RoI:
         self.input_bockbone = tf.keras.Input(shape=backbone_model.input.shape[1:], dtype=tf.float32,
                                              name='BACKBONE_INPUT')
         proposal_boxes = tf.keras.Input(shape=(4,), batch_size=None, name='PROPOSAL_BOXES', dtype=tf.float32)
+        # index of the image of each box in the image batch, the image is given once for all its boxes
+        box_indices = tf.keras.Input(shape=(), batch_size=None, name='BOX_INDICES', dtype=tf.int32)
         feature_map_shape = self.backbone_model.layers[-1].output_shape[1:]
         feature_map = tf.keras.Input(shape=feature_map_shape, batch_size=None, name='FEATURE_MAP', dtype=tf.float32)
 
-        shape1 = tf.shape(proposal_boxes, out_type=tf.int32)
-        n_boxes = tf.gather_nd(shape1, [0])
-        indices = tf.zeros(shape=n_boxes, dtype=tf.int32)  # only input 1 image, all indices are 0
         img_shape_constant = tf.constant([img_shape[0], img_shape[1], img_shape[0], img_shape[1]], tf.float32)
         proposal_boxes2 = tf.math.divide(proposal_boxes, img_shape_constant)
 
         image_crop = tf.image.crop_and_resize(image=feature_map, boxes=proposal_boxes2,
-                                              box_indices=indices, crop_size=[7, 7])
+                                              box_indices=box_indices, crop_size=[7, 7])
         flatten1 = tf.keras.layers.GlobalAveragePooling2D()(image_crop)
         fc1 = tf.keras.layers.Dense(units=1024, activation='relu')(flatten1)
         class_header = tf.keras.layers.Dense(units=n_output_classes + 1, activation='softmax')(fc1)
         box_reg_header = tf.keras.layers.Dense(units=4, activation='linear')(fc1)
 
-        self.RoI_header_model = tf.keras.Model(inputs=[feature_map, proposal_boxes],
+        self.RoI_header_model = tf.keras.Model(inputs=[feature_map, proposal_boxes, box_indices],
                                                outputs=[class_header, box_reg_header],
                                                name='RoI_HEADER_MODEL')
         backbone_out = self.backbone_model(self.input_bockbone)
-        ro_i_with_backbone_out1, ro_i_with_backbone_out2 = self.RoI_header_model([backbone_out, proposal_boxes])
-        self.RoI_with_backbone_model = tf.keras.Model(inputs=[self.input_bockbone, proposal_boxes],
+        ro_i_with_backbone_out1, ro_i_with_backbone_out2 = self.RoI_header_model([backbone_out, proposal_boxes,
+                                                                                  box_indices])
+        self.RoI_with_backbone_model = tf.keras.Model(inputs=[self.input_bockbone, proposal_boxes, box_indices],
                                                       outputs=[ro_i_with_backbone_out1, ro_i_with_backbone_out2])
 
         # --- for train step ---
-        self.huber = tf.keras.losses.Huber()
+        self.huber = tf.keras.losses.Huber(reduction=tf.keras.losses.Reduction.NONE)
         self.optimizer_with_backbone = tf.keras.optimizers.Adam(self.lr)
         self.optimizer_header = tf.keras.optimizers.Adam(self.lr)
 
@@ -46,37 +49,86 @@ class RoI:
         self.RoI_header_model.load_weights(filepath=f"{root_path}/RoI_header_model")
 
     def process_image(self, input_img_box):
+        # input_img_box: [images, boxes] of one image or [images, boxes, box_indices]
+        if len(input_img_box) == 2:
+            input_img_box = list(input_img_box) + [self._zero_box_indices(input_img_box[1])]
         pred_class, pred_box_reg = self.RoI_with_backbone_model(input_img_box)
         return pred_class, pred_box_reg
 
+    @classmethod
+    def _zero_box_indices(cls, proposal_box):
+        # all the boxes belong to the first image
+        return tf.zeros(shape=tf.shape(proposal_box)[:1], dtype=tf.int32)
+
     def plot_model(self):
         tf.keras.utils.plot_model(self.RoI_header_model, 'RoI_header_model.png', show_shapes=True)
         tf.keras.utils.plot_model(self.RoI_with_backbone_model, 'RoI_with_backbone_model.png', show_shapes=True)
 
-    @tf.function
-    def train_step_with_backbone(self, input_image, proposal_box, class_header, box_reg_header):
+    def _roi_loss(self, class_header, box_reg_header, class_pred, box_reg_pred):
+        # loss of each box: cross entropy of the class + huber loss averaged over the 4 regression values,
+        # the step loss is the mean over the boxes, for one box it is the loss of that box
+        class_loss = tf.keras.losses.sparse_categorical_crossentropy(y_true=class_header, y_pred=class_pred)
+        box_reg_loss = self.huber(y_true=box_reg_header, y_pred=box_reg_pred)
+        return tf.reduce_mean(tf.add(class_loss, box_reg_loss))
+
+    # all the boxes of one image or of a batch of images in one step, the feature map of each image is computed once.
+    # One trace for any number of boxes and images
+    _train_step_signature = [tf.TensorSpec(shape=(None, None, None, 3), dtype=tf.float32),
+                             tf.TensorSpec(shape=(None, 4), dtype=tf.float32),
+                             tf.TensorSpec(shape=(None,), dtype=tf.int64),
+                             tf.TensorSpec(shape=(None, 4), dtype=tf.float32),
+                             tf.TensorSpec(shape=(None,), dtype=tf.int32)]
+
+    def train_step_with_backbone(self, input_image, proposal_box, class_header, box_reg_header, box_indices=None):
+        # input_image: (B, H, W, 3), proposal_box: (N, 4), box_indices: (N,) image of each box, None for all 0
+        if box_indices is None:
+            box_indices = self._zero_box_indices(proposal_box)
+        self._train_step_with_backbone(input_image, proposal_box, class_header, box_reg_header, box_indices)
+
+    def train_step_header(self, input_image, proposal_box, class_header, box_reg_header, box_indices=None):
+        if box_indices is None:
+            box_indices = self._zero_box_indices(proposal_box)
+        self._train_step_header(input_image, proposal_box, class_header, box_reg_header, box_indices)
+
+    @tf.function(input_signature=_train_step_signature)
+    def _train_step_with_backbone(self, input_image, proposal_box, class_header, box_reg_header, box_indices):
         with tf.GradientTape() as RoI_tape:
-            class_pred, box_reg_pred = self.RoI_with_backbone_model([input_image, proposal_box])
-            class_loss = tf.keras.losses.sparse_categorical_crossentropy(y_true=class_header, y_pred=class_pred)
-
-            box_reg_loss = self.huber(y_true=box_reg_header, y_pred=box_reg_pred)
-            total_loss = tf.reduce_mean(tf.add(class_loss, box_reg_loss))
+            class_pred, box_reg_pred = self.RoI_with_backbone_model([input_image, proposal_box, box_indices])
+            total_loss = self._roi_loss(class_header, box_reg_header, class_pred, box_reg_pred)
         gradients = RoI_tape.gradient(total_loss, self.RoI_with_backbone_model.trainable_variables)
         self.optimizer_with_backbone.apply_gradients(zip(gradients, self.RoI_with_backbone_model.trainable_variables))
 
-    @tf.function
-    def train_step_header(self, input_image, proposal_box, class_header, box_reg_header):
+    @tf.function(input_signature=_train_step_signature)
+    def _train_step_header(self, input_image, proposal_box, class_header, box_reg_header, box_indices):
         with tf.GradientTape() as RoI_tape:
-            class_pred, box_reg_pred = self.RoI_with_backbone_model([input_image, proposal_box])
-            class_loss = tf.keras.losses.sparse_categorical_crossentropy(y_true=class_header, y_pred=class_pred)
-
-            box_reg_loss = self.huber(y_true=box_reg_header, y_pred=box_reg_pred)
-            total_loss = tf.reduce_mean(tf.add(class_loss, box_reg_loss))
+            class_pred, box_reg_pred = self.RoI_with_backbone_model([input_image, proposal_box, box_indices])
+            total_loss = self._roi_loss(class_header, box_reg_header, class_pred, box_reg_pred)
         gradients = RoI_tape.gradient(total_loss, self.RoI_header_model.trainable_variables)
         self.optimizer_header.apply_gradients(zip(gradients, self.RoI_header_model.trainable_variables))
 
 
+def benchmark_train_step(roi: RoI, input_image, proposal_box, class_header, box_reg_header, n_repeat: int = 3):
+    # images per second of the RoI train step with backbone: one step per box against one step for all the boxes
+    box_indices = np.zeros(shape=proposal_box.shape[0], dtype=np.int32)
+    for name, box_slices in (('per box', [slice(j, j + 1) for j in range(proposal_box.shape[0])]),
+                             ('batched', [slice(0, proposal_box.shape[0])])):
+        # first run traces
+        roi.train_step_with_backbone(input_image, proposal_box[:1], class_header[:1], box_reg_header[:1],
+                                     box_indices[:1])
+        t = time.time()
+        for _ in range(n_repeat):
+            for j in box_slices:
+                roi.train_step_with_backbone(input_image, proposal_box[j], class_header[j], box_reg_header[j],
+                                             box_indices[j])
+        print(f"{name}, {proposal_box.shape[0]} boxes: {n_repeat / (time.time() - t):.3f} images/s")
+
+
 if __name__ == '__main__':
     b1 = Backbone()
     t1 = RoI(b1.backbone_model, img_shape=(800, 1333, 3))
     t1.plot_model()
+    rng = np.random.default_rng(0)
+    top_left = rng.uniform(0, 600, size=(32, 2))
+    test_boxes = np.concatenate([top_left, top_left + rng.uniform(32, 200, size=(32, 2))], axis=1).astype(np.float32)
+    benchmark_train_step(t1, rng.uniform(0, 255, size=(1, 800, 1333, 3)).astype(np.float32), test_boxes,
+                         rng.integers(0, 81, size=32), rng.normal(size=(32, 4)).astype(np.float32))
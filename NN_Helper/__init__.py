@@ -1,5 +1,12 @@
 from NN_Helper.bboxtools import BboxTools
 from NN_Helper.bboxtoolstf import BboxToolsTf
+from NN_Helper.nmstools import NmsTools
 from NN_Helper.genbaseanchors import GenBaseAnchors
 from NN_Helper.gencandidateanchors import GenCandidateAnchors, get_feature_map_h_w_with_n_stages
+from NN_Helper.anchorspatialindex import AnchorSpatialIndex
+from NN_Helper.targetassigner import TargetAssigner
+from NN_Helper.randomaugmenter import Augmentation, RandomAugmenter
+from NN_Helper.rpntargetcache import RpnTargetCache
 from NN_Helper.nndatagenerator import NnDataGenerator
+from NN_Helper.aspectbuckets import AspectBuckets
+from NN_Helper.sampleworkerpool import SampleWorkerPool
@@ -0,0 +1,78 @@
+import numpy as np
+
+from NN_Helper import BboxTools
+
+
+class AnchorSpatialIndex:
+    # Index of the candidate anchor grid, bucketed by feature map cell (row, column) and anchor size.
+    # All anchors of the same size are the same box shifted by the stride of the cell,
+    # so the cells whose anchor of that size can overlap a query box form a rectangle of the grid,
+    # which is computed directly instead of testing every anchor.
+    def __init__(self, gen_candidate_anchors, margin: float = 2):
+        self.h = gen_candidate_anchors.h
+        self.w = gen_candidate_anchors.w
+        self.n_anchors = gen_candidate_anchors.n_anchors
+        self.stride = gen_candidate_anchors.n_stage_revert_factor
+        self.anchors_flat = gen_candidate_anchors.anchor_candidates_flat
+        # extent of the anchor of each size at cell (0, 0) before clipping, shape (n_anchors, 4).
+        # margin covers the int truncation of the stored anchors, a larger candidate set is always safe
+        self.base_extents = gen_candidate_anchors.base_anchors.astype(np.float32) - self.stride / 2
+        self.margin = margin
+
+    def query(self, box):
+        '''
+        :param box: (x1, y1, x2, y2)
+        :return: sorted int64 indices into anchor_candidates_flat of the anchors which can overlap the box,
+                 the iou of every other anchor with the box is 0
+        '''
+        x1, y1, x2, y2 = (float(v) for v in box[:4])
+        # anchor at cell (i, j) overlaps the box only if
+        # i * stride + ext_x1 <= x2 and i * stride + ext_x2 >= x1, same for j with the y axis
+        i_min = np.ceil((x1 - self.margin - self.base_extents[:, 2]) / self.stride).astype(np.int64)
+        i_max = np.floor((x2 + self.margin - self.base_extents[:, 0]) / self.stride).astype(np.int64)
+        j_min = np.ceil((y1 - self.margin - self.base_extents[:, 3]) / self.stride).astype(np.int64)
+        j_max = np.floor((y2 + self.margin - self.base_extents[:, 1]) / self.stride).astype(np.int64)
+        np.clip(i_min, 0, self.h, out=i_min)
+        np.clip(i_max, -1, self.h - 1, out=i_max)
+        np.clip(j_min, 0, self.w, out=j_min)
+        np.clip(j_max, -1, self.w - 1, out=j_max)
+
+        indices = []
+        for anchor_index in range(self.n_anchors):
+            rows = np.arange(i_min[anchor_index], i_max[anchor_index] + 1)
+            cols = np.arange(j_min[anchor_index], j_max[anchor_index] + 1)
+            if rows.size == 0 or cols.size == 0:
+                continue
+            cells = rows[:, np.newaxis] * self.w + cols[np.newaxis, :]
+            indices.append((cells * self.n_anchors + anchor_index).ravel())
+        if not indices:
+            return np.zeros(shape=(0,), dtype=np.int64)
+        return np.sort(np.concatenate(indices))
+
+    def sparse_ious(self, gt_boxes):
+        '''
+        ious of the anchors which can overlap at least one gt box, every other anchor has iou 0 with all of them.
+        The cost scales with the area of the gt boxes, not with the anchor grid
+        :param gt_boxes: (M, 4)
+        :return: candidates: sorted int64 (K,) indices into anchor_candidates_flat, the union of query of the gt boxes
+                 ious: float32 (K, M), same rows with BboxTools.ious_matrix(anchors_flat, gt_boxes)[candidates]
+        '''
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float32).reshape((-1, 4))
+        candidates = [self.query(gt_box) for gt_box in gt_boxes]
+        candidates = np.unique(np.concatenate(candidates)) if candidates else np.zeros(shape=(0,), dtype=np.int64)
+        if candidates.size == 0:
+            return candidates, np.zeros(shape=(0, gt_boxes.shape[0]), dtype=np.float32)
+        return candidates, BboxTools.ious_matrix(self.anchors_flat[candidates], gt_boxes)
+
+    def ious_matrix(self, gt_boxes):
+        '''
+        same result with BboxTools.ious_matrix(anchors_flat, gt_boxes), the ious are only computed for the
+        candidates of sparse_ious, but the output is still dense: use sparse_ious and TargetAssigner.assign_sparse
+        to keep the whole matching in the area of the gt boxes
+        :param gt_boxes: (M, 4)
+        :return: float32 numpy array (h*w*n_anchors, M)
+        '''
+        candidates, candidate_ious = self.sparse_ious(gt_boxes)
+        ious = np.zeros(shape=(self.anchors_flat.shape[0], candidate_ious.shape[1]), dtype=np.float32)
+        ious[candidates] = candidate_ious
+        return ious
@@ -0,0 +1,124 @@
+import math
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from NN_Helper import NnDataGenerator
+
+
+class AspectBuckets:
+    # Images grouped by aspect ratio into a few resize shapes instead of one fixed shape for all of them.
+    # The default shapes keep the COCO rule "short side 800, long side up to 1333": a portrait or square image is
+    # not stretched to 800x1333, it gets a smaller shape, which is less distortion and fewer backbone pixels.
+    # Every bucket has its own NnDataGenerator (resize, anchor grid and annotation cache of the bucket shape, RPN
+    # target cache of the bucket images). A batch only holds images of one bucket, the models are built with a
+    # dynamic input shape (Backbone img_shape (None, None, 3)) so one model serves all the buckets.
+    SHAPES = ((800, 1333, 3), (800, 1067, 3), (800, 800, 3), (1067, 800, 3), (1333, 800, 3))
+
+    def __init__(self, generator_kwargs: dict, shapes: tuple = SHAPES):
+        '''
+        :param generator_kwargs: arguments of NnDataGenerator, img_shape_resize is replaced by each bucket shape
+        :param shapes: (height, width, 3) of the buckets
+        '''
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.generators = [NnDataGenerator(**dict(generator_kwargs, img_shape_resize=shape, rpn_target_cache=False))
+                           for shape in self.shapes]
+        # image ids of each bucket, in the order of the dataset
+        self.image_ids = self.group(self.generators[0].dataset_coco)
+        if generator_kwargs.get('rpn_target_cache'):
+            # each bucket caches the targets of its own images only
+            for generator, image_ids in zip(self.generators, self.image_ids):
+                if image_ids:
+                    generator.load_rpn_target_cache(image_ids)
+
+    @classmethod
+    def bucket_of(cls, shapes, image_shape):
+        # the bucket with the closest aspect ratio, compared in log scale so 1:2 and 2:1 are as far from 1:1
+        log_ratio = math.log(image_shape[0] / image_shape[1])
+        return int(np.argmin([abs(log_ratio - math.log(shape[0] / shape[1])) for shape in shapes]))
+
+    def group(self, coco_tools):
+        # the original image shapes come from the annotation cache, no image is decoded
+        image_ids = [[] for _ in self.shapes]
+        for image_id in coco_tools.image_ids:
+            image_ids[self.bucket_of(self.shapes, coco_tools.get_image_shape(image_id))].append(image_id)
+        return image_ids
+
+    def tf_dataset_rpn(self, batch_size: int = 1, shuffle: bool = True, seed: int = None):
+        '''
+        one epoch of RPN train samples of all the buckets, same elements with NnDataGenerator.tf_dataset_rpn.
+        The batches of the buckets are interleaved at random, with the weights of their number of batches.
+        The last batch of each bucket may be incomplete, every image is trained even in a bucket smaller than
+        batch_size
+        :return: tf.data.Dataset, the image shape of a batch is the shape of its bucket
+        '''
+        datasets, weights = [], []
+        for generator, image_ids in zip(self.generators, self.image_ids):
+            if image_ids:
+                datasets.append(generator.tf_dataset_rpn(batch_size=batch_size, shuffle=shuffle, seed=seed,
+                                                         image_ids=image_ids))
+                weights.append(math.ceil(len(image_ids) / batch_size))
+        if not datasets:
+            raise ValueError('AspectBuckets: no image in any bucket')
+        if len(datasets) == 1:
+            return datasets[0]
+        weights = np.asarray(weights, dtype=np.float32) / sum(weights)
+        # tf.data.Dataset.sample_from_datasets since tensorflow 2.7
+        sample_from_datasets = getattr(tf.data.Dataset, 'sample_from_datasets',
+                                       tf.data.experimental.sample_from_datasets)
+        return sample_from_datasets(datasets, weights=weights.tolist(), seed=seed)
+
+    def report(self, fixed_shape: tuple = None):
+        '''
+        :param fixed_shape: the single resize shape to compare with, default the first bucket shape
+        :return: list of (shape, n_images, anchors per image) of the buckets, and the ratio of backbone pixels of an
+                 epoch with the buckets over the pixels with fixed_shape
+        '''
+        fixed_shape = tuple(fixed_shape or self.shapes[0])
+        rows = []
+        n_pixels = 0
+        for shape, generator, image_ids in zip(self.shapes, self.generators, self.image_ids):
+            rows.append((shape, len(image_ids), generator.n_total_anchors))
+            n_pixels += len(image_ids) * shape[0] * shape[1]
+        n_images = sum(len(image_ids) for image_ids in self.image_ids)
+        return rows, n_pixels / max(n_images * fixed_shape[0] * fixed_shape[1], 1)
+
+
+def benchmark_buckets(generator_kwargs: dict, n_steps: int = 20, shapes: tuple = AspectBuckets.SHAPES):
+    # RPN samples per second of the data pipeline and images per second of the RPN header train step of the
+    # training (Backbone and RPN of NN_Components with a dynamic input shape, one model for both), one fixed shape
+    # (generator_kwargs img_shape_resize) against the aspect ratio buckets
+    from NN_Components import Backbone, RPN
+    buckets = AspectBuckets(generator_kwargs, shapes)
+    fixed = NnDataGenerator(**generator_kwargs)
+    rows, pixel_ratio = buckets.report(fixed.img_shape_resize)
+    for shape, n_images, n_anchors in rows:
+        print(f"bucket {shape[0]}x{shape[1]}: {n_images} images, {n_anchors} anchors")
+    print(f"backbone pixels with the buckets: {pixel_ratio:.2f} of the fixed shape")
+    rpn = RPN(Backbone(img_shape=(None, None, 3), n_stage=generator_kwargs.get('n_stage', 5)).backbone_model)
+
+    for name, dataset in (('fixed', fixed.tf_dataset_rpn(shuffle=False)),
+                          ('buckets', buckets.tf_dataset_rpn(shuffle=False))):
+        # one epoch to warm up the caches, the train step has one trace for all the shapes
+        for batch in dataset:
+            rpn.train_step_header(*batch)
+        t = time.time()
+        n = sum(1 for _ in dataset.repeat().take(n_steps))
+        data_seconds = time.time() - t
+        t = time.time()
+        for batch in dataset.repeat().take(n_steps):
+            rpn.train_step_header(*batch)
+        # the steps run asynchronously on a gpu, reading a weight waits for them
+        rpn.RPN_header_model.trainable_variables[0].numpy()
+        print(f"{name}: pipeline {n / data_seconds:.1f} samples/s, "
+              f"pipeline + RPN header train step {n_steps / (time.time() - t):.2f} images/s")
+
+
+if __name__ == '__main__':
+    from Configs.FasterRCNN_config import Param
+
+    benchmark_buckets(dict(file=Param.DATA_JSON_FILE, imagefolder_path=Param.PATH_IMAGES,
+                           anchor_base_size=Param.BASE_SIZE, ratios=Param.RATIOS, scales=Param.SCALES,
+                           n_anchors=Param.N_ANCHORS, img_shape_resize=Param.IMG_RESIZED_SHAPE,
+                           n_stage=Param.N_STAGE))
@@ -1,85 +1,90 @@
-import numpy as np
 import tensorflow as tf
 
-from NN_Helper import BboxTools
-
 
 class BboxToolsTf:
-    # Beside ious, format of boxes is numpy.
-    # format of boxes is list for ious
-    # TODO: tf.numpy_function only works on eager mode, not graph mode!!
+    # Pure TensorFlow version of BboxTools, all methods only use tf ops,
+    # so they work in eager mode, inside tf.function and with jit_compile=True.
+    # box axis format: (x1, y1, x2, y2), boxes are cast to float32 tensors with shape (..., 4)
     @classmethod
-    def _ious(cls, boxes_np, box_1target):
-        # box axis format: (x1,y1,x2,y2)
-        # boxes_np:(?,4), box_1target:(4,)
-        shape = boxes_np.shape
-        box_b_area = (box_1target[2] - box_1target[0] + 1) * (box_1target[3] - box_1target[1] + 1)
-        ious = np.zeros(shape=shape[0])
-        for i in range(shape[0]):
-            # determine the (x, y)-coordinates of the intersection rectangle
-            box = boxes_np[i]
-            x_a = max(box[0], box_1target[0])
-            y_a = max(box[1], box_1target[1])
-            x_b = min(box[2], box_1target[2])
-            y_b = min(box[3], box_1target[3])
-
-            # compute the area of intersection rectangle
-            inter_area = max(0, x_b - x_a + 1) * max(0, y_b - y_a + 1)
+    def ious(cls, boxes, box_1target):
+        # boxes:(?,4), box_1target:(4,), output: (?,)
+        box_1target = tf.reshape(tf.cast(box_1target, tf.float32), (1, 4))
+        return cls.ious_matrix(boxes, box_1target)[:, 0]
 
-            # compute the area of both the prediction and ground-truth
-            # rectangles
-            box_a_area = (box[2] - box[0] + 1) * (box[3] - box[1] + 1)
+    @classmethod
+    def ious_matrix(cls, boxes, gt_boxes):
+        # boxes:(N,4), gt_boxes:(M,4), output: (N,M)
+        boxes = tf.cast(boxes, tf.float32)
+        gt_boxes = tf.cast(gt_boxes, tf.float32)
+        x1, y1, x2, y2 = tf.split(boxes, 4, axis=-1)  # (N,1) each
+        gt_x1, gt_y1, gt_x2, gt_y2 = tf.unstack(gt_boxes, 4, axis=-1)  # (M,) each
 
-            # compute the intersection over union by taking the intersection
-            # area and dividing it by the sum of prediction + ground-truth
-            # areas - the interesection area
-            ious[i] = (inter_area / float(box_a_area + box_b_area - inter_area))
+        # --- determine the (x, y)-coordinates of the intersection rectangles ---
+        inter_h = tf.maximum(tf.minimum(x2, gt_x2) - tf.maximum(x1, gt_x1) + 1, 0)
+        inter_w = tf.maximum(tf.minimum(y2, gt_y2) - tf.maximum(y1, gt_y1) + 1, 0)
+        inter_area = inter_h * inter_w
 
-        # return the intersection over union value
-        return ious
-
-    @classmethod
-    def ious(cls, boxes_np, box_1target):
-        ious = tf.numpy_function(cls._ious, [boxes_np, box_1target], tf.float32)
-        return ious
+        box_areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+        gt_areas = (gt_x2 - gt_x1 + 1) * (gt_y2 - gt_y1 + 1)
+        return inter_area / (box_areas + gt_areas - inter_area)
 
     @classmethod
     def bbox_regression_target(cls, pred_boxes, gt_box):
-        reg_target = tf.numpy_function(BboxTools.bbox_regression_target, [pred_boxes, gt_box], tf.float32)
-        return reg_target
+        # pred_boxes: (N,4), gt_box: (4,) or (N,4)
+        ex_boxes_xywh = cls.xxyy2xywh(pred_boxes)
+        gt_boxes_xywh = cls.xxyy2xywh(gt_box)
+        reg_xy = (gt_boxes_xywh[..., 0:2] - ex_boxes_xywh[..., 0:2]) / ex_boxes_xywh[..., 2:4]
+        reg_wh = tf.math.log(gt_boxes_xywh[..., 2:4] / ex_boxes_xywh[..., 2:4])
+        return tf.concat([reg_xy, reg_wh], axis=-1)
 
     @classmethod
     def bbox_reg2truebox(cls, base_boxes, regs):
         # input shape (N,4) , (N,4)
-        # tested
-        truebox = tf.numpy_function(BboxTools.bbox_reg2truebox, [base_boxes, regs], tf.float32)
-        return truebox
+        regs = tf.cast(regs, tf.float32)
+        base_box_xywh = cls.xxyy2xywh(base_boxes)
+        box_xy = regs[..., 0:2] * base_box_xywh[..., 2:4] + base_box_xywh[..., 0:2]
+        box_wh = tf.math.exp(regs[..., 2:4]) * base_box_xywh[..., 2:4]
+        return cls.xywh2xxyy(tf.concat([box_xy, box_wh], axis=-1))
 
     @classmethod
     def xxyy2xywh(cls, boxes):
-        xywh = tf.numpy_function(BboxTools.xxyy2xywh, [boxes], tf.float32)
-        return xywh
+        # the center is x1 + (w - 1) / 2, same with GenBaseAnchors, so xywh2xxyy is the exact inverse
+        boxes = tf.cast(boxes, tf.float32)
+        wh = boxes[..., 2:4] - boxes[..., 0:2] + 1
+        xy = (boxes[..., 0:2] + boxes[..., 2:4]) * 0.5
+        return tf.concat([xy, wh], axis=-1)
 
     @classmethod
     def xywh2xxyy(cls, boxes):
-        xyxy = tf.numpy_function(BboxTools.xywh2xxyy, [boxes], tf.int32)
-        return xyxy
+        boxes = tf.cast(boxes, tf.float32)
+        half_wh = (boxes[..., 2:4] - 1) * 0.5
+        return tf.concat([boxes[..., 0:2] - half_wh, boxes[..., 0:2] + half_wh], axis=-1)
 
     @classmethod
     def clip_boxes(cls, boxes, img_shape):
-        boxes2 = tf.numpy_function(BboxTools.clip_boxes, [boxes, img_shape], tf.int32)
-        return boxes2
+        # same rules as BboxTools.clip_boxes
+        boxes = tf.cast(boxes, tf.float32)
+        x_max = tf.cast(img_shape[0], tf.float32)
+        y_max = tf.cast(img_shape[1], tf.float32)
+        x1, y1, x2, y2 = tf.unstack(boxes, 4, axis=-1)
+        x1 = tf.where(x1 < 0, 0., tf.where(x1 > x_max, x_max - 1, x1))
+        y1 = tf.where(y1 < 0, 0., tf.where(y1 > y_max, y_max - 1, y1))
+        x2 = tf.where(x2 < 0, 1., tf.where(x2 > x_max, x_max, x2))
+        y2 = tf.where(y2 < 0, 1., tf.where(y2 > y_max, y_max, y2))
+        return tf.stack([x1, y1, x2, y2], axis=-1)
 
 
 if __name__ == '__main__':
-    pass
-    # t1 = tf.constant([[10, 10, 20, 20]], dtype=tf.int32)
-    # t2 = tf.constant([[5, 5, 35, 35]])
-    # print(t1)
-    # print(BboxToolsTf.xxyy2xywh(t1))
-    # print(BboxToolsTf.xywh2xxyy(BboxToolsTf.xxyy2xywh(t1)))
-    #
-    # print(BboxToolsTf.xxyy2xywh(t2))
-    # print(BboxToolsTf.bbox_regression_target(t1, t2))
-    # print(BboxToolsTf.bbox_reg2truebox(t1, BboxToolsTf.bbox_regression_target(t1, t2)))
-    # print(BboxToolsTf.ious(t1, t2[0]))
+    t1 = tf.constant([[10, 10, 20, 20]], dtype=tf.int32)
+    t2 = tf.constant([[5, 5, 35, 35]])
+    print(BboxToolsTf.xxyy2xywh(t1))
+    print(BboxToolsTf.xywh2xxyy(BboxToolsTf.xxyy2xywh(t1)))
+    print(BboxToolsTf.bbox_regression_target(t1, t2))
+    print(BboxToolsTf.bbox_reg2truebox(t1, BboxToolsTf.bbox_regression_target(t1, t2)))
+    print(BboxToolsTf.ious(t1, t2[0]))
+
+    @tf.function(jit_compile=True)
+    def decode_and_clip(base_boxes, regs):
+        return BboxToolsTf.clip_boxes(BboxToolsTf.bbox_reg2truebox(base_boxes, regs), (800, 1333))
+
+    print(decode_and_clip(t1, BboxToolsTf.bbox_regression_target(t1, t2)))
@@ -1,7 +1,7 @@
+import functools
 import random
 
 import cv2 as cv
-import matplotlib.pyplot as plt
 import numpy as np
 
 from Debugger import debug_print
@@ -20,33 +20,19 @@ class GenCandidateAnchors:
             ratios = [0.5, 1, 2]
         self.img_shape = (img_shape[0], img_shape[1])
         self.n_stage_revert_factor = 2 ** n_stage
-        self.base_anchors = GenBaseAnchors.gen_base_anchors(base_size=base_size, ratios=ratios,
-                                                            scales=scales)
         # here round up the number since the tensorflow conv2d round strategy
-        self.h = int(img_shape[0] / self.n_stage_revert_factor) + int((img_shape[0] % self.n_stage_revert_factor) > 0)
-        self.w = int(img_shape[1] / self.n_stage_revert_factor) + int((img_shape[1] % self.n_stage_revert_factor) > 0)
+        self.h, self.w = get_feature_map_h_w_with_n_stages(img_shape=img_shape, n_stage=n_stage)
         self.n_anchors = n_anchors
-        self.anchor_candidates = self.gen_all_candidate_anchors(self.h, self.w, self.n_anchors, self.img_shape)
-        self.anchor_candidates_list = list(np.reshape(self.anchor_candidates, newshape=(-1, 4)).tolist())
+        # the grid is shared by all generators with the same config, the arrays are read only
+        self.base_anchors, self.anchor_candidates, self.anchor_cross_boundary_mask = _gen_anchor_grid(
+            self.img_shape, n_stage, base_size, tuple(np.asarray(ratios).tolist()),
+            tuple(np.asarray(scales).tolist()))
+        # (h*w*n_anchors, 4) view of anchor_candidates, the row order is the same with the flatten (h, w, n_anchors)
+        self.anchor_candidates_flat = self.anchor_candidates.reshape((-1, 4))
 
     def gen_all_candidate_anchors(self, h: int, w: int, num_anchors: int, image_shape: tuple):
-        anchors = np.zeros(shape=(h, w, num_anchors, 4), dtype=np.int)
-        # anchors axis format: (x1, y1, x2, y2)
-        x_max = image_shape[0] - 1
-        y_max = image_shape[1] - 1
-        for x in range(h):
-            for y in range(w):
-                temp = self.base_anchors + np.array([x * self.n_stage_revert_factor - self.n_stage_revert_factor / 2,
-                                                     y * self.n_stage_revert_factor - self.n_stage_revert_factor / 2,
-                                                     x * self.n_stage_revert_factor - self.n_stage_revert_factor / 2,
-                                                     y * self.n_stage_revert_factor - self.n_stage_revert_factor / 2])
-                temp[:, 0][temp[:, 0] < 0] = 0
-                temp[:, 1][temp[:, 1] < 0] = 0
-                temp[:, 2][temp[:, 2] > x_max] = x_max
-                temp[:, 3][temp[:, 3] > y_max] = y_max
-                anchors[x, y, :, :] = temp
-
-        return anchors
+        anchors, _ = _shift_base_anchors(self.base_anchors, h, w, self.n_stage_revert_factor, image_shape)
+        return anchors.reshape((h, w, num_anchors, 4))
 
     def _validate_bbox(self, bboxes):
         img1 = np.zeros(shape=(self.img_shape[0], self.img_shape[1], 3), dtype=np.uint8)
@@ -56,6 +42,8 @@ class GenCandidateAnchors:
             # print(bbox)
             cv.rectangle(img=img1, rec=(bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]), color=color,
                          thickness=4)
+        # debug window only, importing NN_Helper must not import matplotlib
+        import matplotlib.pyplot as plt
         plt.imshow(img1)
         plt.show()
 
@@ -68,6 +56,38 @@ def get_feature_map_h_w_with_n_stages(img_shape: tuple, n_stage: int):
     return h, w
 
 
+def _shift_base_anchors(base_anchors, h: int, w: int, n_stage_revert_factor: int, image_shape: tuple):
+    # anchors axis format: (x1, y1, x2, y2), shape (h, w, n_base_anchors, 4), broadcast in one op
+    x_shifts = np.arange(h, dtype=np.float32) * n_stage_revert_factor - n_stage_revert_factor / 2
+    y_shifts = np.arange(w, dtype=np.float32) * n_stage_revert_factor - n_stage_revert_factor / 2
+    shifts = np.zeros(shape=(h, w, 1, 4), dtype=np.float32)
+    shifts[:, :, 0, 0::2] = x_shifts[:, np.newaxis, np.newaxis]
+    shifts[:, :, 0, 1::2] = y_shifts[np.newaxis, :, np.newaxis]
+    anchors = shifts + base_anchors.astype(np.float32)
+
+    # --- anchors crossing the image boundary, before clipping ---
+    x_max = image_shape[0] - 1
+    y_max = image_shape[1] - 1
+    cross_boundary_mask = (anchors[..., 0] < 0) | (anchors[..., 1] < 0) | \
+                          (anchors[..., 2] > x_max) | (anchors[..., 3] > y_max)
+
+    np.maximum(anchors[..., 0:2], 0, out=anchors[..., 0:2])
+    np.minimum(anchors[..., 2], x_max, out=anchors[..., 2])
+    np.minimum(anchors[..., 3], y_max, out=anchors[..., 3])
+    return anchors.astype(np.int32), cross_boundary_mask
+
+
+@functools.lru_cache(maxsize=16)
+def _gen_anchor_grid(img_shape: tuple, n_stage: int, base_size: int, ratios: tuple, scales: tuple):
+    base_anchors = GenBaseAnchors.gen_base_anchors(base_size=base_size, ratios=list(ratios),
+                                                   scales=np.asarray(scales))
+    h, w = get_feature_map_h_w_with_n_stages(img_shape=img_shape, n_stage=n_stage)
+    anchors, cross_boundary_mask = _shift_base_anchors(base_anchors, h, w, 2 ** n_stage, img_shape)
+    for array in (base_anchors, anchors, cross_boundary_mask):
+        array.setflags(write=False)
+    return base_anchors, anchors, cross_boundary_mask
+
+
 if __name__ == '__main__':
     t1 = GenCandidateAnchors(base_size=12)
     debug_print("base anchors", t1.base_anchors)
@@ -83,4 +103,4 @@ if __name__ == '__main__':
     debug_print("Same with Anchor candidate at [0,0,2] after reshape", temp[2, :])
     temp2 = temp.reshape((t1.h, t1.w, t1.n_anchors, 4))
     debug_print("Same with temp[2,:] after reshape", temp2[0, 0, 2, :])
-    debug_print("Same anchor in anchor list", t1.anchor_candidates_list[2])
+    debug_print("Same anchor in flat anchors", t1.anchor_candidates_flat[2])
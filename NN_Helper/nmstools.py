@@ -0,0 +1,196 @@
+import numpy as np
+
+from NN_Helper import BboxTools
+
+
+class NmsTools:
+    # box axis format: (x1, y1, x2, y2), same with BboxTools, areas use the +1 pixel convention.
+    # All methods return indices into the input boxes, ordered by descending score.
+    # pre_top_k: only the pre_top_k highest scored boxes take part in the suppression
+    # post_top_k: stop after post_top_k boxes are kept
+    @classmethod
+    def nms(cls, boxes, scores=None, iou_threshold: float = 0.5, pre_top_k: int = None, post_top_k: int = None):
+        '''
+        greedy non maximum suppression, a box is suppressed if its iou with a kept box >= iou_threshold
+        :param boxes: (N, 4)
+        :param scores: (N,), None means the boxes are already sorted by score
+        :return: int64 indices of the kept boxes
+        '''
+        order = cls._sorted_order(boxes, scores, pre_top_k)
+        boxes = np.asarray(boxes, dtype=np.float32).reshape((-1, 4))
+        keep = cls._greedy_nms(boxes[order], iou_threshold, post_top_k)
+        return order[keep]
+
+    @classmethod
+    def batched_nms(cls, boxes, scores, class_ids, iou_threshold: float = 0.5, pre_top_k: int = None,
+                    post_top_k: int = None):
+        '''
+        per class nms, boxes of different classes never suppress each other.
+        Same result with shifting the boxes of each class by an offset larger than any coordinate and running
+        one nms, but each class is suppressed on its own segment, so the loop only runs over boxes of one class
+        :param class_ids: (N,) int
+        '''
+        order = cls._sorted_order(boxes, scores, pre_top_k)
+        boxes = np.asarray(boxes, dtype=np.float32).reshape((-1, 4))[order]
+        class_ids = np.asarray(class_ids).reshape((-1,))[order]
+        # group by class, the score order is kept inside each class by the stable sort
+        class_order = np.argsort(class_ids, kind='stable')
+        class_starts = np.flatnonzero(np.diff(class_ids[class_order], prepend=np.nan)) if order.size else []
+        class_ends = np.append(class_starts[1:], order.size) if order.size else []
+        keep = [class_order[start:end][cls._greedy_nms(boxes[class_order[start:end]], iou_threshold, post_top_k)]
+                for start, end in zip(class_starts, class_ends)]
+        keep = np.sort(np.concatenate(keep)) if keep else np.zeros(shape=(0,), dtype=np.int64)
+        return order[keep[:post_top_k]]
+
+    @classmethod
+    def soft_nms(cls, boxes, scores, iou_threshold: float = 0.3, sigma: float = 0.5,
+                 score_threshold: float = 0.001, method: str = 'gaussian', pre_top_k: int = None,
+                 post_top_k: int = None):
+        '''
+        soft nms (Bodla et al. 2017), the scores of overlapping boxes are decayed instead of removed
+        :param method: 'gaussian': score * exp(-iou^2 / sigma), 'linear': score * (1 - iou) if iou >= iou_threshold
+        :return: int64 indices of the kept boxes, float32 decayed scores of the kept boxes
+        '''
+        order = cls._sorted_order(boxes, scores, pre_top_k)
+        boxes = np.asarray(boxes, dtype=np.float32).reshape((-1, 4))[order]
+        scores = np.asarray(scores, dtype=np.float32).reshape((-1,))[order]
+        x1, y1, x2, y2 = (np.ascontiguousarray(boxes[:, i]) for i in range(4))
+        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+        n_max = boxes.shape[0] if post_top_k is None else min(post_top_k, boxes.shape[0])
+
+        remaining = np.arange(boxes.shape[0])
+        keep = []
+        keep_scores = []
+        while remaining.size > 0 and len(keep) < n_max:
+            top = np.argmax(scores[remaining])
+            i = remaining[top]
+            if scores[i] < score_threshold:
+                break
+            keep.append(i)
+            keep_scores.append(scores[i])
+            remaining = np.delete(remaining, top)
+            ious = cls._ious_one_to_many(x1, y1, x2, y2, areas, i, remaining)
+            if method == 'linear':
+                decay = np.where(ious >= iou_threshold, 1 - ious, 1)
+            else:
+                decay = np.exp(-(ious * ious) / sigma)
+            scores[remaining] *= decay
+        return order[np.asarray(keep, dtype=np.int64)], np.asarray(keep_scores, dtype=np.float32)
+
+    @classmethod
+    def _sorted_order(cls, boxes, scores, pre_top_k):
+        n = len(boxes)
+        if scores is None:
+            order = np.arange(n, dtype=np.int64)
+        else:
+            order = np.argsort(-np.asarray(scores, dtype=np.float32).reshape((-1,)), kind='stable')
+        if pre_top_k is not None:
+            order = order[:pre_top_k]
+        return order
+
+    @classmethod
+    def _greedy_nms(cls, boxes, iou_threshold, post_top_k, max_matrix_boxes: int = 512):
+        # boxes: (N, 4) float32 sorted by score
+        if boxes.shape[0] <= max_matrix_boxes:
+            return cls._greedy_nms_matrix(boxes, iou_threshold, post_top_k)
+        # for many boxes, only the remaining boxes are compared with each kept box,
+        # the coordinates and areas are computed once
+        x1, y1, x2, y2 = (np.ascontiguousarray(boxes[:, i]) for i in range(4))
+        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+        n_max = boxes.shape[0] if post_top_k is None else post_top_k
+
+        remaining = np.arange(boxes.shape[0])
+        keep = []
+        while remaining.size > 0 and len(keep) < n_max:
+            i = remaining[0]
+            keep.append(i)
+            remaining = remaining[1:]
+            ious = cls._ious_one_to_many(x1, y1, x2, y2, areas, i, remaining)
+            remaining = remaining[ious < iou_threshold]
+        return np.asarray(keep, dtype=np.int64)
+
+    @classmethod
+    def _greedy_nms_matrix(cls, boxes, iou_threshold, post_top_k):
+        # for a few boxes, compute all ious as one matrix, only a boolean sweep is left for the greedy part
+        suppress = BboxTools.ious_matrix(boxes, boxes) >= iou_threshold
+        alive = np.ones(shape=boxes.shape[0], dtype=bool)
+        for row in range(boxes.shape[0]):
+            if alive[row]:
+                alive[row + 1:] &= ~suppress[row, row + 1:]
+        return np.flatnonzero(alive)[:post_top_k]
+
+    @classmethod
+    def _ious_one_to_many(cls, x1, y1, x2, y2, areas, i, others):
+        # iou of box i with the boxes of indices others, intermediate arrays are reused in place
+        inter_h = np.minimum(x2[others], x2[i])
+        inter_h -= np.maximum(x1[others], x1[i])
+        inter_h += 1
+        np.maximum(inter_h, 0, out=inter_h)
+        inter_w = np.minimum(y2[others], y2[i])
+        inter_w -= np.maximum(y1[others], y1[i])
+        inter_w += 1
+        np.maximum(inter_w, 0, out=inter_w)
+        inter_area = np.multiply(inter_h, inter_w, out=inter_h)
+        union = np.add(areas[others], areas[i], out=inter_w)
+        union -= inter_area
+        return np.divide(inter_area, union, out=inter_area)
+
+
+def _nms_reference_loop(boxes, iou_threshold):
+    # the previous FasterRCNN.nms_loop_np based loop, kept for the benchmark
+    boxes_temp = np.array(boxes)
+    nms_boxes_list = []
+    while boxes_temp.shape[0] > 0:
+        box_1target = np.ones(shape=boxes_temp.shape) * boxes_temp[0, :]
+        zeros = np.zeros(shape=boxes_temp.shape)
+        box_b_area = (box_1target[:, 2] - box_1target[:, 0] + 1) * (box_1target[:, 3] - box_1target[:, 1] + 1)
+        x_a = np.max(np.array([boxes_temp[:, 0], box_1target[:, 0]]), axis=0)
+        y_a = np.max(np.array([boxes_temp[:, 1], box_1target[:, 1]]), axis=0)
+        x_b = np.min(np.array([boxes_temp[:, 2], box_1target[:, 2]]), axis=0)
+        y_b = np.min(np.array([boxes_temp[:, 3], box_1target[:, 3]]), axis=0)
+        inter_area = np.max(np.array([zeros[:, 0], x_b - x_a + 1]), axis=0) * np.max(
+            np.array([zeros[:, 0], y_b - y_a + 1]), axis=0)
+        box_a_area = (boxes_temp[:, 2] - boxes_temp[:, 0] + 1) * (boxes_temp[:, 3] - boxes_temp[:, 1] + 1)
+        ious = (inter_area / (box_a_area + box_b_area - inter_area))
+        nms_boxes_list.append(boxes_temp[0, :])
+        boxes_temp = boxes_temp[ious < iou_threshold]
+    return nms_boxes_list
+
+
+def benchmark_nms(sizes=(300, 2000, 10000), iou_threshold: float = 0.4):
+    import time
+
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        xy1 = rng.uniform(0, 700, size=(n, 2))
+        boxes = np.hstack([xy1, xy1 + rng.uniform(16, 300, size=(n, 2))]).astype(np.float32)
+        scores = rng.uniform(size=n).astype(np.float32)
+        class_ids = rng.integers(0, 80, size=n)
+        boxes_sorted = boxes[np.argsort(-scores, kind='stable')]
+
+        t = time.time()
+        reference = _nms_reference_loop(boxes_sorted, iou_threshold)
+        time_reference = time.time() - t
+        t = time.time()
+        keep = NmsTools.nms(boxes, scores, iou_threshold)
+        time_nms = time.time() - t
+        t = time.time()
+        NmsTools.batched_nms(boxes, scores, class_ids, iou_threshold)
+        time_batched = time.time() - t
+        t = time.time()
+        NmsTools.soft_nms(boxes, scores, iou_threshold, pre_top_k=2000, post_top_k=300)
+        time_soft = time.time() - t
+
+        assert np.array_equal(np.asarray(reference), boxes[keep])
+        print(f"boxes: {n}, kept: {keep.shape[0]}, loop: {time_reference * 1000:.1f} ms, "
+              f"nms: {time_nms * 1000:.1f} ms ({time_reference / time_nms:.1f}x), "
+              f"batched nms: {time_batched * 1000:.1f} ms, soft nms (top 2000 -> 300): {time_soft * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    test_boxes = np.array([[0, 0, 9, 9], [1, 1, 10, 10], [20, 20, 29, 29], [0, 0, 9, 9]])
+    test_scores = np.array([0.9, 0.8, 0.7, 0.95])
+    print(NmsTools.nms(test_boxes, test_scores, 0.5))
+    print(NmsTools.batched_nms(test_boxes, test_scores, [0, 1, 0, 0], 0.5))
+    print(NmsTools.soft_nms(test_boxes, test_scores, 0.5))
+    benchmark_nms()
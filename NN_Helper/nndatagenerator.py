@@ -1,11 +1,9 @@
-import random
-
-import cv2 as cv
-import matplotlib.pyplot as plt
 import numpy as np
+import tensorflow as tf
 
-from Data_Helper import CocoTools
-from NN_Helper import BboxTools, GenCandidateAnchors
+from Data_Helper import CocoTools, VisualRenderer
+from NN_Helper import AnchorSpatialIndex, BboxTools, GenCandidateAnchors, RandomAugmenter, RpnTargetCache, \
+    TargetAssigner
 
 
 class NnDataGenerator():
@@ -19,46 +17,130 @@ class NnDataGenerator():
                  img_shape_resize: tuple = (800, 1333, 3),
                  n_stage: int = 5,
                  threshold_iou_rpn: float = 0.7,
-                 threshold_iou_roi: float = 0.55
+                 threshold_iou_roi: float = 0.55,
+                 image_shard_dir: str = None,
+                 augmenter: RandomAugmenter = None,
+                 rpn_target_cache: bool = False,
+                 rpn_n_background: int = 128,
+                 seed: int = None
                  ):
-        # TODO: complete the resize part of the data generator
+        # the images and boxes are resized to img_shape_resize by CocoTools, the boxes once in its AnnotationCache.
+        # augmenter: random flip and scale of the train samples in memory, before the target assignment, None for off
+        # rpn_target_cache: read the RPN targets of the samples which are not augmented from an RpnTargetCache,
+        # built by a process pool on the first run of a config
+        # rpn_n_background: about n_foreground + rpn_n_background anchors of an image are trained by the RPN loss,
+        # the backgrounds are sampled here, seed is the seed of that sampling
         self.threshold_iou_rpn = threshold_iou_rpn
         self.threshold_iou_roi = threshold_iou_roi
-        self.dataset_coco = CocoTools(file, imagefolder_path, img_shape_resize)
+        self.dataset_coco = CocoTools(file, imagefolder_path, img_shape_resize, image_shard_dir=image_shard_dir)
         self.gen_candidate_anchors = GenCandidateAnchors(base_size=anchor_base_size, ratios=ratios, scales=scales,
                                                          img_shape=img_shape_resize, n_stage=n_stage,
                                                          n_anchors=n_anchors)
+        self.anchor_spatial_index = AnchorSpatialIndex(self.gen_candidate_anchors)
+        self.rpn_target_assigner = TargetAssigner(positive_threshold=threshold_iou_rpn, negative_threshold=0.3)
+        self.roi_target_assigner = TargetAssigner(positive_threshold=threshold_iou_roi)
         self.img_shape_resize = img_shape_resize
+        self.augmenter = augmenter
+        # Augmentation of the last train sample, reuse it for boxes predicted on that sample (RPN proposals)
+        self.last_augmentation = None
+        self.shape_anchors = (self.gen_candidate_anchors.h, self.gen_candidate_anchors.w,
+                              self.gen_candidate_anchors.n_anchors)
+        self.rpn_target_cache = None
+        if rpn_target_cache:
+            self.load_rpn_target_cache()
+        # reads of the RpnTargetCache and how many of them were hits, see rpn_target_cache_stats
+        self.rpn_target_cache_lookups = 0
+        self.rpn_target_cache_hits = 0
+        self.n_total_anchors = int(np.prod(self.shape_anchors))
+        self.rpn_n_background = rpn_n_background
+        self.rng = np.random.default_rng(seed)
 
-    def _resize_img(self, img):
-        return cv.resize(img, self.img_shape_resize, cv.INTER_LINEAR)
-
-    def _resize_box(self, box):
-        pass
+    def load_rpn_target_cache(self, image_ids: list = None):
+        '''
+        load the RpnTargetCache of the config, built by a process pool on the first run
+        :param image_ids: the images to cache, e.g. the ones of an aspect bucket, None means all the images
+        '''
+        if self.augmenter is not None and self.augmenter.scale_range is not None:
+            print("[WARNING] rpn_target_cache with scale jitter: the scaled samples are never read from the cache")
+        self.rpn_target_cache = RpnTargetCache.load_or_build(self, image_ids)
 
     def gen_train_input_one(self, image_id):
         return self.dataset_coco.get_original_image(image_id=image_id)
 
-    def gen_train_target_anchor_boxreg_for_rpn(self, image_id, debuginfo=False):
-        bboxes = self.dataset_coco.get_original_bboxes_list(image_id=image_id)
-
-        # === resize ===
-
-        bboxes_ious = []  # for each gt_bbox calculate ious with candidates
-        for bbox in bboxes:
-            ious = BboxTools.ious(self.gen_candidate_anchors.anchor_candidates_list, bbox)
-            ious_temp = np.ones(shape=(len(ious)), dtype=np.float) * 0.5
-            # other author's implementations are use -1 to indicate ignoring, here use 0.5 to use max
-            ious_temp = np.where(np.asarray(ious) > self.threshold_iou_rpn, 1, ious_temp)
-            ious_temp = np.where(np.asarray(ious) < 0.3, 0, ious_temp)
-            ious_temp[np.argmax(ious)] = 1
-            bboxes_ious.append(ious_temp)
-
-        # for each candidate anchor, determine the anchor target
-        anchors_target = np.array(bboxes_ious)
-        anchors_target = np.max(anchors_target, axis=0)
-        anchors_target = np.reshape(anchors_target, newshape=(
-            self.gen_candidate_anchors.h, self.gen_candidate_anchors.w, self.gen_candidate_anchors.n_anchors))
+    def gen_train_sample_one(self, image_id, augmentation=None):
+        '''
+        image, gt boxes and sparse classes of image_id, augmented in memory if the generator has an augmenter
+        :param augmentation: Augmentation to reuse, None to sample a new one
+        :return: read only (H, W, 3) image, (n, 4) boxes (x1, y1, x2, y2), int64 (n,) sparse classes
+        '''
+        img, bboxes, sparse_targets, augmentation = self._train_sample(image_id, augmentation)
+        if self.augmenter is not None:
+            self.last_augmentation = augmentation
+        return img, bboxes, sparse_targets
+
+    def _train_sample(self, image_id, augmentation=None):
+        # gen_train_sample_one without setting last_augmentation, for the concurrent tf.data workers.
+        # the Augmentation is returned too, None without augmenter
+        img = self.gen_train_input_one(image_id)
+        bboxes = np.asarray(self.dataset_coco.get_original_bboxes_list(image_id=image_id)).reshape((-1, 4))
+        sparse_targets = np.asarray(self.dataset_coco.get_original_category_sparse_list(image_id=image_id),
+                                    dtype=np.int64)
+        if self.augmenter is not None and not (augmentation is not None and
+                                               RandomAugmenter.is_identity(augmentation)):
+            img, bboxes, sparse_targets, augmentation = self.augmenter.augment(img, bboxes, sparse_targets,
+                                                                              augmentation)
+        return img, bboxes, sparse_targets, augmentation
+
+    def rpn_target_cache_stats(self):
+        '''
+        counted in this process only, approximate with concurrent tf.data workers
+        :return: (hits, lookups) of the RpnTargetCache since the generator was built, (0, 0) without cache
+        '''
+        return self.rpn_target_cache_hits, self.rpn_target_cache_lookups
+
+    def gen_sparse_target_for_rpn(self, image_id, bboxes=None, augmentation=None):
+        '''
+        sparse RPN targets of one image, the indices are into anchor_candidates_flat (C order of shape_anchors).
+        Each background anchor is sampled with probability (n_foreground + rpn_n_background) / n_total_anchors,
+        same with the balance of the dense RPN._rpn_loss, the other anchors are not trained
+        :param bboxes: gt boxes of an augmented sample, None means the boxes of image_id
+        :return: foreground_indices int32 (p,), foreground_reg_targets float32 (p, 4),
+                 background_indices int32 (q,) sorted
+        '''
+        sparse = None
+        if self.rpn_target_cache is not None:
+            self.rpn_target_cache_lookups += 1
+            if RandomAugmenter.is_identity(augmentation):
+                sparse = self.rpn_target_cache.get_sparse(image_id)
+                self.rpn_target_cache_hits += sparse is not None
+        if sparse is None:
+            if bboxes is None:
+                bboxes = np.asarray(self.dataset_coco.get_original_bboxes_list(image_id=image_id)).reshape((-1, 4))
+            # only the anchors which overlap a gt box are matched, all the others are background
+            candidates, anchor_labels, _, anchor_reg_targets, _ = self.rpn_target_assigner.assign_sparse(
+                *self.anchor_spatial_index.sparse_ious(bboxes), self.gen_candidate_anchors.anchor_candidates_flat,
+                bboxes)
+            foreground = anchor_labels == 1
+            sparse = candidates[foreground], anchor_reg_targets[foreground], candidates[anchor_labels == 0.5]
+        foreground, reg_targets, ignore = sparse
+        selected = self.rng.random(self.n_total_anchors) < (len(foreground) + self.rpn_n_background) / \
+            self.n_total_anchors
+        selected[foreground] = False
+        selected[ignore] = False
+        return np.asarray(foreground, dtype=np.int32), np.asarray(reg_targets, dtype=np.float32), \
+            np.flatnonzero(selected).astype(np.int32)
+
+    def gen_train_target_anchor_boxreg_for_rpn(self, image_id, debuginfo=False, bboxes=None):
+        # bboxes: gt boxes of an augmented sample, None means the boxes of image_id
+        if bboxes is None:
+            bboxes = np.asarray(self.dataset_coco.get_original_bboxes_list(image_id=image_id)).reshape((-1, 4))
+
+        # for each candidate anchor, determine the anchor target and the box reg target in one pass
+        ious = self.anchor_spatial_index.ious_matrix(bboxes)
+        anchor_labels, _, anchor_reg_targets, _ = self.rpn_target_assigner.assign(
+            ious, self.gen_candidate_anchors.anchor_candidates_flat, bboxes)
+        anchors_target = anchor_labels.reshape(self.shape_anchors)
+        bbox_reg_target = anchor_reg_targets.reshape(self.shape_anchors + (4,))
         if debuginfo:
             print(f"[Debug INFO] Number of total gt bboxes :{len(bboxes)}")
             print(
@@ -66,129 +148,178 @@ class NnDataGenerator():
             print(f"[Debug INFO] Shape of anchors_target: {anchors_target.shape}")
             print(
                 f"[Debug INFO] Selected anchors: \n {self.gen_candidate_anchors.anchor_candidates[np.where(anchors_target == 1)]}")
-        # test
-        # self.anchor_generator.anchors_candidate[np.where(anchors_target==1)] = self.anchor_generator.anchors_candidate[np.where(anchors_target==1)] +100
-        # print(f"Selected anchors: \n {self.anchor_generator.anchors_candidate[np.where(anchors_target == 1)]}")
-
-        # for each gt_box, determine the box reg target
-        bbox_reg_target = np.zeros(
-            shape=(self.gen_candidate_anchors.h, self.gen_candidate_anchors.w, self.gen_candidate_anchors.n_anchors, 4),
-            dtype=np.float)
-        for index, bbox_ious in enumerate(bboxes_ious):
-            ious_temp = np.reshape(bbox_ious, newshape=(
-                self.gen_candidate_anchors.h, self.gen_candidate_anchors.w, self.gen_candidate_anchors.n_anchors))
-            gt_box = bboxes[index]
-            candidate_boxes = self.gen_candidate_anchors.anchor_candidates[np.where(ious_temp == 1)]
-            # print(candidate_boxes,gt_box)
-            box_reg = BboxTools.bbox_regression_target(candidate_boxes, gt_box)
-            # print(box_reg)
-            # print(bbox_tools.bbox_reg2truebox(candidate_boxes, box_reg))
-            bbox_reg_target[np.where(ious_temp == 1)] = box_reg
 
         return anchors_target, bbox_reg_target
 
     def gen_target_anchor_bboxes_classes_for_debug(self, image_id, debuginfo=False):
-        bboxes = self.dataset_coco.get_original_bboxes_list(image_id=image_id)
+        bboxes = np.asarray(self.dataset_coco.get_original_bboxes_list(image_id=image_id)).reshape((-1, 4))
         sparse_targets = self.dataset_coco.get_original_category_sparse_list(image_id=image_id)
 
-        bboxes_ious = []  # for each gt_bbox calculate ious with candidates
-        for bbox in bboxes:
-            ious = BboxTools.ious(self.gen_candidate_anchors.anchor_candidates_list, bbox)
-            ious_temp = np.ones(shape=(len(ious)), dtype=np.float) * 0.5
-            # other author's implementations are use -1 to indicate ignoring, here use 0.5 to use max
-            ious_temp = np.where(np.asarray(ious) > self.threshold_iou_rpn, 1, ious_temp)
-            ious_temp = np.where(np.asarray(ious) < 0.3, 0, ious_temp)
-            ious_temp[np.argmax(ious)] = 1
-            bboxes_ious.append(ious_temp)
-
-        # for each gt_box, determine the box reg target
-        target_anchor_bboxes = []
-        target_classes = []
-        for index, bbox_ious in enumerate(bboxes_ious):
-            ious_temp = np.reshape(bbox_ious, newshape=(
-                self.gen_candidate_anchors.h, self.gen_candidate_anchors.w, self.gen_candidate_anchors.n_anchors))
-            candidate_boxes = self.gen_candidate_anchors.anchor_candidates[np.where(ious_temp == 1)]
-            n = candidate_boxes.shape[0]
-            for i in range(n):
-                target_anchor_bboxes.append(candidate_boxes[i])
-                target_classes.append(sparse_targets[index])
+        ious = self.anchor_spatial_index.ious_matrix(bboxes)
+        anchor_labels, _, _, anchor_classes = self.rpn_target_assigner.assign(
+            ious, self.gen_candidate_anchors.anchor_candidates_flat, bboxes, sparse_targets)
+
+        # foreground anchors and the classes of their matched gt boxes
+        foreground = anchor_labels == 1
+        target_anchor_bboxes = list(self.gen_candidate_anchors.anchor_candidates_flat[foreground])
+        target_classes = anchor_classes[foreground].tolist()
         return target_anchor_bboxes, target_classes
 
-    def gen_train_data_rpn_one(self, image_id):
-        input1 = self.gen_train_input_one(image_id)
-        anchor_target, bbox_reg_target = self.gen_train_target_anchor_boxreg_for_rpn(image_id)
-        return np.array([input1]).astype(np.float), np.array([anchor_target]).astype(np.float), np.array(
-            [bbox_reg_target]).astype(np.float)
-
-    def gen_train_data_rpn_all(self):
-        inputs = []
-        anchor_targets = []
-        bbox_reg_targets = []
-        for image_id in self.dataset_coco.image_ids:
-            inputs.append(self.gen_train_input_one(image_id))
-            anchor_target, bbox_reg_target = self.gen_train_target_anchor_boxreg_for_rpn(image_id)
-            anchor_targets.append(anchor_target)
-            bbox_reg_targets.append(bbox_reg_target)
-        return np.array(inputs).astype(np.float), np.array(anchor_targets), np.array(bbox_reg_targets)
-
-    def gen_train_data_roi_one(self, image_id, bbox_list):
-        gt_bboxes = self.dataset_coco.get_original_bboxes_list(image_id=image_id)
-        sparse_targets = self.dataset_coco.get_original_category_sparse_list(image_id=image_id)
+    def gen_train_data_rpn_one(self, image_id, augmentation=None):
+        '''
+        :param augmentation: Augmentation to reuse, None to sample a new one, RandomAugmenter.IDENTITY for the
+                             original image (evaluation and debug images)
+        :return: image float32 (1, H, W, 3) and the sparse targets of gen_sparse_target_for_rpn with a batch axis
+        '''
+        input1, bboxes, _, augmentation = self._train_sample(image_id, augmentation)
+        if self.augmenter is not None:
+            self.last_augmentation = augmentation
+        foreground_indices, foreground_reg_targets, background_indices = self.gen_sparse_target_for_rpn(
+            image_id, bboxes, augmentation)
+        # batch of one image, the sparse targets are the inputs of RPN.train_step_*
+        return np.asarray(input1, dtype=np.float32)[np.newaxis], foreground_indices[np.newaxis], \
+            foreground_reg_targets[np.newaxis], background_indices[np.newaxis]
+
+    def gen_rpn_sample_one(self, image_id):
+        '''
+        RPN train sample without batch axis and with the uint8 image, for the concurrent loaders
+        (tf_dataset_rpn, SampleWorkerPool), last_augmentation is not set
+        :return: image uint8 (H, W, 3), and the sparse targets of gen_sparse_target_for_rpn
+        '''
+        img, bboxes, _, augmentation = self._train_sample(image_id)
+        return (np.ascontiguousarray(img, dtype=np.uint8),) + self.gen_sparse_target_for_rpn(image_id, bboxes,
+                                                                                           augmentation)
+
+    def gen_train_data_roi_one(self, image_id, bbox_list=None, augmentation=None):
+        '''
+        RoI train sample of one image, the image is given once for all its boxes
+        :param bbox_list: (N, 4) proposal boxes, None means all the candidate anchors
+        :param augmentation: the Augmentation of the image the proposals were predicted on, see last_augmentation
+        :return: input_image float32 (1, H, W, 3), boxes float32 (n, 4), classes int64 (n,),
+                 bbox_reg_target float32 (n, 4), box_indices int32 (n,) index of the image of each box, all 0
+        '''
+        original_img, gt_bboxes, sparse_targets = self.gen_train_sample_one(image_id, augmentation)
+        input_box_filtered_by_iou, target_classes, target_bbox_reg = self._roi_targets(gt_bboxes, sparse_targets,
+                                                                                       bbox_list)
+        input_image = original_img[np.newaxis].astype(np.float32)
+        box_indices = np.zeros(shape=input_box_filtered_by_iou.shape[0], dtype=np.int32)
+        return input_image, input_box_filtered_by_iou, target_classes, target_bbox_reg, box_indices
+
+    def gen_train_data_roi_batch(self, image_ids):
+        '''
+        RoI train samples of several images for one RoI train step, the boxes of all the images are concatenated
+        :return: input_image float32 (B, H, W, 3), boxes float32 (n, 4), classes int64 (n,),
+                 bbox_reg_target float32 (n, 4), box_indices int32 (n,) index of the image of each box in the batch
+        '''
+        images, boxes, classes, bbox_reg_targets, box_indices = [], [], [], [], []
+        for k, image_id in enumerate(image_ids):
+            img, gt_bboxes, sparse_targets, _ = self._train_sample(image_id)
+            image_boxes, image_classes, image_bbox_reg_target = self._roi_targets(gt_bboxes, sparse_targets)
+            images.append(img)
+            boxes.append(image_boxes)
+            classes.append(image_classes)
+            bbox_reg_targets.append(image_bbox_reg_target)
+            box_indices.append(np.full(shape=image_boxes.shape[0], fill_value=k, dtype=np.int32))
+        return np.stack(images).astype(np.float32), np.concatenate(boxes), np.concatenate(classes), \
+            np.concatenate(bbox_reg_targets), np.concatenate(box_indices)
 
-        bboxes_ious = []  # for each gt_bbox calculate ious with candidates
-        for bbox in gt_bboxes:
-            ious = BboxTools.ious(bbox_list, bbox)
-            ious_temp = np.zeros(shape=(len(ious)), dtype=np.float)
-            # other author's implementations are use -1 to indicate ignoring, here use 0.5 to use max
-            ious_temp = np.where(np.asarray(ious) > self.threshold_iou_roi, 1, ious_temp)
-            ious_temp[np.argmax(ious)] = 1
-            bboxes_ious.append(ious_temp)
-
-        # for each gt_box, determine the box reg target
-        original_img = self.gen_train_input_one(image_id)
-        input_images = []
-        input_box_filtered_by_iou = []
-        target_classes = []
-        target_bbox_reg = []
-        for index_gt, bbox_ious in enumerate(bboxes_ious):
-            candidate_boxes = np.asarray(bbox_list)[np.where(bbox_ious == 1)]
-            n = candidate_boxes.shape[0]
-            for i in range(n):
-                input_box_filtered_by_iou.append(candidate_boxes[i].astype(np.float))
-                box_reg = BboxTools.bbox_regression_target(pred_boxes=candidate_boxes[i].reshape((1, 4)),
-                                                           gt_box=gt_bboxes[index_gt])
-                target_bbox_reg.append(box_reg.ravel())
-                target_classes.append(sparse_targets[index_gt])
-                input_images.append(original_img.astype(np.float))
-        for index_gt, bbox_gt in enumerate(gt_bboxes):
-            input_images.append(original_img.astype(np.float))
-            input_box_filtered_by_iou.append(bbox_gt.astype(np.float))
-            target_classes.append(sparse_targets[index_gt])
-            target_bbox_reg.append(np.array([0, 0, 0, 0], dtype=np.float))
-        return np.asarray(input_images).astype(
-            np.float), np.asarray(input_box_filtered_by_iou), np.asarray(target_classes), np.asarray(
-            target_bbox_reg)
+    def _roi_targets(self, gt_bboxes, sparse_targets, bbox_list=None):
+        if bbox_list is None:
+            bbox_list = self.gen_candidate_anchors.anchor_candidates_flat
+            ious = self.anchor_spatial_index.ious_matrix(gt_bboxes)
+        else:
+            bbox_list = np.asarray(bbox_list, dtype=np.float32).reshape((-1, 4))
+            ious = BboxTools.ious_matrix(bbox_list, gt_bboxes)
+        box_labels, _, box_reg_targets, box_classes = self.roi_target_assigner.assign(
+            ious, bbox_list, gt_bboxes, sparse_targets)
+
+        # foreground boxes with their targets, then the gt boxes themselves with reg target 0
+        foreground = np.flatnonzero(box_labels == 1)
+        input_box_filtered_by_iou = np.concatenate([bbox_list[foreground], gt_bboxes]).astype(np.float32)
+        target_classes = np.concatenate([box_classes[foreground], sparse_targets]).astype(np.int64)
+        target_bbox_reg = np.concatenate([box_reg_targets[foreground],
+                                          np.zeros(shape=gt_bboxes.shape, dtype=np.float32)])
+        return input_box_filtered_by_iou, target_classes, target_bbox_reg
+
+    # --- tf.data pipelines ---
+    # The samples are generated by the numpy code above in tf.data map workers (tf.numpy_function), so decoding,
+    # augmentation and target assignment of the next samples overlap with the train steps.
+    # The images cross the numpy boundary as uint8 and are cast to float32 in the graph.
+    # last_augmentation is not meaningful with these datasets, the samples are made concurrently.
+    def _image_id_dataset(self, image_ids, shuffle: bool, seed: int):
+        image_ids = list(self.dataset_coco.image_ids if image_ids is None else image_ids)
+        indices = tf.data.Dataset.range(len(image_ids))
+        if shuffle:
+            indices = indices.shuffle(buffer_size=max(len(image_ids), 1), seed=seed, reshuffle_each_iteration=True)
+        return image_ids, indices
+
+    def tf_dataset_rpn(self, batch_size: int = 1, shuffle: bool = True, seed: int = None, image_ids: list = None):
+        '''
+        one epoch of RPN train samples, iterate it again for the next epoch (reshuffled)
+        :param image_ids: None means all the images of the dataset
+        :return: tf.data.Dataset of (image uint8 (B, H, W, 3), foreground_indices int32 (B, p),
+                 foreground_reg_targets float32 (B, p, 4), background_indices int32 (B, q)), the sparse targets of
+                 gen_sparse_target_for_rpn padded to the longest of the batch with index -1.
+                 The last incomplete batch is kept, an epoch of fewer images than batch_size is one batch
+        '''
+        image_ids, indices = self._image_id_dataset(image_ids, shuffle, seed)
+
+        def sample(index):
+            return self.gen_rpn_sample_one(image_ids[int(index)])
+
+        def map_fn(index):
+            img, foreground_indices, foreground_reg_targets, background_indices = tf.numpy_function(
+                sample, [index], [tf.uint8, tf.int32, tf.float32, tf.int32])
+            img.set_shape(self.img_shape_resize[:2] + (3,))
+            foreground_indices.set_shape((None,))
+            foreground_reg_targets.set_shape((None, 4))
+            background_indices.set_shape((None,))
+            # kept uint8, RPN.train_step_header casts in the graph
+            return img, foreground_indices, foreground_reg_targets, background_indices
+
+        dataset = indices.map(map_fn, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+        dataset = dataset.padded_batch(batch_size,
+                                       padded_shapes=(self.img_shape_resize[:2] + (3,), (None,), (None, 4), (None,)),
+                                       padding_values=(tf.constant(0, tf.uint8), -1, 0.0, -1),
+                                       drop_remainder=False)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def tf_dataset_roi(self, shuffle: bool = True, seed: int = None, image_ids: list = None):
+        '''
+        one epoch of RoI train samples against all the candidate anchors, one image per element,
+        the RoI header takes the boxes of one image
+        :return: tf.data.Dataset of (image float32 (1, H, W, 3), boxes float32 (n, 4), classes int64 (n,),
+                 bbox_reg_target float32 (n, 4), box_indices int32 (n,)), same with gen_train_data_roi_one
+        '''
+        image_ids, indices = self._image_id_dataset(image_ids, shuffle, seed)
+
+        def sample(index):
+            img, gt_bboxes, sparse_targets, _ = self._train_sample(image_ids[int(index)])
+            boxes, classes, bbox_reg_target = self._roi_targets(gt_bboxes, sparse_targets)
+            return np.ascontiguousarray(img, dtype=np.uint8), boxes, classes, bbox_reg_target
+
+        def map_fn(index):
+            img, boxes, classes, bbox_reg_target = tf.numpy_function(sample, [index],
+                                                                     [tf.uint8, tf.float32, tf.int64, tf.float32])
+            img.set_shape(self.img_shape_resize[:2] + (3,))
+            boxes.set_shape((None, 4))
+            classes.set_shape((None,))
+            bbox_reg_target.set_shape((None, 4))
+            box_indices = tf.zeros(shape=tf.shape(boxes)[:1], dtype=tf.int32)
+            return tf.cast(img, tf.float32)[tf.newaxis], boxes, classes, bbox_reg_target, box_indices
+
+        dataset = indices.map(map_fn, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+        return dataset.prefetch(tf.data.AUTOTUNE)
 
     def _validate_bbox(self, image_id, bboxes):
-        img1 = self.dataset_coco.get_original_image(image_id=image_id)
-        for bbox in bboxes:
-            color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-            img1 = cv.rectangle(img1, (bbox[1], bbox[0]), (bbox[3], bbox[2]), color, 4)
-        plt.imshow(img1)
-        plt.show()
+        img1 = self.dataset_coco.renderer.render(self.dataset_coco.get_original_image(image_id=image_id), bboxes,
+                                                 thickness=4)
+        VisualRenderer.show(img1, f'{image_id}')
 
     def _validata_masks(self, image_id):
         img1 = self.dataset_coco.get_original_image(image_id=image_id)
-        temp_img = np.zeros(shape=img1.shape, dtype=np.uint8)
-        masks = self.dataset_coco.get_original_segms_mask_list(image_id=image_id)
-        for mask in masks:
-            color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-            temp_img[:, :, 0][mask.astype(bool)] = color[0]
-            temp_img[:, :, 1][mask.astype(bool)] = color[1]
-            temp_img[:, :, 2][mask.astype(bool)] = color[2]
-        img1 = (img1 * 0.5 + temp_img * 0.5).astype(np.uint8)
-        plt.imshow(img1, cmap='gray')
-        plt.show()
+        masks, _ = self.dataset_coco.get_segm_mask_from_anno_coco(None, image_id)
+        VisualRenderer.show(self.dataset_coco.renderer.render(img1, masks=masks), f'{image_id}')
 
 
 def test2():
@@ -215,19 +346,11 @@ def test():
     print(data1.images)
     bboxes = data1.get_original_bboxes_list(image_id=image_id)
     print(bboxes)
-    # img1 = np.zeros(shape=(720,1280,3), dtype=np.uint8)
-    for bbox in bboxes:
-        color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-        # cv.rectangle(img1,(bbox[0],bbox[1]), (bbox[2],bbox[3]), 255)
-        # print(bbox)
-        # cv.rectangle(img=img1,rec=(bbox[1],bbox[0],bbox[3]-bbox[1],bbox[2]-bbox[0]), color=color, thickness=4)
-        cv.rectangle(img1, (bbox[1], bbox[0]), (bbox[3], bbox[2]), color, 4)
-    plt.imshow(img1)
-    plt.show()
+    VisualRenderer.show(data1.renderer.render(img1, bboxes, thickness=4))
 
     g1 = GenCandidateAnchors()
-    print(len(g1.anchor_candidates_list))
-    ious = BboxTools.ious(g1.anchor_candidates_list, bboxes[0])
+    print(len(g1.anchor_candidates_flat))
+    ious = BboxTools.ious_matrix(g1.anchor_candidates_flat, bboxes[:1])[:, 0]
     ious[np.argmax(ious)] = 1
     print(len(ious))
     ious_np = np.reshape(ious, newshape=(23, 40, 9))
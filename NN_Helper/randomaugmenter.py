@@ -0,0 +1,130 @@
+import collections
+
+import cv2
+import numpy as np
+
+# flip_axes: flipped numpy axes of the image, 0: rows (upside down), 1: columns (mirror)
+# scale: zoom factor of the image content, the output keeps the input shape
+# shift: (row, column) translation after the zoom, the content is cropped (scale > 1) or padded (scale < 1)
+Augmentation = collections.namedtuple('Augmentation', ['flip_axes', 'scale', 'shift'])
+
+
+class RandomAugmenter:
+    # Random flip and scale jitter of one training sample, applied in memory to the decoded image and its
+    # boxes before the target assignment, nothing is written to disk.
+    # All the transforms are u' = a * u + b per axis in continuous coordinates (pixel row r covers [r, r + 1)),
+    # so the image and the boxes of a sample always stay aligned.
+    # A flip only is a view of the image (np.flip), flip and scale are one cv2.warpAffine to the output shape.
+    # no flip and no scale, pass it as the augmentation of a sample to get the original image and boxes
+    IDENTITY = Augmentation(flip_axes=(), scale=1.0, shift=(0.0, 0.0))
+
+    def __init__(self,
+                 flip_horizontal: float = 0.5,
+                 flip_vertical: float = 0.0,
+                 scale_range: tuple = None,
+                 min_box_size: float = 2,
+                 seed: int = None):
+        '''
+        :param flip_horizontal: probability of mirroring the columns
+        :param flip_vertical: probability of flipping the rows
+        :param scale_range: (min, max) of the uniform zoom factor, None for no scale jitter
+        :param min_box_size: boxes cropped to less than this height or width are dropped
+        :param seed: seed of the random generator, None for a random seed
+        '''
+        self.flip_horizontal = flip_horizontal
+        self.flip_vertical = flip_vertical
+        self.scale_range = scale_range
+        self.min_box_size = min_box_size
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self, image_shape):
+        '''
+        :param image_shape: (H, W, ...) of the image to augment
+        :return: random Augmentation
+        '''
+        flip_axes = ()
+        if self.rng.random() < self.flip_vertical:
+            flip_axes += (0,)
+        if self.rng.random() < self.flip_horizontal:
+            flip_axes += (1,)
+        scale = 1.0
+        if self.scale_range is not None:
+            scale = float(self.rng.uniform(self.scale_range[0], self.scale_range[1]))
+        shift = []
+        for size in image_shape[:2]:
+            margin = size - size * scale
+            # crop at a random offset if zoomed in, paste at a random offset if zoomed out
+            shift.append(float(self.rng.uniform(min(margin, 0), max(margin, 0))))
+        return Augmentation(flip_axes, scale, tuple(shift))
+
+    @classmethod
+    def is_identity(cls, augmentation: Augmentation):
+        # None means not augmented
+        return augmentation is None or (not augmentation.flip_axes and augmentation.scale == 1.0 and
+                                        augmentation.shift == (0.0, 0.0))
+
+    @classmethod
+    def _affine(cls, augmentation: Augmentation, image_shape):
+        # (a, b) of u' = a * u + b for the rows and the columns
+        coefficients = []
+        for axis, size in enumerate(image_shape[:2]):
+            a, b = augmentation.scale, augmentation.shift[axis]
+            if axis in augmentation.flip_axes:
+                a, b = -a, b + augmentation.scale * size
+            coefficients.append((a, b))
+        return coefficients
+
+    def augment_image(self, image, augmentation: Augmentation):
+        '''
+        :param image: (H, W, C) image, may be read only
+        :return: (H, W, C) augmented image, a read only view of image if there is no scale jitter
+        '''
+        if augmentation.scale == 1.0 and augmentation.shift == (0.0, 0.0):
+            return np.flip(image, axis=augmentation.flip_axes) if augmentation.flip_axes else image
+        (a_row, b_row), (a_col, b_col) = self._affine(augmentation, image.shape)
+        # the pixel centers are at u + 0.5: c' = a * c + (a * 0.5 + b - 0.5), opencv matrix is (column, row)
+        matrix = np.array([[a_col, 0, a_col * 0.5 + b_col - 0.5],
+                           [0, a_row, a_row * 0.5 + b_row - 0.5]], dtype=np.float64)
+        return cv2.warpAffine(np.ascontiguousarray(image), matrix, (image.shape[1], image.shape[0]),
+                              flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def augment_bboxes(self, bboxes, augmentation: Augmentation, image_shape):
+        '''
+        :param bboxes: (n, 4) boxes (x1, y1, x2, y2), x2 and y2 inclusive (the +1 area convention)
+        :param image_shape: (H, W, ...) of the image of the boxes
+        :return: (k, 4) augmented boxes clipped to the image, same dtype, and the (k,) indices of the kept boxes
+        '''
+        bboxes = np.asarray(bboxes).reshape((-1, 4))
+        (a_row, b_row), (a_col, b_col) = self._affine(augmentation, image_shape)
+        # inclusive box -> continuous edges [x1, x2 + 1), transformed, sorted again after a flip
+        edges = bboxes.astype(np.float64) + [0, 0, 1, 1]
+        rows = edges[:, [0, 2]] * a_row + b_row
+        cols = edges[:, [1, 3]] * a_col + b_col
+        rows.sort(axis=1)
+        cols.sort(axis=1)
+        # only the boxes made smaller than min_box_size by the crop are dropped, not the ones already small
+        min_rows = np.minimum(rows[:, 1] - rows[:, 0], self.min_box_size)
+        min_cols = np.minimum(cols[:, 1] - cols[:, 0], self.min_box_size)
+        np.clip(rows, 0, image_shape[0], out=rows)
+        np.clip(cols, 0, image_shape[1], out=cols)
+        keep = np.flatnonzero((rows[:, 1] - rows[:, 0] >= min_rows) & (cols[:, 1] - cols[:, 0] >= min_cols) &
+                              (rows[:, 1] > rows[:, 0]) & (cols[:, 1] > cols[:, 0]))
+        out = np.stack([rows[:, 0], cols[:, 0], rows[:, 1] - 1, cols[:, 1] - 1], axis=1)[keep]
+        if np.issubdtype(bboxes.dtype, np.integer):
+            out = np.round(out)
+        return out.astype(bboxes.dtype), keep
+
+    def augment(self, image, bboxes, classes, augmentation: Augmentation = None):
+        '''
+        augment one sample. A random scale jitter which would crop out every box is replaced by the flip only
+        :param augmentation: reuse an earlier Augmentation, None to sample a new one
+        :return: image, bboxes, classes (the ones of the dropped boxes are removed), the used Augmentation
+        '''
+        if augmentation is None:
+            augmentation = self.sample(image.shape)
+        out_bboxes, keep = self.augment_bboxes(bboxes, augmentation, image.shape)
+        if keep.size == 0 and len(bboxes) > 0:
+            augmentation = Augmentation(augmentation.flip_axes, 1.0, (0.0, 0.0))
+            out_bboxes, keep = self.augment_bboxes(bboxes, augmentation, image.shape)
+        out_classes = np.asarray(classes)[keep]
+        return self.augment_image(image, augmentation), out_bboxes, out_classes, augmentation
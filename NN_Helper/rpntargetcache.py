@@ -0,0 +1,164 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from NN_Helper import AnchorSpatialIndex, TargetAssigner
+
+
+class RpnTargetCache:
+    # On disk cache of the RPN targets of every image of a dataset, one folder of .npy arrays loaded with mmap.
+    # The targets only depend on the anchors, the iou thresholds and the resized boxes, so the folder name has
+    # a hash of all of them (and of the size and mtime of the json file): any change gives a new folder,
+    # the stale ones of the same resized shape and images are removed when the new one is built. The caches of the
+    # other shapes and image sets (the AspectBuckets generators on the same json) are kept.
+    # Sparse: only the foreground anchors (label 1, with their regression rows) and the ignored anchors
+    # (label 0.5) are stored, every other anchor is background with regression target 0.
+    # The targets of image k are foreground_indices[foreground_offsets[k]:foreground_offsets[k + 1]] (indices into
+    # anchor_candidates_flat) with the rows of foreground_reg_targets, and the same slice of ignore_* arrays.
+    VERSION = 1
+    ARRAYS = ('foreground_offsets', 'foreground_indices', 'foreground_reg_targets', 'ignore_offsets',
+              'ignore_indices')
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        with open(f"{cache_dir}/meta.json", 'r') as f:
+            self.meta = json.load(f)
+        self.image_ids = self.meta['image_ids']
+        self.image_id2row = {image_id: row for row, image_id in enumerate(self.image_ids)}
+        self.n_total_anchors = self.meta['n_total_anchors']
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(f"{cache_dir}/{name}.npy", mmap_mode='r'))
+
+    @classmethod
+    def key(cls, gen_candidate_anchors, target_assigner: TargetAssigner, json_file: str, resized_shape):
+        # the anchor arrays cover the base size, ratios, scales, stages and image shape of the anchor config
+        stat = os.stat(json_file)
+        sha = hashlib.sha1()
+        sha.update(np.ascontiguousarray(gen_candidate_anchors.anchor_candidates_flat).tobytes())
+        sha.update(json.dumps({
+            'version': cls.VERSION,
+            'anchor_grid': [gen_candidate_anchors.h, gen_candidate_anchors.w, gen_candidate_anchors.n_anchors],
+            'positive_threshold': target_assigner.positive_threshold,
+            'negative_threshold': target_assigner.negative_threshold,
+            'resized_shape': list(resized_shape[:2]) if resized_shape is not None else None,
+            'json_size': stat.st_size,
+            'json_mtime_ns': stat.st_mtime_ns,
+        }, sort_keys=True).encode())
+        return sha.hexdigest()[:16]
+
+    @classmethod
+    def images_key(cls, image_ids: list):
+        return hashlib.sha1(json.dumps(list(image_ids)).encode()).hexdigest()[:8]
+
+    @classmethod
+    def cache_dir_for(cls, json_file: str, resized_shape, images_key: str, key: str):
+        # same shape suffix with the AnnotationCache folders
+        suffix = f"{resized_shape[0]}x{resized_shape[1]}" if resized_shape is not None else 'original'
+        return f"{json_file}.rpn_targets_{suffix}_{images_key}_{key}"
+
+    @classmethod
+    def load_or_build(cls, generator, image_ids: list = None, n_processes: int = None, images_per_task: int = 64):
+        '''
+        :param generator: NnDataGenerator, the source of the anchors, the assigner and the gt boxes
+        :param image_ids: the images to cache, None means all the images of the dataset. They are part of the key
+        :param n_processes: processes of the pool filling the cache, None means os.cpu_count()
+        :return: RpnTargetCache of the current config, built if there is none
+        '''
+        coco_tools = generator.dataset_coco
+        json_file = coco_tools.file
+        resized_shape = generator.img_shape_resize
+        image_ids = list(coco_tools.image_ids if image_ids is None else image_ids)
+        images_key = cls.images_key(image_ids)
+        cache_dir = cls.cache_dir_for(json_file, resized_shape, images_key,
+                                      cls.key(generator.gen_candidate_anchors, generator.rpn_target_assigner,
+                                              json_file, resized_shape))
+        if os.path.exists(f"{cache_dir}/meta.json"):
+            return cls(cache_dir)
+        # stale caches of other configs or older annotations with the same resized shape and images, and the
+        # folders of the former namings rpn_targets_<key> and rpn_targets_<shape>_<key>
+        folder, prefix = os.path.split(cls.cache_dir_for(json_file, resized_shape, images_key, ''))
+        base_prefix = os.path.basename(f"{json_file}.rpn_targets_")
+        for name in os.listdir(folder or '.'):
+            path = os.path.join(folder, name)
+            former = name.startswith(base_prefix) and name[len(base_prefix):].count('_') < 2
+            if (name.startswith(prefix) or former) and path != cache_dir:
+                shutil.rmtree(path, ignore_errors=True)
+
+        tasks = []
+        for start in range(0, len(image_ids), images_per_task):
+            tasks.append([np.asarray(coco_tools.get_original_bboxes_list(image_id)).reshape((-1, 4))
+                          for image_id in image_ids[start:start + images_per_task]])
+        foreground_indices, foreground_reg_targets, ignore_indices = [], [], []
+        # spawned like the SampleWorkerPool processes, the models (and the tensorflow threads) may already be built
+        with ProcessPoolExecutor(max_workers=n_processes, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(generator.gen_candidate_anchors, generator.rpn_target_assigner)) as pool:
+            for results in pool.map(_assign_chunk, tasks):
+                for foreground, reg_targets, ignore in results:
+                    foreground_indices.append(foreground)
+                    foreground_reg_targets.append(reg_targets)
+                    ignore_indices.append(ignore)
+        arrays = {
+            'foreground_offsets': _offsets(foreground_indices),
+            'foreground_indices': np.concatenate(foreground_indices or [np.zeros(0, np.int32)]),
+            'foreground_reg_targets': np.concatenate(foreground_reg_targets or [np.zeros((0, 4), np.float32)]),
+            'ignore_offsets': _offsets(ignore_indices),
+            'ignore_indices': np.concatenate(ignore_indices or [np.zeros(0, np.int32)]),
+        }
+        # written to a temporary folder and renamed, an interrupted build leaves no partial cache
+        tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(f"{tmp_dir}/{name}.npy", array)
+        with open(f"{tmp_dir}/meta.json", 'w') as f:
+            json.dump({'version': cls.VERSION, 'image_ids': image_ids,
+                       'n_total_anchors': int(generator.gen_candidate_anchors.anchor_candidates_flat.shape[0])}, f)
+        os.replace(tmp_dir, cache_dir)
+        return cls(cache_dir)
+
+    def get_sparse(self, image_id):
+        '''
+        :return: foreground_indices int32 (p,), foreground_reg_targets float32 (p, 4), ignore_indices int32 (q,),
+                 read only views into the cache. None if image_id is not cached
+        '''
+        row = self.image_id2row.get(image_id)
+        if row is None:
+            return None
+        foreground = slice(self.foreground_offsets[row], self.foreground_offsets[row + 1])
+        ignore = slice(self.ignore_offsets[row], self.ignore_offsets[row + 1])
+        return self.foreground_indices[foreground], self.foreground_reg_targets[foreground], \
+            self.ignore_indices[ignore]
+
+
+def _offsets(chunks):
+    offsets = np.zeros(shape=len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+    return offsets
+
+
+# --- worker process ---
+_worker = {}
+
+
+def _init_worker(gen_candidate_anchors, target_assigner):
+    _worker['anchors'] = gen_candidate_anchors.anchor_candidates_flat
+    _worker['index'] = AnchorSpatialIndex(gen_candidate_anchors)
+    _worker['assigner'] = target_assigner
+
+
+def _assign_chunk(bboxes_list):
+    # sparse RPN targets of a chunk of images, same assignment with gen_train_target_anchor_boxreg_for_rpn
+    results = []
+    for bboxes in bboxes_list:
+        candidates, labels, _, reg_targets, _ = _worker['assigner'].assign_sparse(
+            *_worker['index'].sparse_ious(bboxes), _worker['anchors'], bboxes)
+        foreground = labels == 1
+        results.append((candidates[foreground].astype(np.int32), reg_targets[foreground],
+                        candidates[labels == 0.5].astype(np.int32)))
+    return results
@@ -0,0 +1,315 @@
+import math
+import multiprocessing
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SampleWorkerPool:
+    # RPN train samples made by n_workers processes, each one runs its own NnDataGenerator over a shard of the
+    # image ids (image i goes to worker i % n_workers), so the decoding, resizing and target assignment never hold
+    # the GIL of the training process.
+    # Each worker owns a ring of queue_depth slots in one SharedMemory block, a slot holds a whole batch: the worker
+    # writes batch_size samples of its shard into a free slot, the sparse targets padded with -1 in place, and sends
+    # only (worker, slot, image_ids, lengths) to the trainer, which reads the batch in place as contiguous arrays.
+    # The slot is given back to its worker when the trainer asks for the next batch, so the yielded arrays are only
+    # valid until then. A worker waits when all its slots are held, queue_depth bounds the batches made in advance.
+    # The processes are spawned, the training process may already run tensorflow. Build the RpnTargetCache of the
+    # config (NnDataGenerator with rpn_target_cache) before starting the pool, the workers only load it.
+    def __init__(self,
+                 generator_kwargs: dict,
+                 image_ids: list,
+                 n_workers: int = 4,
+                 queue_depth: int = 4,
+                 n_epochs: int = None,
+                 seed: int = None,
+                 batch_size: int = 1):
+        '''
+        :param generator_kwargs: arguments of the NnDataGenerator of each worker
+        :param image_ids: the image ids to sample, shuffled every epoch in each shard
+        :param queue_depth: slots (batches) of the ring buffer of each worker
+        :param n_epochs: epochs over its shard of each worker, None for no end
+        :param seed: augmentation, background sampling and shuffling of worker w use the seeds (seed, w, ...),
+                     None for random seeds
+        :param batch_size: samples of a batch, the last batch of each epoch of a shard may be incomplete
+        '''
+        self.generator_kwargs = generator_kwargs
+        self.image_ids = list(image_ids)
+        self.n_workers = n_workers
+        self.queue_depth = queue_depth
+        self.n_epochs = n_epochs
+        self.seed = seed
+        self.batch_size = batch_size
+        img_shape = tuple(generator_kwargs.get('img_shape_resize', (800, 1333, 3)))
+        self.layout = self.slot_layout(img_shape[:2], self._n_total_anchors(generator_kwargs, img_shape), batch_size)
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = []
+        self._shms = []
+        self._arrays = []
+        self._free_slots = []
+        self._ready = None
+        self._stop = None
+        self._counters = None
+        self._held = None
+        self._n_running = 0
+        self._start_time = None
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def _n_total_anchors(cls, generator_kwargs: dict, img_shape):
+        # same anchors with the NnDataGenerator of the workers, without loading the dataset here
+        from NN_Helper import GenCandidateAnchors
+        anchors = GenCandidateAnchors(base_size=generator_kwargs['anchor_base_size'],
+                                      ratios=generator_kwargs['ratios'], scales=generator_kwargs['scales'],
+                                      img_shape=img_shape, n_stage=generator_kwargs.get('n_stage', 5),
+                                      n_anchors=generator_kwargs['n_anchors'])
+        return anchors.h * anchors.w * anchors.n_anchors
+
+    @classmethod
+    def slot_layout(cls, img_hw, n_total_anchors: int, batch_size: int = 1):
+        # (name, shape, dtype) of the arrays of one slot. The sparse targets of an image are never longer than the
+        # anchors, a padded batch of them (B, p) is written flat at the start of its array
+        return [('image', (batch_size,) + tuple(img_hw) + (3,), np.uint8),
+                ('foreground_indices', (batch_size * n_total_anchors,), np.int32),
+                ('foreground_reg_targets', (batch_size * n_total_anchors, 4), np.float32),
+                ('background_indices', (batch_size * n_total_anchors,), np.int32)]
+
+    @classmethod
+    def ring_arrays(cls, buffer, layout, queue_depth: int):
+        # numpy arrays of shape (queue_depth,) + shape over buffer, each one 64 bytes aligned
+        arrays = {}
+        offset = 0
+        for name, shape, dtype in layout:
+            shape = (queue_depth,) + tuple(shape)
+            arrays[name] = np.ndarray(shape=shape, dtype=dtype, buffer=buffer, offset=offset)
+            offset += cls._aligned_bytes(shape, dtype)
+        return arrays
+
+    @classmethod
+    def ring_bytes(cls, layout, queue_depth: int):
+        return sum(cls._aligned_bytes((queue_depth,) + tuple(shape), dtype) for _, shape, dtype in layout)
+
+    @classmethod
+    def _aligned_bytes(cls, shape, dtype):
+        return -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 64) * 64
+
+    def start(self):
+        if self._processes:
+            return self
+        n_bytes = self.ring_bytes(self.layout, self.queue_depth)
+        self._ready = self._context.Queue()
+        self._stop = self._context.Event()
+        self._counters = self._context.RawArray('q', self.n_workers)
+        for worker in range(self.n_workers):
+            shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+            self._shms.append(shm)
+            self._arrays.append(self.ring_arrays(shm.buf, self.layout, self.queue_depth))
+            free_slots = self._context.Queue()
+            for slot in range(self.queue_depth):
+                free_slots.put(slot)
+            self._free_slots.append(free_slots)
+            process = self._context.Process(
+                target=_worker_main, name=f"SampleWorker{worker}", daemon=True,
+                args=(worker, self.generator_kwargs, self.image_ids[worker::self.n_workers], self.n_epochs,
+                      self.seed, self.batch_size, shm.name, self.layout, self.queue_depth, free_slots, self._ready,
+                      self._stop, self._counters))
+            process.start()
+            self._processes.append(process)
+        self._n_running = self.n_workers
+        self._start_time = time.time()
+        return self
+
+    def __iter__(self):
+        '''
+        batches in the order they are finished, until every worker has done its n_epochs. The sparse targets are
+        padded to the longest of the batch with index -1 (regression rows 0) like NnDataGenerator.tf_dataset_rpn
+        :return: iterator of (image_ids, images uint8 (B, H, W, 3), foreground_indices int32 (B, p),
+                 foreground_reg_targets float32 (B, p, 4), background_indices int32 (B, q)), read only contiguous
+                 views into the shared memory, valid until the next batch is requested
+        '''
+        self.start()
+        while True:
+            self._release()
+            if self._n_running == 0:
+                return
+            message = self._next_message()
+            kind, worker = message[0], message[1]
+            if kind == 'done':
+                self._n_running -= 1
+                continue
+            if kind == 'error':
+                self.close()
+                raise RuntimeError(f"sample worker {worker} failed:\n{message[2]}")
+            _, _, slot, image_ids, n_foreground, n_background = message
+            self._held = (worker, slot)
+            batch = self.batch_views(self._arrays[worker], slot, len(image_ids), n_foreground, n_background)
+            for array in batch:
+                array.flags.writeable = False
+            yield (image_ids,) + batch
+
+    def batches_per_epoch(self):
+        # batches of one epoch over all the shards, the last batch of each shard incomplete
+        return sum(math.ceil(len(self.image_ids[worker::self.n_workers]) / self.batch_size)
+                   for worker in range(self.n_workers))
+
+    @classmethod
+    def batch_views(cls, arrays, slot: int, n_images: int, n_foreground: int, n_background: int):
+        # the padded batch of a slot, the flat targets reshaped without copy
+        return (arrays['image'][slot, :n_images],
+                arrays['foreground_indices'][slot, :n_images * n_foreground].reshape((n_images, n_foreground)),
+                arrays['foreground_reg_targets'][slot, :n_images * n_foreground].reshape((n_images, n_foreground, 4)),
+                arrays['background_indices'][slot, :n_images * n_background].reshape((n_images, n_background)))
+
+    def _next_message(self):
+        t = time.time()
+        while True:
+            try:
+                message = self._ready.get(timeout=1.0)
+                break
+            except queue.Empty:
+                # a worker killed by the os never sends done
+                for worker, process in enumerate(self._processes):
+                    if not process.is_alive() and process.exitcode != 0:
+                        self.close()
+                        raise RuntimeError(f"sample worker {worker} died with exit code {process.exitcode}")
+        self.wait_seconds += time.time() - t
+        return message
+
+    def _release(self):
+        if self._held is not None:
+            worker, slot = self._held
+            self._held = None
+            self._free_slots[worker].put(slot)
+
+    def throughput(self):
+        '''
+        :return: list of (samples made, samples per second since start) of each worker
+        '''
+        if self._counters is None:
+            return []
+        elapsed = max(time.time() - self._start_time, 1e-9)
+        return [(int(n), n / elapsed) for n in self._counters]
+
+    def close(self, timeout: float = 10.0):
+        # stop the workers, the ones not exited after timeout are terminated, then free the shared memory
+        if not getattr(self, '_processes', None):
+            return
+        self._held = None
+        self._stop.set()
+        deadline = time.time() + timeout
+        while any(process.is_alive() for process in self._processes) and time.time() < deadline:
+            # drain the messages, a worker exits only after its queue feeder flushed them
+            try:
+                self._ready.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for q in self._free_slots + [self._ready]:
+            q.close()
+            q.cancel_join_thread()
+        self._arrays = []
+        for shm in self._shms:
+            try:
+                shm.close()
+            except BufferError:
+                # samples still referenced by the caller, the mapping is freed with them
+                pass
+            shm.unlink()
+        self._processes, self._shms, self._free_slots = [], [], []
+        self._n_running = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+# --- worker process ---
+def _worker_main(worker, generator_kwargs, image_ids, n_epochs, seed, batch_size, shm_name, layout, queue_depth,
+                 free_slots, ready, stop, counters):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    arrays = None
+    try:
+        from NN_Helper import NnDataGenerator
+        arrays = SampleWorkerPool.ring_arrays(shm.buf, layout, queue_depth)
+        generator = NnDataGenerator(**generator_kwargs)
+        # independent random streams of the workers
+        seeds = np.random.SeedSequence(None if seed is None else [seed, worker]).spawn(3)
+        generator.rng = np.random.default_rng(seeds[0])
+        if generator.augmenter is not None:
+            generator.augmenter.rng = np.random.default_rng(seeds[1])
+        rng = np.random.default_rng(seeds[2])
+        epoch = 0
+        while n_epochs is None or epoch < n_epochs:
+            order = rng.permutation(len(image_ids)).tolist()
+            for start in range(0, len(order), batch_size):
+                batch_image_ids = [image_ids[i] for i in order[start:start + batch_size]]
+                slot = _free_slot(free_slots, stop)
+                if slot is None:
+                    return
+                # the images go straight into the slot, the short sparse targets are padded once the batch is done
+                foregrounds, reg_targets, backgrounds = [], [], []
+                for k, image_id in enumerate(batch_image_ids):
+                    image, foreground, foreground_reg_targets, background = generator.gen_rpn_sample_one(image_id)
+                    arrays['image'][slot, k] = image
+                    foregrounds.append(foreground)
+                    reg_targets.append(foreground_reg_targets)
+                    backgrounds.append(background)
+                n_foreground = max(len(foreground) for foreground in foregrounds)
+                n_background = max(len(background) for background in backgrounds)
+                _, foreground_view, reg_targets_view, background_view = SampleWorkerPool.batch_views(
+                    arrays, slot, len(batch_image_ids), n_foreground, n_background)
+                for k in range(len(batch_image_ids)):
+                    _write_padded(foreground_view[k], foregrounds[k], -1)
+                    _write_padded(reg_targets_view[k], reg_targets[k], 0)
+                    _write_padded(background_view[k], backgrounds[k], -1)
+                counters[worker] += len(batch_image_ids)
+                ready.put(('batch', worker, slot, batch_image_ids, n_foreground, n_background))
+            epoch += 1
+        ready.put(('done', worker))
+    except Exception:
+        ready.put(('error', worker, traceback.format_exc()))
+    finally:
+        del arrays
+        shm.close()
+
+
+def _write_padded(out, array, value):
+    out[:len(array)] = array
+    out[len(array):] = value
+
+
+def _free_slot(free_slots, stop):
+    # None when the pool is closed
+    while not stop.is_set():
+        try:
+            return free_slots.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+if __name__ == '__main__':
+    from Configs.FasterRCNN_config import Param
+
+    kwargs = dict(file=Param.DATA_JSON_FILE, imagefolder_path=Param.PATH_IMAGES, anchor_base_size=Param.BASE_SIZE,
+                  ratios=Param.RATIOS, scales=Param.SCALES, n_anchors=Param.N_ANCHORS,
+                  img_shape_resize=Param.IMG_RESIZED_SHAPE, n_stage=Param.N_STAGE)
+    from NN_Helper import NnDataGenerator
+    test_image_ids = NnDataGenerator(**kwargs).dataset_coco.image_ids
+    with SampleWorkerPool(kwargs, test_image_ids, n_workers=4, queue_depth=4, n_epochs=1, batch_size=2) as pool:
+        t = time.time()
+        n = sum(len(batch[0]) for batch in pool)
+        print(f"{n} samples in {pool.batches_per_epoch()} batches in {time.time() - t:.1f} s, "
+              f"trainer waited {pool.wait_seconds:.1f} s")
+        print(f"per worker (samples, samples/s): {pool.throughput()}")
@@ -0,0 +1,80 @@
+import numpy as np
+
+from NN_Helper import BboxTools
+
+
+class TargetAssigner:
+    # Assign training targets to boxes (anchors or proposals) from one iou matrix in one vectorized pass.
+    # labels: 1 foreground, 0 background, 0.5 ignore. other author's implementations are use -1 to indicate
+    # ignoring, here use 0.5 to use max, same with the anchor target of RPN
+    def __init__(self, positive_threshold: float, negative_threshold: float = None):
+        '''
+        :param positive_threshold: boxes with max iou > positive_threshold are foreground
+        :param negative_threshold: boxes with max iou < negative_threshold are background, the ones between
+                                   are ignored. None means all the boxes which are not foreground are background
+        '''
+        self.positive_threshold = positive_threshold
+        self.negative_threshold = negative_threshold
+
+    def assign(self, ious, boxes, gt_boxes, gt_classes=None):
+        '''
+        :param ious: (N, M) iou matrix of boxes and gt_boxes
+        :param boxes: (N, 4) boxes (x1, y1, x2, y2)
+        :param gt_boxes: (M, 4) ground truth boxes (x1, y1, x2, y2)
+        :param gt_classes: (M,) sparse classes of gt_boxes, optional
+        :return: labels: float32 (N,)
+                 matched_gt_indices: int64 (N,), index of the gt box of each foreground box, -1 for others
+                 reg_targets: float32 (N, 4), regression target to the matched gt box, 0 for others
+                 class_targets: int64 (N,), class of the matched gt box, -1 for others. None without gt_classes
+        '''
+        ious = np.asarray(ious, dtype=np.float32)
+        n_boxes, n_gt = ious.shape
+        labels = np.zeros(shape=n_boxes, dtype=np.float32)
+        matched_gt_indices = np.full(shape=n_boxes, fill_value=-1, dtype=np.int64)
+        reg_targets = np.zeros(shape=(n_boxes, 4), dtype=np.float32)
+        class_targets = None if gt_classes is None else np.full(shape=n_boxes, fill_value=-1, dtype=np.int64)
+        if n_boxes == 0 or n_gt == 0:
+            return labels, matched_gt_indices, reg_targets, class_targets
+
+        # --- for each box, the gt box with max iou ---
+        max_gt_indices = np.argmax(ious, axis=1)
+        max_ious = ious[np.arange(n_boxes), max_gt_indices]
+        if self.negative_threshold is not None:
+            labels[max_ious >= self.negative_threshold] = 0.5
+        foreground = max_ious > self.positive_threshold
+        matched_gt_indices[foreground] = max_gt_indices[foreground]
+
+        # --- the box with max iou of each gt box is always foreground and matched to that gt box ---
+        best_boxes = np.argmax(ious, axis=0)
+        matched_gt_indices[best_boxes] = np.arange(n_gt)
+
+        foreground_indices = np.flatnonzero(matched_gt_indices >= 0)
+        labels[foreground_indices] = 1
+        matched = matched_gt_indices[foreground_indices]
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float32).reshape((-1, 4))
+        reg_targets[foreground_indices] = BboxTools.bbox_regression_target(
+            np.asarray(boxes, dtype=np.float32)[foreground_indices], gt_boxes[matched])
+        if gt_classes is not None:
+            class_targets[foreground_indices] = np.asarray(gt_classes)[matched]
+        return labels, matched_gt_indices, reg_targets, class_targets
+
+    def assign_sparse(self, candidates, ious, boxes, gt_boxes, gt_classes=None):
+        '''
+        assign on the rows of the candidate boxes only, e.g. from AnchorSpatialIndex.sparse_ious. Every other box
+        has iou 0 with all the gt boxes, so it is background (negative_threshold > 0). Same result with assign on
+        the dense iou matrix
+        :param candidates: sorted int64 (K,) indices into boxes
+        :param ious: (K, M) iou matrix of boxes[candidates] and gt_boxes
+        :return: candidates int64 (K',), and labels, matched_gt_indices, reg_targets, class_targets of assign
+                 for the boxes boxes[candidates]
+        '''
+        candidates = np.asarray(candidates, dtype=np.int64)
+        ious = np.asarray(ious, dtype=np.float32)
+        if ious.shape[1] > 0 and (candidates.size == 0 or candidates[0] != 0) and \
+                not np.all(np.max(ious, axis=0, initial=0) > 0):
+            # the dense argmax matches a gt box without any overlap to box 0, keep box 0 as a candidate for it
+            candidates = np.concatenate([np.zeros(shape=1, dtype=np.int64), candidates])
+            ious = np.concatenate([np.zeros(shape=(1, ious.shape[1]), dtype=np.float32), ious])
+        labels, matched_gt_indices, reg_targets, class_targets = self.assign(
+            ious, np.asarray(boxes, dtype=np.float32)[candidates], gt_boxes, gt_classes)
+        return candidates, labels, matched_gt_indices, reg_targets, class_targets
@@ -1,7 +1,7 @@
+import itertools
 import json
 import os
 import random
-from typing import Any, Union
 
 import numpy as np
 import tensorflow as tf
@@ -9,14 +9,16 @@ import tensorflow as tf
 from Configs.FasterRCNN_config import Param
 from Debugger import debug_print
 from NN_Components import Backbone, RPN, RoI
-from NN_Helper import NnDataGenerator, BboxTools
+from NN_Helper import AspectBuckets, NnDataGenerator, BboxTools, NmsTools, RandomAugmenter, SampleWorkerPool
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'  # for mac os tensorflow setting
 
 
 class FasterRCNN():
     def __init__(self):
-        self.Backbone = Backbone(img_shape=Param.IMG_RESIZED_SHAPE, n_stage=Param.N_STAGE)
+        # dynamic input shape with aspect ratio buckets, one model for all the bucket shapes
+        self.Backbone = Backbone(img_shape=(None, None, 3) if Param.ASPECT_BUCKETS else Param.IMG_RESIZED_SHAPE,
+                                 n_stage=Param.N_STAGE)
         self.IMG_SHAPE = Param.IMG_RESIZED_SHAPE
         # self.backbone_model.trainable= False
         # === RPN part ===
@@ -33,7 +35,8 @@ class FasterRCNN():
         self.RoI_header = self.RoI.RoI_header_model
 
         # === Data part ===
-        self.train_data_generator = NnDataGenerator(
+        # the arguments are kept for the generators of the SampleWorkerPool processes
+        self.generator_kwargs = dict(
             file=Param.DATA_JSON_FILE,
             imagefolder_path=Param.PATH_IMAGES,
             anchor_base_size=Param.BASE_SIZE,
@@ -43,43 +46,44 @@ class FasterRCNN():
             img_shape_resize=Param.IMG_RESIZED_SHAPE,
             n_stage=Param.N_STAGE,
             threshold_iou_rpn=Param.THRESHOLD_IOU_RPN,
-            threshold_iou_roi=Param.THRESHOLD_IOU_RoI)
+            threshold_iou_roi=Param.THRESHOLD_IOU_RoI,
+            image_shard_dir=Param.PATH_IMAGE_SHARDS or None,
+            augmenter=RandomAugmenter(flip_horizontal=Param.AUGMENT_FLIP_HORIZONTAL,
+                                      flip_vertical=Param.AUGMENT_FLIP_VERTICAL,
+                                      scale_range=Param.AUGMENT_SCALE_RANGE),
+            rpn_target_cache=Param.RPN_TARGET_CACHE)
+        self.train_data_generator = NnDataGenerator(**self.generator_kwargs)
         self.cocotool = self.train_data_generator.dataset_coco
 
         self.anchor_candidate_generator = self.train_data_generator.gen_candidate_anchors
         self.anchor_candidates = self.anchor_candidate_generator.anchor_candidates
 
     def test_loss_function(self):
-        inputs, anchor_targets, bbox_targets = self.train_data_generator.gen_train_data_rpn_all()
-        print(inputs.shape, anchor_targets.shape, bbox_targets.shape)
-        input1 = np.reshape(inputs[0, :, :, :], (1, 720, 1280, 3))
-        anchor1 = np.reshape(anchor_targets[0, :, :, :], (1, 23, 40, 9))
-        anchor2 = tf.convert_to_tensor(anchor1)
-        anchor2 = tf.dtypes.cast(anchor2, tf.int32)
-        anchor2 = tf.one_hot(anchor2, 2, axis=-1)
-        print(anchor1)
-        bbox1 = np.reshape(bbox_targets[0, :, :, :, :], (1, 23, 40, 9, 4))
-        loss = self.RPN._rpn_loss(anchor1, bbox1, anchor2, bbox1)
+        # RPN loss of the first sample with the sparse targets of the train steps, any resize shape
+        image, foreground_indices, foreground_reg_targets, background_indices = next(iter(
+            self.train_data_generator.tf_dataset_rpn(shuffle=False)))
+        print(image.shape, foreground_indices.shape, foreground_reg_targets.shape, background_indices.shape)
+        anchor_pred, bbox_reg_pred = self.RPN.RPN_with_backbone_model(tf.cast(image, tf.float32), training=False)
+        loss = self.RPN._rpn_loss_sparse(foreground_indices, foreground_reg_targets, background_indices,
+                                         anchor_pred, bbox_reg_pred)
         print(loss)
 
     def faster_rcnn_output(self):
         # === prepare input images ===
         image_ids = self.train_data_generator.dataset_coco.image_ids
-        inputs, anchor_targets, bbox_reg_targets = self.train_data_generator.gen_train_data_rpn_one(image_ids[0])
-        print(inputs.shape, anchor_targets.shape, bbox_reg_targets.shape)
+        # the original image, the output boxes are in its frame
+        inputs, foreground_indices, _, background_indices = self.train_data_generator.gen_train_data_rpn_one(
+            image_ids[0], RandomAugmenter.IDENTITY)
+        print(inputs.shape, foreground_indices.shape, background_indices.shape)
         image = np.reshape(inputs[0, :, :, :], (1, self.IMG_SHAPE[0], self.IMG_SHAPE[1], 3))
         # === get proposed region boxes ===
         rpn_anchor_pred, rpn_bbox_regression_pred = self.RPN.process_image(image)
-        proposed_boxes = self.RPN._proposal_boxes(rpn_anchor_pred, rpn_bbox_regression_pred,
-                                                  self.anchor_candidates,
-                                                  self.anchor_candidate_generator.h,
-                                                  self.anchor_candidate_generator.w,
-                                                  self.anchor_candidate_generator.n_anchors,
-                                                  Param.ANCHOR_PROPOSAL_N,
-                                                  Param.ANCHOR_THRESHOLD
-                                                  )
+        proposed_boxes, proposed_box_indices = self.RPN._proposal_boxes(rpn_anchor_pred, rpn_bbox_regression_pred,
+                                                                        self.anchor_candidates,
+                                                                        Param.ANCHOR_PROPOSAL_N,
+                                                                        Param.ANCHOR_THRESHOLD)
         # === processing boxes with RoI header ===
-        pred_class, pred_box_reg = self.RoI.process_image([image, proposed_boxes])
+        pred_class, pred_box_reg = self.RoI.process_image([image, proposed_boxes, proposed_box_indices])
         # === processing the results ===
         pred_class_sparse = np.argmax(a=pred_class[:, :], axis=1)
         pred_class_sparse_value = np.max(a=pred_class[:, :], axis=1)
@@ -104,26 +108,28 @@ class FasterRCNN():
         # print(final_box)
         print(final_box[pred_class_sparse_value > 0.9])
         final_box = final_box[pred_class_sparse_value > 0.9]
-        self.cocotool.draw_bboxes(original_image=image[0], bboxes=final_box.tolist(), show=True, save_file=True,
+        self.cocotool.draw_bboxes(original_image=image[0], bboxes=final_box.tolist(), save_file=True,
                                   path=Param.PATH_DEBUG_IMG, save_name='6PredRoISBoxes')
 
-        # === Non maximum suppression ===
-        final_box_temp = np.array(final_box).astype(np.int)
-        nms_boxes_list = []
-        while final_box_temp.shape[0] > 0:
-            ious = self.nms_loop_np(final_box_temp)
-            nms_boxes_list.append(
-                final_box_temp[0, :])  # since it's sorted by the value, here we can pick the first one each time.
-            final_box_temp = final_box_temp[ious < Param.RPN_NMS_THRESHOLD]
+        # === Non maximum suppression per class ===
+        keep = NmsTools.batched_nms(boxes=final_box,
+                                    scores=pred_class_sparse_value[pred_class_sparse_value > 0.9],
+                                    class_ids=pred_class_sparse[pred_class_sparse_value > 0.9],
+                                    iou_threshold=Param.RPN_NMS_THRESHOLD)
+        nms_boxes_list = final_box[keep].tolist()
         debug_print('number of box after nms', len(nms_boxes_list))
-        self.cocotool.draw_bboxes(original_image=image[0], bboxes=nms_boxes_list, show=True, save_file=True,
+        self.cocotool.draw_bboxes(original_image=image[0], bboxes=nms_boxes_list, save_file=True,
                                   path=Param.PATH_DEBUG_IMG, save_name='7PredRoINMSBoxes')
+        # the jpegs are written in the background
+        self.cocotool.renderer.wait()
 
     def test_proposal_visualization(self):
         # === Prediction part ===
         image_ids = self.train_data_generator.dataset_coco.image_ids
-        inputs, anchor_targets, bbox_reg_targets = self.train_data_generator.gen_train_data_rpn_one(image_ids[0])
-        print(inputs.shape, anchor_targets.shape, bbox_reg_targets.shape)
+        # the original image, the ground truth and target anchors are drawn on it
+        inputs, foreground_indices, _, background_indices = self.train_data_generator.gen_train_data_rpn_one(
+            image_ids[0], RandomAugmenter.IDENTITY)
+        print(inputs.shape, foreground_indices.shape, background_indices.shape)
         input1 = np.reshape(inputs[0, :, :, :], (1, self.IMG_SHAPE[0], self.IMG_SHAPE[1], 3))
         rpn_anchor_pred, rpn_bbox_regression_pred = self.RPN.process_image(input1)
         print(rpn_anchor_pred.shape, rpn_bbox_regression_pred.shape)
@@ -137,7 +143,6 @@ class FasterRCNN():
         # squeeze the pred of anchor and bbox_reg
         rpn_anchor_pred = tf.squeeze(rpn_anchor_pred)
         rpn_bbox_regression_pred = tf.squeeze(rpn_bbox_regression_pred)
-        shape1 = tf.shape(rpn_anchor_pred)
         print(rpn_anchor_pred.shape, rpn_bbox_regression_pred.shape)
         # flatten the pred of anchor to get top N values and indices
         rpn_anchor_pred = tf.reshape(rpn_anchor_pred, (-1,))
@@ -154,15 +159,9 @@ class FasterRCNN():
 
         top_indices = tf.reshape(top_indices, (-1, 1))
         debug_print('top indices', top_indices)
-        update_value = tf.math.add(top_values, 1)
-        rpn_anchor_pred = tf.tensor_scatter_nd_update(rpn_anchor_pred, top_indices, update_value)
-        rpn_anchor_pred = tf.reshape(rpn_anchor_pred, shape1)
-
-        # --- find the base boxes ---
-        anchor_pred_top_indices = tf.where(tf.greater(rpn_anchor_pred, 1))
-        debug_print('original_indices shape', anchor_pred_top_indices.shape)
-        debug_print('original_indices', anchor_pred_top_indices)
-        base_boxes = tf.gather_nd(self.anchor_candidates, anchor_pred_top_indices)
+
+        # --- find the base boxes, in the same (score) order with top_values and the bbox_regs ---
+        base_boxes = tf.gather_nd(self.anchor_candidate_generator.anchor_candidates_flat, top_indices)
         debug_print('base_boxes shape', base_boxes.shape)
         debug_print('base_boxes', base_boxes)
         base_boxes = np.array(base_boxes)
@@ -182,13 +181,8 @@ class FasterRCNN():
         final_box = BboxTools.bbox_reg2truebox(base_boxes=base_boxes, regs=final_box_reg)
 
         # === Non maximum suppression ===
-        final_box_temp = np.array(final_box).astype(np.int)
-        nms_boxes_list = []
-        while final_box_temp.shape[0] > 0:
-            ious = self.nms_loop_np(final_box_temp)
-            nms_boxes_list.append(
-                final_box_temp[0, :])  # since it's sorted by the value, here we can pick the first one each time.
-            final_box_temp = final_box_temp[ious < Param.RPN_NMS_THRESHOLD]
+        keep = NmsTools.nms(boxes=final_box, scores=np.array(top_values), iou_threshold=Param.RPN_NMS_THRESHOLD)
+        nms_boxes_list = final_box[keep].tolist()
         debug_print('number of box after nms', len(nms_boxes_list))
 
         # Need to convert above instructions to tf operations
@@ -199,121 +193,115 @@ class FasterRCNN():
         final_box = BboxTools.clip_boxes(final_box, self.IMG_SHAPE)
 
         original_boxes = self.cocotool.get_original_bboxes_list(image_id=self.cocotool.image_ids[0])
-        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=original_boxes, show=True, save_file=True,
+        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=original_boxes, save_file=True,
                                   path=Param.PATH_DEBUG_IMG, save_name='1GroundTruthBoxes')
         target_anchor_boxes, target_classes = self.train_data_generator.gen_target_anchor_bboxes_classes_for_debug(
             image_id=self.cocotool.image_ids[0])
-        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=target_anchor_boxes, show=True, save_file=True,
+        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=target_anchor_boxes, save_file=True,
                                   path=Param.PATH_DEBUG_IMG, save_name='2TrueAnchorBoxes')
-        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=base_boxes.tolist(), show=True, save_file=True,
+        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=base_boxes.tolist(), save_file=True,
                                   path=Param.PATH_DEBUG_IMG, save_name='3PredAnchorBoxes')
-        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=final_box.tolist(), show=True, save_file=True,
+        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=final_box.tolist(), save_file=True,
                                   path=Param.PATH_DEBUG_IMG, save_name='4PredRegBoxes')
-        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=nms_boxes_list, show=True, save_file=True,
+        self.cocotool.draw_bboxes(original_image=input1[0], bboxes=nms_boxes_list, save_file=True,
                                   path=Param.PATH_DEBUG_IMG, save_name='5PredNMSBoxes')
+        # the jpegs are written in the background
+        self.cocotool.renderer.wait()
 
     def test_total_visualization(self):
         # === prediction part ===
-        input_images, target_anchor_bboxes, target_classes = self.train_data_generator.gen_train_data_roi_one(
-            self.train_data_generator.dataset_coco.image_ids[0],
-            self.train_data_generator.gen_candidate_anchors.anchor_candidates_list)
-        input_images, target_anchor_bboxes, target_classes = np.asarray(input_images).astype(np.float), np.asarray(
-            target_anchor_bboxes), np.asarray(target_classes)
+        input_image, target_anchor_bboxes, target_classes, _, box_indices = \
+            self.train_data_generator.gen_train_data_roi_one(self.train_data_generator.dataset_coco.image_ids[0],
+                                                             augmentation=RandomAugmenter.IDENTITY)
         # TODO:check tf.image.crop_and_resize
-        input_images2 = input_images[:1].astype(np.float)
-        print(input_images2.shape)
-        target_anchor_bboxes2 = target_anchor_bboxes[:1].astype(np.float)
+        print(input_image.shape)
+        target_anchor_bboxes2 = target_anchor_bboxes[:1]
         print(target_anchor_bboxes2.shape)
-        class_header, box_reg_header = self.RoI.process_image([input_images2, target_anchor_bboxes2])
+        class_header, box_reg_header = self.RoI.process_image([input_image, target_anchor_bboxes2, box_indices[:1]])
         print(class_header.shape, box_reg_header.shape)
         print(class_header)
 
-    def nms_loop_np(self, boxes):
-        # boxes : (N, 4), box_1target : (4,)
-        # box axis format: (x1,y1,x2,y2)
-
-        box_1target = np.ones(shape=boxes.shape)
-        zeros = np.zeros(shape=boxes.shape)
-        box_1target = box_1target * boxes[0, :]
-        box_b_area = (box_1target[:, 2] - box_1target[:, 0] + 1) * (box_1target[:, 3] - box_1target[:, 1] + 1)
-        # --- determine the (x, y)-coordinates of the intersection rectangle ---
-        x_a = np.max(np.array([boxes[:, 0], box_1target[:, 0]]), axis=0)
-        y_a = np.max(np.array([boxes[:, 1], box_1target[:, 1]]), axis=0)
-        x_b = np.min(np.array([boxes[:, 2], box_1target[:, 2]]), axis=0)
-        y_b = np.min(np.array([boxes[:, 3], box_1target[:, 3]]), axis=0)
-
-        # --- compute the area of intersection rectangle ---
-        inter_area = np.max(np.array([zeros[:, 0], x_b - x_a + 1]), axis=0) * np.max(
-            np.array([zeros[:, 0], y_b - y_a + 1]),
-            axis=0)
-
-        # --- compute the area of both the prediction and ground-truth ---
-        # rectangles
-        box_a_area: Union[int, Any] = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
-
-        # compute the intersection over union by taking the intersection
-        # area and dividing it by the sum of prediction + ground-truth
-        # areas - the intersection area
-        ious = (inter_area / (box_a_area + box_b_area - inter_area))
-
-        # return the intersection over union value
-        return ious
-
     def train_rpn_roi(self, ):
         # TODO: use the output of RPN to train RoI
         image_ids = self.train_data_generator.dataset_coco.image_ids
+        # generators of this process, for the hit rate of their RPN target caches
+        generators = [self.train_data_generator]
+        if Param.N_SAMPLE_WORKERS > 0:
+            # the RPN header samples are made by worker processes, one pool for all the epochs
+            sample_pool = SampleWorkerPool(self.generator_kwargs, image_ids, n_workers=Param.N_SAMPLE_WORKERS,
+                                           queue_depth=Param.SAMPLE_QUEUE_DEPTH, n_epochs=Param.EPOCH,
+                                           batch_size=Param.BATCH_RPN).start()
+            # an epoch is batches_per_epoch batches, the last one of each shard incomplete. The worker shards run
+            # side by side, so the epoch of a faster worker may already give a few batches to this epoch, every
+            # image is still trained once per epoch on average and EPOCH times in total
+            pool_batches = iter(sample_pool)
+        else:
+            sample_pool = None
+            if Param.ASPECT_BUCKETS:
+                aspect_buckets = AspectBuckets(self.generator_kwargs, Param.ASPECT_BUCKETS)
+                generators += aspect_buckets.generators
+                rpn_dataset = aspect_buckets.tf_dataset_rpn(batch_size=Param.BATCH_RPN)
+            else:
+                rpn_dataset = self.train_data_generator.tf_dataset_rpn(batch_size=Param.BATCH_RPN)
         for epoch in range(Param.EPOCH):
             print(f'epoch : {epoch}')
             temp_image_ids = random.choices(population=image_ids, weights=None, k=8)
 
             for image_id in image_ids:
                 # --- train RoI ---
-                input_img, input_box_filtered_by_iou, target_class, target_bbox_reg = \
-                    self.train_data_generator.gen_train_data_roi_one(
-                        image_id, self.train_data_generator.gen_candidate_anchors.anchor_candidates_list)
-                n_box = input_img.shape[0]
+                # one image for all the boxes, box_indices point every box to it
+                input_img, input_box_filtered_by_iou, target_class, target_bbox_reg, box_indices = \
+                    self.train_data_generator.gen_train_data_roi_one(image_id)
+                roi_augmentation = self.train_data_generator.last_augmentation
                 # --- train RoI with backbone once, balance with the RPN train ---
-                # j = random.randint(a=0,
-                #                    b=n_box - 1)
-                # model with backbone only be trained once to balance RPN and RoI training
-                for j in range(n_box):
-                    self.RoI.train_step_with_backbone(input_img[j:j + 1], input_box_filtered_by_iou[j:j + 1],
-                                                      target_class[j:j + 1], target_bbox_reg[j:j + 1])
+                # model with backbone only be trained once to balance RPN and RoI training,
+                # one step for all the boxes, the feature map is computed once
+                self.RoI.train_step_with_backbone(input_img, input_box_filtered_by_iou, target_class, target_bbox_reg,
+                                                  box_indices)
 
                 # --- train RPN with backbone---
-                inputs, anchor_targets, bbox_reg_targets = self.train_data_generator.gen_train_data_rpn_one(image_id)
-                self.RPN.train_step_with_backbone(inputs, anchor_targets, bbox_reg_targets)
+                inputs, foreground_indices, foreground_reg_targets, background_indices = \
+                    self.train_data_generator.gen_train_data_rpn_one(image_id)
+                self.RPN.train_step_with_backbone(inputs, foreground_indices, foreground_reg_targets,
+                                                  background_indices)
 
                 # --- train RoI header secondly ---
-                for j in range(n_box):
-                    self.RoI.train_step_header(input_img[0:1], input_box_filtered_by_iou[j:j + 1],
-                                               target_class[j:j + 1], target_bbox_reg[j:j + 1])
+                self.RoI.train_step_header(input_img, input_box_filtered_by_iou, target_class, target_bbox_reg,
+                                           box_indices)
 
-                # --- train RoI with RPN proposed boxes ---
+                # --- train RoI with RPN proposed boxes, on the same augmented image ---
                 if epoch > 10:
-                    rpn_anchor_pred, rpn_bbox_regression_pred = self.RPN.process_image(input_img[:1])
-                    proposed_boxes = self.RPN._proposal_boxes(rpn_anchor_pred, rpn_bbox_regression_pred,
-                                                              self.anchor_candidates,
-                                                              self.anchor_candidate_generator.h,
-                                                              self.anchor_candidate_generator.w,
-                                                              self.anchor_candidate_generator.n_anchors,
-                                                              Param.ANCHOR_PROPOSAL_N,
-                                                              Param.ANCHOR_THRESHOLD
-                                                              )
+                    rpn_anchor_pred, rpn_bbox_regression_pred = self.RPN.process_image(input_img)
+                    proposed_boxes, _ = self.RPN._proposal_boxes(rpn_anchor_pred, rpn_bbox_regression_pred,
+                                                                 self.anchor_candidates,
+                                                                 Param.ANCHOR_PROPOSAL_N,
+                                                                 Param.ANCHOR_THRESHOLD)
                     if len(list(proposed_boxes.tolist())) == 0:
                         continue
-                    input_img, input_box_filtered_by_iou, target_class, target_bbox_reg = \
+                    input_img, input_box_filtered_by_iou, target_class, target_bbox_reg, box_indices = \
                         self.train_data_generator.gen_train_data_roi_one(
-                            image_id, proposed_boxes.tolist())
-                    for j in range(n_box):
-                        self.RoI.train_step_header(input_img[j:j + 1], input_box_filtered_by_iou[j:j + 1],
-                                                   target_class[j:j + 1], target_bbox_reg[j:j + 1])
-
-            # --- train RPN header first ---
-            for image_id in image_ids:
-                inputs, anchor_targets, bbox_reg_targets = self.train_data_generator.gen_train_data_rpn_one(
-                    image_id)
-                self.RPN.train_step_header(inputs, anchor_targets, bbox_reg_targets)
+                            image_id, proposed_boxes.tolist(), roi_augmentation)
+                    self.RoI.train_step_header(input_img, input_box_filtered_by_iou, target_class, target_bbox_reg,
+                                               box_indices)
+
+            # --- train RPN header first, the samples are made in the background by tf.data or the worker pool ---
+            if sample_pool is None:
+                for inputs, foreground_indices, foreground_reg_targets, background_indices in rpn_dataset:
+                    self.RPN.train_step_header(inputs, foreground_indices, foreground_reg_targets,
+                                               background_indices)
+            else:
+                # the uint8 views of the shared memory go to the train step as they are, it returns before the
+                # next batch gives their slot back
+                for _, images, foreground_indices, foreground_reg_targets, background_indices in itertools.islice(
+                        pool_batches, sample_pool.batches_per_epoch()):
+                    self.RPN.train_step_header(images, foreground_indices, foreground_reg_targets, background_indices)
+                print(f"sample workers (samples, samples/s): {sample_pool.throughput()}")
+            if Param.RPN_TARGET_CACHE:
+                # the samples of the worker processes are not counted here
+                hits, lookups = np.sum([generator.rpn_target_cache_stats() for generator in generators], axis=0)
+                print(f"rpn target cache hits: {hits}/{lookups}")
+        if sample_pool is not None:
+            sample_pool.close()
 
     def save_weight(self):
         self.RPN.save_model(Param.PATH_MODEL)
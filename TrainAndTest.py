@@ -1,9 +1,11 @@
 from NN_Model import FasterRCNN
 
-f1 = FasterRCNN()
+# guarded, the cache build and the sample workers spawn processes which import this script again
+if __name__ == '__main__':
+    f1 = FasterRCNN()
 
-# f1.train_RPN_RoI()
-# f1.save_weight()
-f1.load_weight()
-f1.test_proposal_visualization()
-f1.faster_rcnn_output()
\ No newline at end of file
+    # f1.train_RPN_RoI()
+    # f1.save_weight()
+    f1.load_weight()
+    f1.test_proposal_visualization()
+    f1.faster_rcnn_output()